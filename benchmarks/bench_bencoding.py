@@ -0,0 +1,73 @@
+"""
+Benchmarks `pieces.bencoding.Decoder` and `Encoder` against `bencodepy` on
+a large .torrent file and on tracker and DHT style responses with thousands
+of entries.
+
+Usage:
+    PYTHONPATH=. python benchmarks/bench_bencoding.py [entries]
+"""
+import os
+import random
+import sys
+import time
+import bencodepy
+from pieces.bencoding import Decoder, Encoder
+
+
+def measure(name, fn, repeat):
+    # Best of `repeat` runs, to keep other load on the machine out of it
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    elapsed = min(timings)
+    print(f'  {name:<32} {elapsed * 1e3:10.2f} ms')
+    return elapsed
+
+
+def samples(entries):
+    rng = random.Random(42)
+    files = [{b'length': rng.randrange(2**32),
+              b'path': [b'directory', b'file-%d.bin' % i]} for i in range(entries)]
+    torrent = {b'announce': b'http://tracker.example/announce',
+               b'info': {b'files': files, b'name': b'bench', b'piece length': 2**18,
+                         b'pieces': os.urandom(20 * entries)}}
+    tracker = {b'interval': 1800, b'complete': entries, b'incomplete': 12,
+               b'peers': [{b'ip': b'10.0.%d.%d' % (i // 256 % 256, i % 256), b'port': 6881,
+                           b'peer id': os.urandom(20)} for i in range(entries)]}
+    dht = {b't': b'aa', b'y': b'r',
+           b'r': {b'id': os.urandom(20), b'token': os.urandom(8),
+                  b'values': [os.urandom(6) for _ in range(entries)],
+                  b'nodes': os.urandom(26 * 8)}}
+    return [('.torrent with %d files' % entries, bencodepy.encode(torrent)),
+            ('tracker with %d peers' % entries, bencodepy.encode(tracker)),
+            ('DHT reply with %d values' % entries, bencodepy.encode(dht))]
+
+
+def main():
+    entries = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    for name, data in samples(entries):
+        print(f'{name} ({len(data)} bytes)')
+        assert Decoder(data).decode() == bencodepy.decode(data)
+        baseline = measure('bencodepy.decode', lambda: bencodepy.decode(data), 10)
+        elapsed = measure('Decoder.decode', lambda: Decoder(data).decode(), 10)
+        measure('Decoder.decode (str keys)', lambda: Decoder(data, str_keys=True).decode(), 10)
+        print(f'  speedup {baseline / elapsed:.1f}x')
+
+        value = bencodepy.decode(data)
+        assert Decoder(Encoder(value).encode()).decode() == value
+        baseline = measure('bencodepy.encode', lambda: bencodepy.encode(value), 10)
+        elapsed = measure('Encoder.encode', lambda: Encoder(value).encode(), 10)
+        buffer = bytearray()
+
+        def encode_into():
+            buffer.clear()
+            Encoder(value).encode_into(buffer)
+        measure('Encoder.encode_into (reused)', encode_into, 10)
+        measure('Encoder.stream', lambda: Encoder(value).stream(lambda chunk: None), 10)
+        print(f'  speedup {baseline / elapsed:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+"""
+Benchmarks the whole-set `Bitset` operations used for interest and piece
+picking against a per-piece loop over `bitstring.BitArray` bitfields.
+
+Usage:
+    PYTHONPATH=. python benchmarks/bench_bitset.py [peers] [pieces]
+"""
+import random
+import sys
+import time
+import bitstring
+from pieces.bitset import Bitset
+
+
+def measure(name, fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    elapsed = (time.perf_counter() - start) / repeat
+    print(f'  {name:<32} {elapsed * 1e6:12.1f} us')
+    return result
+
+
+def main():
+    peers = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    pieces = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    rng = random.Random(42)
+    have = Bitset.from_int(pieces, rng.getrandbits(pieces))
+    swarm = [Bitset.from_int(pieces, rng.getrandbits(pieces)) for _ in range(peers)]
+    print(f'{peers} peers, {pieces} pieces')
+
+    measure('popcount', have.count, 1000)
+    peer = swarm[0]
+    measure('intersection count (1 peer)', lambda: peer.intersection_count(have), 1000)
+    measure('interested (1 peer)', lambda: peer.difference_count(have) > 0, 1000)
+    measure(f'missing pieces ({peers} peers)',
+            lambda: [bitset.difference_count(have) for bitset in swarm], 10)
+
+    legacy_have = bitstring.BitArray(bytes=have.tobytes())
+    legacy_peer = bitstring.BitArray(bytes=peer.tobytes())
+    measure('BitArray loop (1 peer)',
+            lambda: sum(1 for i in range(pieces) if legacy_peer[i] and not legacy_have[i]), 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""
+Runs a swarm of in-process DHT nodes on localhost and reports the latency
+and message count of `get_peers` lookups.
+
+Usage:
+    PYTHONPATH=. python benchmarks/bench_dht.py [nodes] [lookups]
+"""
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+from pieces.dht import DHTNode
+
+
+def sent(nodes):
+    return sum(node.stats['sent'] for node in nodes)
+
+
+async def run(count, lookups):
+    rng = random.Random(42)
+    nodes = [await DHTNode(host='127.0.0.1').start() for _ in range(count)]
+    try:
+        start = time.perf_counter()
+        # Every node joins through a random node already in the swarm
+        for index, node in enumerate(nodes[1:], 1):
+            await node.bootstrap([rng.choice(nodes[:index]).address])
+        print(f'{count} nodes bootstrapped in {time.perf_counter() - start:.2f} s, '
+              f'{statistics.mean(len(node.table) for node in nodes):.1f} nodes per table')
+
+        info_hashes = [os.urandom(20) for _ in range(lookups)]
+        for info_hash in info_hashes:
+            await rng.choice(nodes).announce_peer(info_hash, rng.randrange(1, 65536))
+
+        latencies = []
+        messages = []
+        found = 0
+        for info_hash in info_hashes:
+            node = rng.choice(nodes)
+            before = sent(nodes)
+            start = time.perf_counter()
+            peers = await node.get_peers(info_hash)
+            latencies.append(time.perf_counter() - start)
+            messages.append(sent(nodes) - before)
+            found += bool(peers)
+        latencies.sort()
+        print(f'{lookups} get_peers lookups, {found} found the announced peer')
+        print(f'  latency  median {statistics.median(latencies) * 1e3:8.2f} ms   '
+              f'p95 {latencies[int(len(latencies) * 0.95) - 1] * 1e3:8.2f} ms')
+        print(f'  messages median {statistics.median(messages):8.1f}      '
+              f'max {max(messages):8d}')
+    finally:
+        for node in nodes:
+            node.close()
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    lookups = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    asyncio.run(run(count, lookups))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""
+Compares the streaming `MessageFramer` with the original slicing decoder
+(`buffer += data`, `buffer[:n]`, `PeerMessage.decode`) on a stream of
+16 KiB `Piece` messages fed in socket-sized reads.
+
+Usage:
+    PYTHONPATH=. python benchmarks/bench_framer.py [blocks] [read size]
+"""
+import struct
+import sys
+import time
+from pieces.protocol import Have, MessageFramer, Piece, PeerMessage, REQUEST_SIZE
+
+
+def build_stream(blocks: int) -> bytes:
+    block = bytes(REQUEST_SIZE)
+    messages = []
+    for i in range(blocks):
+        messages.append(Piece(i // 16, (i % 16) * REQUEST_SIZE, block).encode())
+        if i % 16 == 15:
+            messages.append(Have(i // 16).encode())
+    return b''.join(messages)
+
+
+def chunks(data: bytes, size: int):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class LegacyParser:
+    """
+    The parsing loop used before the framer, counting the bytes each slice
+    and concatenation copies.
+    """
+    def __init__(self):
+        self.buffer = b''
+        self.copied = 0
+
+    def feed(self, data: bytes):
+        self.buffer += data
+        self.copied += len(self.buffer)
+
+    def parse(self):
+        if len(self.buffer) < 4:
+            return None
+        message_length = struct.unpack('>I', self.buffer[:4])[0]
+        if len(self.buffer) < 4 + message_length:
+            return None
+        data = self.buffer[:4 + message_length]
+        self.buffer = self.buffer[4 + message_length:]
+        self.copied += len(data) + len(self.buffer)
+        message = PeerMessage.decode(data)
+        if isinstance(message, Piece):
+            # Piece.decode slices the message once more, then 's' copies the block
+            self.copied += len(data) + len(message.block)
+        return message
+
+
+def run_legacy(reads):
+    parser = LegacyParser()
+    count = 0
+    for data in reads:
+        parser.feed(data)
+        while parser.parse():
+            count += 1
+    return count, parser.copied
+
+
+def run_framer(reads):
+    framer = MessageFramer()
+    count = 0
+    fed = 0
+    for data in reads:
+        framer.feed(data)
+        fed += len(data)
+        for _ in framer:
+            count += 1
+    return count, fed + framer.bytes_moved
+
+
+def measure(name, fn, reads, blocks):
+    start = time.perf_counter()
+    count, copied = fn(reads)
+    elapsed = time.perf_counter() - start
+    print(f'{name:>8}: {count / elapsed:12,.0f} messages/s '
+          f'{copied / blocks:10,.0f} bytes copied/block')
+
+
+def main():
+    blocks = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    read_size = int(sys.argv[2]) if len(sys.argv) > 2 else 64 * 1024
+    reads = chunks(build_stream(blocks), read_size)
+    print(f'{blocks} blocks of {REQUEST_SIZE} bytes, {read_size} byte reads')
+    measure('legacy', run_legacy, reads, blocks)
+    measure('framer', run_framer, reads, blocks)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+"""
+Benchmarks decoding compact peer lists with `pieces.peer.decode_peers`
+against slicing and formatting one 6 byte entry at a time.
+
+Usage:
+    PYTHONPATH=. python benchmarks/bench_peers.py [peers]
+"""
+import os
+import sys
+import time
+from pieces.peer import decode_peers
+
+
+def measure(name, fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - start)
+    elapsed = min(timings)
+    print(f'  {name:<32} {elapsed * 1e3:10.2f} ms')
+    return result, elapsed
+
+
+def per_entry(peers):
+    # The tracker's original decoder
+    peer_list = []
+    for i in range(0, len(peers), 6):
+        ip = peers[i:i + 4]
+        port = peers[i + 4:i + 6]
+        peer_list.append(('.'.join(str(x) for x in ip), int.from_bytes(port, 'big')))
+    return peer_list
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    data = os.urandom(6 * count)
+    data6 = os.urandom(18 * count)
+    print(f'{count} peers')
+    baseline, before = measure('per entry (IPv4)', lambda: per_entry(data), 10)
+    peers, after = measure('decode_peers (IPv4)', lambda: decode_peers(data), 10)
+    measure('decode_peers (IPv6)', lambda: decode_peers(data6, ipv6=True), 10)
+    assert peers == list(dict.fromkeys(peer for peer in baseline if peer[1]))
+    print(f'  speedup {before / after:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+Benchmarks the rarest-first `PiecePicker` with a simulated swarm: a share
+of the peers are seeds, the others have a random ~12% of the pieces.
+
+Seeds pick in O(1), so by default every peer is partial, the case where
+picks have to find a piece the peer has.
+
+Usage:
+    PYTHONPATH=. python benchmarks/bench_picker.py [peers] [pieces] [seed share]
+"""
+import random
+import sys
+import time
+from pieces.bitset import Bitset
+from pieces.picker import PiecePicker
+
+
+def build_swarm(peers: int, pieces: int, seed_share: float, rng):
+    everything = (1 << pieces) - 1
+    swarm = {}
+    for peer in range(peers):
+        if rng.random() < seed_share:
+            value = everything
+        else:
+            value = rng.getrandbits(pieces) & rng.getrandbits(pieces) & rng.getrandbits(pieces)
+        swarm[peer] = Bitset.from_int(pieces, value)
+    return swarm
+
+
+def naive_rarest(swarm, bitmap, candidates):
+    """
+    Counts every peer's bitfield for every candidate piece, as a picker
+    without an availability index would.
+    """
+    best = None
+    for index in candidates:
+        if bitmap[index]:
+            count = sum(peer[index] for peer in swarm.values())
+            if best is None or count < best[0]:
+                best = (count, index)
+    return best
+
+
+def main():
+    peers = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    pieces = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    seed_share = float(sys.argv[3]) if len(sys.argv) > 3 else 0.0
+    rng = random.Random(42)
+    swarm = build_swarm(peers, pieces, seed_share, rng)
+    print(f'{peers} peers ({seed_share:.0%} seeds), {pieces} pieces')
+
+    picker = PiecePicker(pieces, random_first=0)
+    start = time.perf_counter()
+    for peer, bitmap in swarm.items():
+        picker.add_peer(peer, bitmap)
+    elapsed = time.perf_counter() - start
+    print(f'  add_peer:   {elapsed / peers * 1e3:10.3f} ms/peer')
+
+    haves = [(rng.randrange(peers), rng.randrange(pieces)) for _ in range(100000)]
+    start = time.perf_counter()
+    for peer, index in haves:
+        picker.peer_has(peer, index)
+    elapsed = time.perf_counter() - start
+    print(f'  peer_has:   {elapsed / len(haves) * 1e6:10.3f} us/have')
+
+    picks = 10000
+    order = [rng.randrange(peers) for _ in range(picks)]
+    start = time.perf_counter()
+    picked = [picker.pick(peer, swarm[peer]) for peer in order]
+    elapsed = time.perf_counter() - start
+    print(f'  pick:       {elapsed / picks * 1e6:10.3f} us/pick '
+          f'({sum(index is not None for index in picked)} picked)')
+
+    sample = 1000
+    partial = next(swarm[peer] for peer in swarm if peer not in picker.seeds)
+    start = time.perf_counter()
+    naive_rarest(swarm, partial, range(sample))
+    elapsed = (time.perf_counter() - start) * pieces / sample
+    print(f'  naive pick: {elapsed * 1e6:10.0f} us/pick (extrapolated from {sample} pieces)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""
+Measures the rate achieved through a global -> torrent -> peer hierarchy
+of `TokenBucket`s and the CPU it costs, with peers streaming 64 KiB
+chunks over loopback TCP connections as `PeerConnection` does.
+
+Each run is compared to the same transfer without limits. The global
+limit defaults to 1 Gbit/s. Fairness is the smallest share of a peer
+divided by the largest.
+
+Usage:
+    PYTHONPATH=. python benchmarks/bench_ratelimit.py [peers] [Mbit/s] [seconds]
+"""
+import asyncio
+import sys
+import time
+from pieces.protocol import PeerStreamIterator
+from pieces.ratelimit import TokenBucket, limiter
+
+CHUNK = PeerStreamIterator.CHUNK_SIZE
+
+
+async def transfer(peers: int, rate, duration: float):
+    received = [0] * peers
+    chunk = bytes(CHUNK)
+
+    async def sink(reader, writer):
+        index = int((await reader.readexactly(4)).decode())
+        while True:
+            data = await reader.read(CHUNK)
+            if not data:
+                break
+            received[index] += len(data)
+        writer.close()
+
+    server = await asyncio.start_server(sink, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    global_limit = limiter(rate)
+    # Two torrents sharing the global limit
+    torrents = [TokenBucket(parent=global_limit) for _ in range(2)]
+
+    async def source(index):
+        limit = TokenBucket(parent=torrents[index % 2])
+        _, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(f'{index:04d}'.encode())
+        try:
+            while True:
+                await limit.acquire(CHUNK)
+                writer.write(chunk)
+                await writer.drain()
+        finally:
+            writer.close()
+
+    tasks = [asyncio.ensure_future(source(index)) for index in range(peers)]
+    # Let the connections settle before measuring
+    await asyncio.sleep(0.2)
+    before = list(received)
+    start = time.perf_counter()
+    cpu = time.process_time()
+    await asyncio.sleep(duration)
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu
+    shares = [after - first for after, first in zip(received, before)]
+    total = sum(shares)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    # Let the sinks see the connections close
+    await asyncio.sleep(0.1)
+    server.close()
+    await server.wait_closed()
+    return total / elapsed, cpu / elapsed, min(shares) / max(shares)
+
+
+def main():
+    peers = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    mbits = float(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    duration = float(sys.argv[3]) if len(sys.argv) > 3 else 3
+    rate = mbits * 1e6 / 8
+    print(f'{peers} loopback peers, limit {mbits:,.0f} Mbit/s, {duration:.0f}s per run')
+    for name, limit in (('unlimited', None), ('limited', rate)):
+        achieved, cpu, fairness = asyncio.run(transfer(peers, limit, duration))
+        target = f'{achieved / rate:6.1%} of limit' if limit else ''
+        print(f'{name:>9}: {achieved * 8 / 1e6:8,.0f} Mbit/s {cpu:6.1%} CPU '
+              f'{cpu / (achieved / 2**20) * 1e6:6,.0f} CPU us/MiB '
+              f'fairness {fairness:4.2f} {target}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+Benchmarks rechecking data on disk with the parallel mmap `Rechecker`
+against reading and hashing one piece at a time.
+
+Usage:
+    PYTHONPATH=. python benchmarks/bench_recheck.py [megabytes] [piece KiB]
+"""
+import asyncio
+import hashlib
+import os
+import sys
+import tempfile
+import time
+from pieces.recheck import Rechecker
+from pieces.storage import Storage
+from pieces.torrent import Torrent
+from pieces.verify import PieceVerifier
+
+
+def make_torrent(directory, size, piece_length):
+    data = os.urandom(piece_length) * (size // piece_length)
+    hashes = b''.join(hashlib.sha1(data[i:i + piece_length]).digest()
+                      for i in range(0, len(data), piece_length))
+    # Four files, so pieces span file boundaries
+    quarter = len(data) // 4 + 123
+    lengths = [quarter, quarter, quarter, len(data) - 3 * quarter]
+    info = {b'name': b'bench', b'piece length': piece_length, b'pieces': hashes,
+            b'files': [{b'length': length, b'path': [b'file%d' % i]}
+                       for i, length in enumerate(lengths)]}
+    torrent = Torrent({b'announce': b'http://localhost/announce', b'info': info}, directory)
+    storage = Storage(torrent)
+    storage.write(0, data)
+    return torrent, storage
+
+
+def sequential(torrent, storage):
+    verified = 0
+    for index in range(len(torrent.pieces) // 20):
+        data = storage.read_piece(index)
+        if hashlib.sha1(data).digest() == torrent.pieces[index * 20:(index + 1) * 20]:
+            verified += 1
+    return verified
+
+
+def parallel(torrent, storage):
+    verifier = PieceVerifier()
+    try:
+        rechecker = Rechecker(storage, torrent.pieces, verifier)
+        return len(asyncio.run(rechecker.run(range(len(torrent.pieces) // 20))))
+    finally:
+        verifier.close()
+
+
+def main():
+    size = (int(sys.argv[1]) if len(sys.argv) > 1 else 512) * 2**20
+    piece_length = (int(sys.argv[2]) if len(sys.argv) > 2 else 256) * 2**10
+    with tempfile.TemporaryDirectory() as directory:
+        torrent, storage = make_torrent(directory, size, piece_length)
+        print(f'{size // 2**20} MiB, {piece_length // 2**10} KiB pieces, '
+              f'{os.cpu_count()} cores (page cache warm)')
+        for name, fn in (('sequential read + sha1', sequential),
+                         ('parallel mmap Rechecker', parallel)):
+            start = time.perf_counter()
+            verified = fn(torrent, storage)
+            elapsed = time.perf_counter() - start
+            print(f'  {name:<28} {elapsed:8.3f} s  {size / 2**20 / elapsed:8.1f} MiB/s '
+                  f'({verified} pieces)')
+        storage.close()
+
+
+if __name__ == '__main__':
+    main()
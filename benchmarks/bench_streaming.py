@@ -0,0 +1,100 @@
+"""
+Measures the startup latency of playing a file while it downloads: the
+time until the first `FIRST_FRAME` bytes of the file can be read, with
+the pieces picked rarest-first and with a `FileStream` giving the pieces
+at the playhead deadlines.
+
+Peers are simulated: each one sends the blocks requested from it one
+after the other at its rate, 2 fast peers and a number of slow ones each
+having a random 80% of the pieces.
+
+Usage:
+    PYTHONPATH=. python benchmarks/bench_streaming.py [slow peers] [MiB]
+"""
+import asyncio
+import hashlib
+import os
+import random
+import sys
+import tempfile
+import time
+from pieces.bitset import Bitset
+from pieces.client import PieceManager
+from pieces.streaming import FileStream
+from pieces.torrent import Torrent
+
+PIECE_LENGTH = 2**18
+FIRST_FRAME = 2**21
+PIPELINE = 8  # Requests outstanding per peer
+FAST_RATE = 8 * 2**20
+SLOW_RATE = 2**18
+
+
+def make_torrent(data: bytes, output_path: str):
+    hashes = b''.join(hashlib.sha1(data[i:i + PIECE_LENGTH]).digest()
+                      for i in range(0, len(data), PIECE_LENGTH))
+    info = {b'name': b'movie.mkv', b'piece length': PIECE_LENGTH, b'pieces': hashes,
+            b'length': len(data)}
+    return Torrent({b'announce': b'http://localhost/announce', b'info': info}, output_path)
+
+
+async def serve(manager, peer_id, rate, data):
+    queue = []
+    while True:
+        while len(queue) < PIPELINE:
+            block = manager.next_request(peer_id)
+            if not block:
+                break
+            queue.append(block)
+        if not queue:
+            await asyncio.sleep(0.01)
+            continue
+        block = queue.pop(0)
+        await asyncio.sleep(block.length / rate)
+        start = block.piece * PIECE_LENGTH + block.offset
+        manager.block_received(peer_id, block.piece, block.offset,
+                               data[start:start + block.length])
+
+
+async def first_frame(data: bytes, slow_peers: int, streaming: bool) -> float:
+    with tempfile.TemporaryDirectory() as directory:
+        manager = PieceManager(make_torrent(data, directory))
+        rng = random.Random(1)
+        peers = []
+        for index in range(2 + slow_peers):
+            has = Bitset(manager.total_pieces)
+            for piece in rng.sample(range(manager.total_pieces), manager.total_pieces * 4 // 5):
+                has.add(piece)
+            manager.add_peer(index, has)
+            peers.append((index, FAST_RATE if index < 2 else SLOW_RATE))
+        start = time.perf_counter()
+        tasks = [asyncio.ensure_future(serve(manager, peer_id, rate, data))
+                 for peer_id, rate in peers]
+        if streaming:
+            async with FileStream(manager, 0) as stream:
+                await stream.read(FIRST_FRAME)
+        else:
+            for index in range(FIRST_FRAME // PIECE_LENGTH):
+                await manager.wait_for(index)
+        elapsed = time.perf_counter() - start
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, *manager._writes, return_exceptions=True)
+        manager.close()
+    return elapsed
+
+
+def main():
+    slow_peers = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    size = (int(sys.argv[2]) if len(sys.argv) > 2 else 32) * 2**20
+    data = os.urandom(size)
+    rate = (2 * FAST_RATE + slow_peers * SLOW_RATE) / 2**20
+    print(f'{size // 2**20} MiB, 2 fast and {slow_peers} slow peers ({rate:.1f} MiB/s), '
+          f'first frame {FIRST_FRAME // 2**10} KiB')
+    for name, streaming in (('rarest', False), ('streaming', True)):
+        elapsed = asyncio.run(first_frame(data, slow_peers, streaming))
+        print(f'{name:>9}: first frame after {elapsed * 1000:8,.0f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+Compares two ways of building outgoing `Piece` messages off the event
+loop:
+
+- per block: read each block on the disk thread pool (`read_async`), then
+  encode it (`Piece.encode`)
+- batched: read `UPLOAD_BATCH` blocks at a time straight into
+  preallocated messages (`Piece.allocate`, `readinto_async`), as the
+  upload path does
+
+The file is read from the page cache, so the numbers are the CPU cost of
+the Python side of serving requests.
+
+Usage:
+    PYTHONPATH=. python benchmarks/bench_upload.py [MiB]
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from pieces.protocol import Piece, REQUEST_SIZE, UPLOAD_BATCH
+from pieces.storage import Storage
+
+
+class FakeTorrent:
+    def __init__(self, path, size):
+        self.output_file = path
+        self.files = []
+        self.total_size = size
+        self.piece_length = 16 * REQUEST_SIZE
+
+
+async def run_per_block(storage, requests):
+    for offset in requests:
+        block = await storage.read_async(offset, REQUEST_SIZE)
+        Piece(offset // storage.piece_length, offset % storage.piece_length, block).encode()
+
+
+async def run_batched(storage, requests):
+    for start in range(0, len(requests), UPLOAD_BATCH):
+        batch = []
+        for offset in requests[start:start + UPLOAD_BATCH]:
+            message, view = Piece.allocate(offset // storage.piece_length,
+                                           offset % storage.piece_length, REQUEST_SIZE)
+            batch.append((offset, view))
+        await storage.readinto_async(batch)
+
+
+def measure(name, fn, storage, requests):
+    start = time.perf_counter()
+    cpu = time.process_time()
+    asyncio.run(fn(storage, requests))
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu
+    size = len(requests) * REQUEST_SIZE / 2**20
+    print(f'{name:>9}: {size / elapsed:10,.0f} MiB/s {cpu / size * 1e6:8,.0f} CPU us/MiB')
+
+
+def main():
+    size = (int(sys.argv[1]) if len(sys.argv) > 1 else 256) * 2**20
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'data')
+        with open(path, 'wb') as f:
+            f.write(os.urandom(size))
+        storage = Storage(FakeTorrent(path, size))
+        requests = list(range(0, size, REQUEST_SIZE))
+        # Warm the page cache
+        asyncio.run(run_batched(storage, requests))
+        print(f'{size // 2**20} MiB in {len(requests)} blocks of {REQUEST_SIZE} bytes')
+        measure('per block', run_per_block, storage, requests)
+        measure('batched', run_batched, storage, requests)
+        storage.close()
+
+
+if __name__ == '__main__':
+    main()
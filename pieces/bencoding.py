@@ -1,80 +1,275 @@
-import struct
-from collections import OrderedDict
+from operator import itemgetter
+
+# Token bytes
+_INT = ord('i')
+_LIST = ord('l')
+_DICT = ord('d')
+_END = ord('e')
+_DIGITS = frozenset(b'0123456789')
+
+# Marks the end of a list or dictionary on the Encoder stack
+_CLOSE = object()
+_first = itemgetter(0)
+
 
 class Decoder:
-    def __init__(self, data):
-        self.data = data
+    """
+    Decodes bencoded data.
+
+    Strings are returned as `bytes`, so binary values such as `pieces` and
+    compact peer lists are kept intact. Dictionary keys can optionally be
+    decoded to `str` (see `str_keys`).
+
+    The data is parsed in a single pass with an explicit stack instead of
+    one Python call per element, so deeply nested or very large data (big
+    .torrent files, tracker and DHT responses with thousands of entries)
+    costs no recursion and no slicing beyond the values themselves.
+
+    The raw byte span of the top-level `info` dictionary is recorded while
+    parsing (see `info_span` and `raw_info`), so the info-hash can be
+    computed from the original bytes without encoding `info` again.
+    """
+    def __init__(self, data, str_keys: bool = False):
+        """
+        :param data: The bencoded bytes-like object to decode
+        :param str_keys: Decode dictionary keys to `str`. Every distinct key
+                         is decoded once, keys that are not valid UTF-8 are
+                         kept as `bytes`.
+        """
+        # memoryview has no find(), so any other buffer is copied once
+        self.data = data if isinstance(data, bytes) else bytes(data)
         self.index = 0
+        self.str_keys = str_keys
+        self.info_span = None
+        self._keys = {}
+
+    @property
+    def raw_info(self):
+        """
+        The bencoded `info` dictionary exactly as it appeared in the data,
+        or None if there is none.
+        """
+        if self.info_span is None:
+            return None
+        start, end = self.info_span
+        return self.data[start:end]
 
     def decode(self):
+        """
+        Decodes the data, which must contain exactly one bencoded value.
+        """
         try:
-            return self.parse()
-        except Exception as e:
+            value = self._parse()
+        except (IndexError, ValueError) as e:
             raise ValueError(f"Decoding failed: {e}")
-
-    def parse(self):
-        if self.data[self.index] == ord('i'):
-            return self.parse_int()
-        elif self.data[self.index] == ord('l'):
-            return self.parse_list()
-        elif self.data[self.index] == ord('d'):
-            return self.parse_dict()
-        else:
-            return self.parse_str()
-
-    def parse_int(self):
-        self.index += 1
-        end = self.data.find(b'e', self.index)
-        if end == -1:
-            raise ValueError("Invalid integer encoding")
-        value = int(self.data[self.index:end])
-        self.index = end + 1
+        if self.index != len(self.data):
+            raise ValueError(f"Decoding failed: trailing data at index {self.index}")
         return value
 
-    def parse_str(self):
-        colon = self.data.find(b':', self.index)
-        if colon == -1:
-            raise ValueError("Invalid string encoding")
-        length = int(self.data[self.index:colon])
-        self.index = colon + 1
-        value = self.data[self.index:self.index + length]
-        self.index += length
-        return value.decode('utf-8')  # Assuming you want strings instead of bytes
-
-    def parse_list(self):
-        self.index += 1
-        result = []
-        while self.data[self.index] != ord('e'):
-            result.append(self.parse())
-        self.index += 1
-        return result
-
-    def parse_dict(self):
-        self.index += 1
-        result = OrderedDict()
-        while self.data[self.index] != ord('e'):
-            key = self.parse_str()
-            value = self.parse()
-            result[key] = value
-        self.index += 1
-        return result
+    def _key(self, key: bytes):
+        decoded = self._keys.get(key)
+        if decoded is None:
+            try:
+                decoded = key.decode('utf-8')
+            except UnicodeDecodeError:
+                decoded = key
+            self._keys[key] = decoded
+        return decoded
+
+    def _parse(self):
+        data = self.data
+        size = len(data)
+        find = data.index
+        index = self.index
+        key_decoder = self._key if self.str_keys else None
+        digits = _DIGITS
+        # Containers being filled, with their start offset and the key
+        # waiting for its value (dicts only). `append` is only set for lists.
+        stack = []
+        container = append = key = None
+        while True:
+            token = data[index]
+            if token in digits:
+                colon = find(b':', index)
+                raw = data[index:colon]
+                if not raw.isdigit() or (token == 0x30 and colon - index > 1):
+                    raise ValueError("Invalid string length")
+                index = colon + 1 + int(raw)
+                if index > size:
+                    raise ValueError("String exceeds data")
+                value = data[colon + 1:index]
+                if append is None and key is None and container is not None:
+                    # A dictionary key
+                    key = key_decoder(value) if key_decoder else value
+                    continue
+            elif token == _INT:
+                end = find(b'e', index)
+                raw = data[index + 1:end]
+                value = int(raw)
+                # Rejects leading zeros, -0 and anything else int() forgives
+                if b'%d' % value != raw:
+                    raise ValueError("Invalid integer")
+                index = end + 1
+            elif token == _LIST or token == _DICT:
+                stack.append((container, append, key, index))
+                if token == _LIST:
+                    container = []
+                    append = container.append
+                else:
+                    container = {}
+                    append = None
+                key = None
+                index += 1
+                continue
+            elif token == _END and container is not None:
+                if key is not None:
+                    raise ValueError("Missing dictionary value")
+                index += 1
+                value = container
+                container, append, key, start = stack.pop()
+                if len(stack) == 1 and (key == b'info' or key == 'info'):
+                    self.info_span = (start, index)
+            else:
+                raise ValueError(f"Unexpected token {chr(token)!r}")
+
+            if append is not None:
+                append(value)
+            elif key is not None:
+                container[key] = value
+                key = None
+            elif container is None:
+                self.index = index
+                return value
+            else:
+                raise ValueError("Dictionary key is not a string")
 
 class Encoder:
+    """
+    Encodes Python values to bencoding: `int` (and `bool`), `bytes`-like
+    objects, `str` (as UTF-8), `list`/`tuple` and `dict`.
+
+    Dictionary keys are written in sorted raw byte order, so the output is
+    canonical whatever order the dict was built in.
+
+    The value is walked with an explicit stack instead of one `Encoder` per
+    element, writing into a single growable `bytearray`: `encode` returns
+    the bytes, `encode_into` appends to a caller's buffer so it can be
+    reused across messages, and `stream` hands the output to a writer in
+    chunks so large values are never held in memory twice.
+    """
+    CHUNK_SIZE = 2**16
+
     def __init__(self, data):
         self.data = data
 
-    def encode(self):
-        if isinstance(self.data, int):
-            return b'i%de' % self.data
-        elif isinstance(self.data, bytes):
-            return b'%d:%s' % (len(self.data), self.data)
-        elif isinstance(self.data, str):  # Handle string encoding
-            return b'%d:%s' % (len(self.data), self.data.encode('utf-8'))
-        elif isinstance(self.data, list):
-            return b'l' + b''.join(Encoder(item).encode() for item in self.data) + b'e'
-        elif isinstance(self.data, OrderedDict):
-            encoded_items = b''.join(Encoder(k if isinstance(k, bytes) else k.encode('utf-8')).encode() + Encoder(v).encode() for k, v in self.data.items())
-            return b'd' + encoded_items + b'e'
-        else:
-            raise TypeError(f"Unsupported data type for encoding: {type(self.data)}")
+    def encode(self) -> bytes:
+        buffer = bytearray()
+        self._encode(buffer)
+        return bytes(buffer)
+
+    def encode_into(self, buffer: bytearray) -> bytearray:
+        """
+        Appends the encoded data to the given buffer.
+        """
+        self._encode(buffer)
+        return buffer
+
+    def stream(self, write, chunk_size: int = CHUNK_SIZE):
+        """
+        Encodes the data in chunks of about `chunk_size` bytes passed to
+        `write`. String values of at least `chunk_size` bytes are passed to
+        `write` as is rather than copied.
+        """
+        buffer = bytearray()
+        self._encode(buffer, write, chunk_size)
+        if buffer:
+            write(bytes(buffer))
+
+    def _encode(self, buffer: bytearray, write=None, chunk_size: int = CHUNK_SIZE):
+        # The stack holds values still to be written, in reverse order, with
+        # _CLOSE marking where a list or dictionary closes
+        stack = [self.data]
+        pop = stack.pop
+        push = stack.append
+        while stack:
+            item = pop()
+            kind = type(item)
+            if kind is bytes:
+                buffer += b'%d:' % len(item)
+                if write is not None and len(item) >= chunk_size:
+                    write(bytes(buffer))
+                    buffer.clear()
+                    write(item)
+                    continue
+                buffer += item
+            elif kind is int:
+                buffer += b'i%de' % item
+            elif kind is str:
+                item = item.encode('utf-8')
+                buffer += b'%d:' % len(item)
+                buffer += item
+            elif kind is list or kind is tuple:
+                buffer += b'l'
+                push(_CLOSE)
+                stack.extend(reversed(item))
+            elif item is _CLOSE:
+                buffer += b'e'
+            elif isinstance(item, dict):
+                buffer += b'd'
+                push(_CLOSE)
+                # All bytes or all str keys sort as is (UTF-8 keeps code
+                # point order), anything else takes the slow path
+                mark = len(stack)
+                try:
+                    keys = sorted(item, reverse=True)
+                except TypeError:
+                    keys = ()
+                    mark = None
+                for key in keys:
+                    if type(key) is not bytes and type(key) is not str:
+                        del stack[mark:]
+                        mark = None
+                        break
+                    push(item[key])
+                    push(key)
+                if mark is None:
+                    for key, value in self._sorted_items(item):
+                        push(value)
+                        push(key)
+            elif isinstance(item, (bytes, bytearray, memoryview)):
+                push(bytes(item))
+            elif isinstance(item, int):
+                # bool and other int subclasses
+                buffer += b'i%de' % int(item)
+            elif isinstance(item, str):
+                push(str(item))
+            elif isinstance(item, (list, tuple)):
+                push(list(item))
+            else:
+                raise TypeError(f"Unsupported data type for encoding: {type(item)}")
+            if write is not None and len(buffer) >= chunk_size:
+                write(bytes(buffer))
+                buffer.clear()
 
+    @staticmethod
+    def _sorted_items(data: dict):
+        """
+        The items of a dictionary with mixed key types, with the keys as
+        bytes and sorted from last to first (the order they are pushed on the
+        stack).
+        """
+        items = []
+        for key, value in data.items():
+            if type(key) is not bytes:
+                if isinstance(key, str):
+                    key = key.encode('utf-8')
+                elif isinstance(key, (bytes, bytearray, memoryview)):
+                    key = bytes(key)
+                else:
+                    raise TypeError(f"Unsupported dictionary key type: {type(key)}")
+            items.append((key, value))
+        items.sort(key=_first, reverse=True)
+        for (key, _), (previous, _) in zip(items, items[1:]):
+            if key == previous:
+                raise ValueError(f"Duplicate dictionary key: {key!r}")
+        return items
@@ -0,0 +1,147 @@
+# The bit positions set in every byte value, most significant bit first
+_BITS = [tuple(bit for bit in range(8) if value & (0x80 >> bit)) for value in range(256)]
+
+
+def set_bits(bitmap: bytes, limit: int):
+    """
+    Yields the index of every bit set in the given bitmap below `limit`.
+    """
+    for position, value in enumerate(bitmap):
+        if value:
+            base = position * 8
+            for bit in _BITS[value]:
+                if base + bit < limit:
+                    yield base + bit
+
+
+class Bitset:
+    """
+    A fixed-size set of piece indices, laid out like a wire protocol
+    bitfield: piece 0 is the most significant bit of the first byte.
+
+    Single pieces are tested and set on a `bytearray`. Whole-set operations
+    (AND, ANDNOT, popcount) run on a Python int made from those bytes, so
+    they cost a handful of C-level passes over the set instead of a Python
+    loop per piece. The int is cached, and a single piece changing flips
+    its bit in the cached int rather than converting the whole set again.
+    """
+    __slots__ = ('length', '_bytes', '_int')
+
+    def __init__(self, length: int, data=None):
+        self.length = length
+        size = (length + 7) // 8
+        if data is None:
+            self._bytes = bytearray(size)
+        else:
+            self._bytes = bytearray(data[:size])
+            if len(self._bytes) < size:
+                self._bytes.extend(bytes(size - len(self._bytes)))
+            if length % 8 and size:
+                # Spare bits at the end of a bitfield must be cleared
+                self._bytes[-1] &= (0xFF << (8 - length % 8)) & 0xFF
+        self._int = None
+
+    @classmethod
+    def from_bytes(cls, length: int, data):
+        return cls(length, data)
+
+    @classmethod
+    def from_int(cls, length: int, value: int):
+        return cls(length, value.to_bytes((length + 7) // 8, 'big'))
+
+    @classmethod
+    def full(cls, length: int):
+        return cls(length, b'\xff' * ((length + 7) // 8))
+
+    @property
+    def value(self) -> int:
+        if self._int is None:
+            self._int = int.from_bytes(self._bytes, 'big')
+        return self._int
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index: int) -> bool:
+        return bool(self._bytes[index >> 3] & (0x80 >> (index & 7)))
+
+    def __setitem__(self, index: int, value):
+        if not 0 <= index < self.length:
+            raise IndexError(f'Bit index out of range: {index}')
+        mask = 0x80 >> (index & 7)
+        if bool(self._bytes[index >> 3] & mask) == bool(value):
+            return
+        self._bytes[index >> 3] ^= mask
+        if self._int is not None:
+            self._int ^= 1 << (len(self._bytes) * 8 - 1 - index)
+
+    def __iter__(self):
+        return set_bits(self._bytes, self.length)
+
+    def __eq__(self, other):
+        if not isinstance(other, Bitset):
+            return NotImplemented
+        return self.length == other.length and self._bytes == other._bytes
+
+    def __and__(self, other):
+        return Bitset.from_int(self.length, self.value & other.value)
+
+    def __or__(self, other):
+        return Bitset.from_int(self.length, self.value | other.value)
+
+    def __sub__(self, other):
+        return Bitset.from_int(self.length, self.value & ~other.value)
+
+    def __repr__(self):
+        return f'Bitset({self.length}, {self.count()} set)'
+
+    def add(self, index: int):
+        self[index] = 1
+
+    def discard(self, index: int):
+        self[index] = 0
+
+    def count(self) -> int:
+        """
+        The number of pieces in the set (popcount).
+        """
+        return self.value.bit_count()
+
+    def all(self) -> bool:
+        return self.count() == self.length
+
+    def any(self) -> bool:
+        return self._bytes.count(0) != len(self._bytes)
+
+    def intersects(self, other) -> bool:
+        return bool(self.value & other.value)
+
+    def intersection_count(self, other) -> int:
+        return (self.value & other.value).bit_count()
+
+    def difference_count(self, other) -> int:
+        """
+        The number of pieces in this set that are not in `other` (ANDNOT).
+        """
+        return (self.value & ~other.value).bit_count()
+
+    def first(self):
+        """
+        The lowest piece index in the set, or None if the set is empty.
+        """
+        value = self.value
+        if not value:
+            return None
+        return len(self._bytes) * 8 - value.bit_length()
+
+    def first_common(self, other):
+        """
+        The lowest piece index in both sets, or None if they are disjoint.
+        """
+        value = self.value & other.value
+        if not value:
+            return None
+        return len(self._bytes) * 8 - value.bit_length()
+
+    def tobytes(self) -> bytes:
+        return bytes(self._bytes)
@@ -0,0 +1,138 @@
+import logging
+from collections import OrderedDict
+
+CACHE_SIZE = 256 * 2**20  # Default byte budget shared by all piece buffers
+MAX_GHOSTS = 4096  # Recently missed pieces remembered
+MAX_POOLED = 8  # Free buffers of each size kept around for reuse
+
+
+class PieceCache:
+    """
+    A byte-budgeted cache of whole-piece `bytearray` buffers, used both as
+    the write-back buffer of pieces being downloaded and as a read cache of
+    verified pieces for serving uploads. One cache can be shared by several
+    torrents to enforce a global budget; pieces are keyed by any hashable,
+    e.g. (info hash, piece index).
+
+    Write buffers are allocated for a piece when it is started, blocks are
+    copied into them at their offset as they arrive, and the piece is
+    verified and written out as a single contiguous buffer. Once written,
+    the buffer becomes a read cache entry instead of being dropped, since
+    a piece we just announced is the one other peers are about to request.
+
+    Read entries are kept in LRU order. A piece missing from the cache is
+    only read from disk as a whole if it already missed recently (as in
+    ARC's ghost lists), so pieces requested once don't evict popular ones.
+
+    Write buffers, read entries and pooled free buffers all count against
+    `budget`. Under memory pressure free buffers are dropped first, then
+    the least recently used read entries. Write buffers are never evicted;
+    `allocate` refuses a new one when the others fill the budget, which
+    holds back starting new pieces until some are written out.
+    """
+    def __init__(self, budget: int = CACHE_SIZE):
+        self.budget = budget
+        self.entries = OrderedDict()  # key -> verified piece data, LRU first
+        self.ghosts = OrderedDict()  # Keys of recently missed pieces
+        self.pool = {}  # size -> free buffers of that size
+        self.read_bytes = 0
+        self.write_bytes = 0
+        self.pool_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def used(self) -> int:
+        return self.read_bytes + self.write_bytes + self.pool_bytes
+
+    def can_allocate(self, size: int) -> bool:
+        """
+        Whether a write buffer of the given size fits next to the others.
+        There is always room for one.
+        """
+        return not self.write_bytes or self.write_bytes + size <= self.budget
+
+    def allocate(self, size: int):
+        """
+        Allocates a write buffer of the given size, evicting read entries to
+        make room if needed.
+
+        :return The buffer, or None if write buffers fill the budget
+        """
+        if not self.can_allocate(size):
+            return None
+        self.write_bytes += size
+        free = self.pool.get(size)
+        if free:
+            self.pool_bytes -= size
+            buffer = free.pop()
+        else:
+            buffer = bytearray(size)
+        self._shrink()
+        return buffer
+
+    def free(self, buffer):
+        """
+        Gives back a write buffer whose piece was abandoned or failed
+        verification.
+        """
+        size = len(buffer)
+        self.write_bytes -= size
+        free = self.pool.setdefault(size, [])
+        if len(free) < MAX_POOLED:
+            free.append(buffer)
+            self.pool_bytes += size
+            self._shrink()
+
+    def insert(self, key, buffer):
+        """
+        Turns a write buffer holding verified piece data into a read entry.
+        """
+        self.write_bytes -= len(buffer)
+        self.invalidate(key)
+        self.entries[key] = buffer
+        self.read_bytes += len(buffer)
+        self.ghosts.pop(key, None)
+        self._shrink()
+
+    def get(self, key):
+        """
+        The cached data of the given piece, or None.
+        """
+        buffer = self.entries.get(key)
+        if buffer is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return buffer
+
+    def should_cache(self, key) -> bool:
+        """
+        Records a miss of the given piece.
+
+        :return True if the piece missed recently already and is worth
+                reading into the cache as a whole
+        """
+        if key in self.ghosts:
+            del self.ghosts[key]
+            return True
+        self.ghosts[key] = None
+        if len(self.ghosts) > MAX_GHOSTS:
+            self.ghosts.popitem(last=False)
+        return False
+
+    def invalidate(self, key):
+        buffer = self.entries.pop(key, None)
+        if buffer is not None:
+            self.read_bytes -= len(buffer)
+
+    def _shrink(self):
+        while self.used > self.budget and self.pool_bytes:
+            size, free = next((size, free) for size, free in self.pool.items() if free)
+            free.pop()
+            self.pool_bytes -= size
+        while self.used > self.budget and self.entries:
+            _, buffer = self.entries.popitem(last=False)
+            self.read_bytes -= len(buffer)
+            logging.debug(f'Evicted {len(buffer)} bytes from the piece cache')
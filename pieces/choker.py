@@ -0,0 +1,97 @@
+import asyncio
+import logging
+import random
+import time
+
+UPLOAD_SLOTS = 4  # Peers unchoked for their rate, next to the optimistic unchoke
+CHOKE_INTERVAL = 10  # Seconds between rechoking rounds
+OPTIMISTIC_INTERVAL = 30  # Seconds between rotations of the optimistic unchoke
+
+
+class Choker:
+    """
+    Decides which peers are allowed to download from us (tit-for-tat).
+
+    Every `interval` the interested peers are ranked by the rate they sent
+    us data at since the previous round, or once we are seeding by the rate
+    we sent them data at, and the best `slots` peers are unchoked. One more
+    interested peer is unchoked optimistically, rotating every
+    `optimistic_interval`, so new peers get a chance to prove themselves
+    and we find peers better than the current ones.
+
+    `connections` is a callable returning the connected peers, which need
+    `peer_state`, `downloaded`, `uploaded`, `choke()` and `unchoke()` like
+    `PeerConnection`. `seeding` is a callable returning True once there is
+    nothing left to download.
+    """
+    def __init__(self, connections, seeding, slots: int = UPLOAD_SLOTS,
+                 interval: float = CHOKE_INTERVAL,
+                 optimistic_interval: float = OPTIMISTIC_INTERVAL):
+        self.connections = connections
+        self.seeding = seeding
+        self.slots = slots
+        self.interval = interval
+        self.optimistic_interval = optimistic_interval
+        self.optimistic = None
+        self._optimistic_since = None
+        self._snapshots = {}  # connection -> bytes transferred at the previous round
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            self.rechoke()
+            await asyncio.sleep(self.interval)
+
+    def rechoke(self, now: float = None):
+        """
+        Runs a choking round, unchoking the peers with the best rates plus
+        the optimistic unchoke and choking everyone else.
+
+        :return The set of unchoked connections
+        """
+        now = time.monotonic() if now is None else now
+        connections = list(self.connections())
+        seeding = self.seeding()
+        rates = {}
+        snapshots = {}
+        for connection in connections:
+            transferred = connection.uploaded if seeding else connection.downloaded
+            rates[connection] = transferred - self._snapshots.get(connection, 0)
+            snapshots[connection] = transferred
+        self._snapshots = snapshots
+
+        interested = [c for c in connections if 'interested' in c.peer_state]
+        ranked = sorted(interested, key=rates.__getitem__, reverse=True)
+        unchoked = set(ranked[:self.slots])
+
+        if self.optimistic not in interested or self.optimistic in unchoked or \
+                now - self._optimistic_since >= self.optimistic_interval:
+            self._rotate_optimistic([c for c in interested if c not in unchoked], now)
+        if self.optimistic is not None:
+            unchoked.add(self.optimistic)
+
+        for connection in connections:
+            if connection in unchoked:
+                connection.unchoke()
+            else:
+                connection.choke()
+        return unchoked
+
+    def _rotate_optimistic(self, candidates, now: float):
+        # Prefer peers that are choked, the optimistic unchoke is their
+        # only way of getting unchoked
+        choked = [c for c in candidates if 'choked' in c.peer_state and c is not self.optimistic]
+        pool = choked or candidates
+        self.optimistic = random.choice(pool) if pool else None
+        self._optimistic_since = now
+        if self.optimistic is not None:
+            logging.debug(f'Optimistically unchoking peer {self.optimistic.remote_id}')
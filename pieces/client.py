@@ -1,219 +1,1080 @@
-import asyncio
-import logging
-import time
-import os
-import math
-from hashlib import sha1
-from asyncio import Queue
-from collections import namedtuple
-from pieces.protocol import PeerConnection, REQUEST_SIZE
-from pieces.tracker import Tracker
-from typing import List
-
-MAX_PEER_CONNECTIONS = 40
-
-class TorrentClient:
-    def __init__(self, torrent):
-        self.is_running = False 
-        self.tracker = Tracker(torrent)
-        self.available_peers = Queue()
-        self.peers = []
-        self.piece_manager = PieceManager(torrent)
-        self.abort = False
-
-    async def start(self):
-        # Initialize peers using host and port
-        while len(self.peers) < MAX_PEER_CONNECTIONS and not self.available_peers.empty():
-            host, port = await self.available_peers.get()
-            self.peers.append(PeerConnection(host, port))
-
-        previous = None
-        interval = 30 * 60
-
-        while True:
-            if self.piece_manager.complete:
-                logging.info('Torrent fully downloaded!')
-                break
-            if self.abort:
-                logging.info('Aborting download...')
-                break
-
-            current = time.time()
-            if (not previous) or (previous + interval < current):
-                response = await self.tracker.connect(
-                    uploaded=self.piece_manager.bytes_uploaded,
-                    downloaded=self.piece_manager.bytes_downloaded)
-
-                if response:
-                    previous = current
-                    interval = response['interval']
-                    self._empty_queue()
-                    for peer in response['peers']:
-                        self.available_peers.put_nowait((peer['host'], peer['port']))  # Assuming peers are dicts with 'host' and 'port'
-            else:
-                await asyncio.sleep(5)
-        self.stop()
-
-    def _empty_queue(self):
-        while not self.available_peers.empty():
-            self.available_peers.get_nowait()
-
-    def stop(self):
-        self.abort = True
-        for peer in self.peers:
-            peer.stop()  # Ensure you have a stop method in PeerConnection
-        self.piece_manager.close()
-        self.tracker.close()
-
-    def _on_block_retrieved(self, peer_id, piece_index, block_offset, data):
-        self.piece_manager.block_received(
-            peer_id=peer_id, piece_index=piece_index,
-            block_offset=block_offset, data=data)
-
-
-class Block:
-    Missing = 0
-    Pending = 1
-    Retrieved = 2
-
-    def __init__(self, piece: int, offset: int, length: int):
-        self.piece = piece
-        self.offset = offset
-        self.length = length
-        self.status = Block.Missing
-        self.data = None
-
-
-class Piece:
-    def __init__(self, index: int, blocks=None, hash_value=None):
-        if blocks is None:
-            blocks = []
-        self.index = index
-        self.blocks = blocks
-        self.hash = hash_value
-
-    def reset(self):
-        for block in self.blocks:
-            block.status = Block.Missing
-
-    def next_request(self) -> Block:
-        missing = [b for b in self.blocks if b.status is Block.Missing]
-        if missing:
-            missing[0].status = Block.Pending
-            return missing[0]
-        return None
-
-    def block_received(self, offset: int, data: bytes):
-        matches = [b for b in self.blocks if b.offset == offset]
-        block = matches[0] if matches else None
-        if block:
-            block.status = Block.Retrieved
-            block.data = data
-        else:
-            logging.warning(f'Trying to complete a non-existing block {offset}')
-
-    def is_complete(self) -> bool:
-        blocks = [b for b in self.blocks if b.status is not Block.Retrieved]
-        return len(blocks) == 0
-
-    @property
-    def data(self):
-        retrieved = sorted(self.blocks, key=lambda b: b.offset)
-        blocks_data = [b.data for b in retrieved]
-        return b''.join(blocks_data)
-
-
-PendingRequest = namedtuple('PendingRequest', ['block', 'added'])
-
-class PieceManager:
-    def __init__(self, torrent):
-        self.torrent = torrent
-        self.peers = {}
-        self.pending_blocks = []
-        self.missing_pieces = []
-        self.ongoing_pieces = []
-        self.have_pieces = []
-        self.max_pending_time = 300 * 1000  # 5 minutes
-        self.missing_pieces = self._initiate_pieces()
-        self.total_pieces = len(torrent.pieces)
-        # In PieceManager __init__ method
-        self.fd = open(os.path.join(os.path.dirname(self.torrent.output_file), 'output_file.bin'), 'ab')
-
-
-        # In the PieceManager class
-        if not hasattr(self.torrent, 'output_file') or not self.torrent.output_file:
-         self.torrent.output_file = 'E:\\BitWave\\output_file.bin'  # Simplified default name
-
-
-        try:
-           self.fd = open(os.path.join(os.path.dirname(self.torrent.output_file), 'output_file.bin'), 'ab')
-        except PermissionError as e:
-            logging.error(f"Permission denied when trying to open the output file: {self.torrent.output_file}. Error: {e}")
-            raise
-        except Exception as e:
-            logging.error(f"An error occurred while trying to open the output file: {self.torrent.output_file}. Error: {e}")
-            raise
-
-    def _initiate_pieces(self) -> List[Piece]:
-        torrent = self.torrent
-        pieces = []
-        total_pieces = len(torrent.pieces)
-        std_piece_blocks = math.ceil(torrent.piece_length / REQUEST_SIZE)
-
-        for index, hash_value in enumerate(torrent.pieces):
-            if index < (total_pieces - 1):
-                blocks = [Block(index, offset * REQUEST_SIZE, REQUEST_SIZE)
-                          for offset in range(std_piece_blocks)]
-            else:
-                last_length = torrent.total_size % torrent.piece_length
-                num_blocks = math.ceil(last_length / REQUEST_SIZE)
-                blocks = [Block(index, offset * REQUEST_SIZE, REQUEST_SIZE)
-                          for offset in range(num_blocks)]
-
-                if last_length % REQUEST_SIZE > 0:
-                    last_block = blocks[-1]
-                    last_block.length = last_length % REQUEST_SIZE
-                    blocks[-1] = last_block
-            pieces.append(Piece(index, blocks, hash_value))
-        return pieces
-
-    def close(self):
-        if self.fd:
-            self.fd.close()
-
-    @property
-    def complete(self):
-        return len(self.have_pieces) == self.total_pieces
-
-    @property
-    def bytes_downloaded(self) -> int:
-        return len(self.have_pieces) * self.torrent.piece_length
-
-    @property
-    def bytes_uploaded(self) -> int:
-        return 0
-
-    def add_peer(self, peer_id, bitfield):
-        self.peers[peer_id] = bitfield
-
-    def update_peer(self, peer_id, index: int):
-        if peer_id in self.peers:
-            self.peers[peer_id][index] = 1
-
-    def remove_peer(self, peer_id):
-        if peer_id in self.peers:
-            del self.peers[peer_id]
-
-    def next_request(self, peer_id) -> Block:
-        if peer_id not in self.peers:
-            return None
-
-        block = self._expired_requests(peer_id)
-        if not block:
-            block = self._next_ongoing(peer_id)
-            if not block:
-                block = self._get_rarest_piece(peer_id).next_request()
-        return block
-
-    def block_received(self, peer_id, piece_index, block_offset, data):
-        logging.debug(f'Received block {block_offset} for piece {piece_index} from peer {peer_id}: ')
+import asyncio
+import bisect
+import logging
+import math
+import os
+import time
+from collections import Counter, namedtuple
+from pieces.bitset import Bitset
+from pieces.cache import PieceCache
+from pieces.choker import Choker
+from pieces.exceptions import DHTError, TorrentError
+from pieces.listener import Listener
+from pieces.picker import PiecePicker
+from pieces.protocol import PeerConnection, REQUEST_SIZE
+from pieces.ratelimit import TokenBucket, limiter
+from pieces.recheck import Rechecker
+from pieces.resume import ResumeFile, file_stat
+from pieces.scheduler import ConnectionScheduler
+from pieces.state import DownloadState
+from pieces.storage import Storage
+from pieces.timeouts import INITIAL_TIMEOUT, RttEstimator, TimeoutQueue
+from pieces.tracker import Tracker
+from pieces.verify import PieceVerifier
+from pieces.streaming import FileStream
+from typing import List
+
+MAX_PEER_CONNECTIONS = 40
+MAX_HALF_OPEN = 8
+MAX_HASH_FAILURES = 3
+MAX_UPLOAD_BLOCK = 2**17  # Largest block we serve, requests for more are dropped
+DHT_INTERVAL = 15 * 60
+ANNOUNCE_RETRY = 60  # Seconds before announcing again after every tracker failed
+ANNOUNCE_TIMEOUT = 2 * 60  # Seconds an announce to every tier may take in total
+MAX_FILE_PRIORITY = 7
+DEADLINE_PRIORITY = 255  # Priority of the most urgent piece with a deadline
+CRITICAL_TIME = 2.0  # Seconds around their deadline pieces are left to fast peers
+RATE_WINDOW = 5.0  # Seconds over which the download rate of peers is averaged
+FAST_PEER_RATIO = 4  # Peers this many times slower than the fastest one are slow
+RESUME_DIRECTORY = os.path.join(os.path.expanduser('~'), '.bitwave', 'resume')
+
+class TorrentClient:
+    def __init__(self, torrent, resume_dir: str = RESUME_DIRECTORY,
+                 force_recheck: bool = False, dht=None,
+                 max_connections: int = MAX_PEER_CONNECTIONS, max_half_open: int = MAX_HALF_OPEN,
+                 seed: bool = False, cache: PieceCache = None, dial_limit: asyncio.Semaphore = None,
+                 port: int = None, disk_executor=None, hash_executor=None, files=None,
+                 upload_limit: TokenBucket = None, download_limit: TokenBucket = None,
+                 peer_upload_rate: int = None, peer_download_rate: int = None):
+        self.is_running = False 
+        self.tracker = Tracker(torrent)
+        # The port peers can connect to us on, once something listens on it
+        self.listen_port = port
+        if port is not None:
+            self.tracker.port = port
+        # Peers from trackers, the DHT and peer exchange all end up here
+        self.scheduler = ConnectionScheduler(self._new_connection, max_connections, max_half_open,
+                                             dial_limit=dial_limit)
+        self.piece_manager = PieceManager(torrent, resume_dir, on_have=self._on_have,
+                                          on_cancel=self._on_cancel, on_ban=self._on_ban,
+                                          cache=cache,
+                                          disk_executor=disk_executor,
+                                          hash_executor=hash_executor, files=files)
+        self.choker = Choker(self.scheduler.connections, lambda: self.piece_manager.complete)
+        # Optional bandwidth limits of the torrent, and of each of its peers
+        self.upload_limit = upload_limit
+        self.download_limit = download_limit
+        self.peer_upload_rate = peer_upload_rate
+        self.peer_download_rate = peer_download_rate
+        # Keep running and uploading once the download is complete
+        self.seed = seed
+        self.force_recheck = force_recheck
+        # An optional started DHTNode to find peers without trackers
+        self.dht = dht
+        self._dht_task = None
+        self._dht_wakeup = asyncio.Event()
+        self._announce_task = None
+        self.abort = False
+
+    async def start(self):
+        """
+        Runs the torrent on its own: listening for peers on its port, and
+        holding the HTTP pool shared by trackers until it returns.
+        """
+        self.tracker.http_pool.acquire()
+        # Accept the peers that found us through the port we announce
+        listener = Listener(self.tracker.port)
+        listener.register(self.tracker.torrent.info_hash, self.accept)
+        try:
+            await listener.start()
+            self.tracker.port = self.listen_port = listener.port
+        except OSError as e:
+            logging.warning(f'Unable to listen on port {self.tracker.port}: {e}')
+            listener = None
+        try:
+            await self.run()
+        finally:
+            if listener:
+                await listener.stop()
+            await self.tracker.http_pool.release()
+
+    async def run(self):
+        """
+        Downloads the torrent, and seeds it afterwards if asked to, leaving
+        the HTTP pool shared with other torrents open. The files are closed
+        when it returns.
+        """
+        try:
+            # Pick up where we left off before connecting to anyone
+            await self.piece_manager.load(self.force_recheck)
+
+            # Peers are dialed as soon as the tracker hands them out
+            self.scheduler.start()
+            self.choker.start()
+            if self.dht:
+                self._dht_task = asyncio.ensure_future(self._dht_loop())
+
+            previous = None
+            interval = 30 * 60
+            retry = 0  # No announce is started before this time
+            # Seeding from the start is not a completion worth announcing
+            completed = self.piece_manager.complete
+
+            while True:
+                if self.piece_manager.complete and not self.seed:
+                    logging.info('Torrent fully downloaded!')
+                    break
+                if self.abort:
+                    logging.info('Aborting download...')
+                    break
+
+                current = time.time()
+                announce = self._announce_task
+                if announce is not None and announce.done():
+                    self._announce_task = None
+                    response = announce.result()
+                    if response:
+                        previous = announced
+                        interval = response['interval']
+                    else:
+                        # Don't hammer trackers that are down
+                        retry = current + ANNOUNCE_RETRY
+
+                if self._announce_task is None and current >= retry:
+                    event = None if previous else 'started'
+                    if previous and not completed and self.piece_manager.complete:
+                        logging.info('Torrent fully downloaded, seeding')
+                        event = 'completed'
+                    if event or previous + interval < current:
+                        # Trackers that don't answer must not hold up the
+                        # checks above
+                        self._announce_task = asyncio.ensure_future(self._announce(event))
+                        announced = current
+                        completed = self.piece_manager.complete
+                await asyncio.sleep(1 if self._announce_task else 5)
+        finally:
+            self.stop()
+            # Only once the pieces being written are on disk
+            await self.piece_manager.close_async()
+
+    async def _announce(self, event):
+        """
+        Announces to the trackers, giving up on those still silent after
+        `ANNOUNCE_TIMEOUT`. Peers are handed to the scheduler as each
+        tracker responds.
+
+        :return The tracker response, or None if no tracker responded
+        """
+        response = await self.tracker.connect(
+            uploaded=self.piece_manager.bytes_uploaded,
+            downloaded=self.piece_manager.bytes_downloaded,
+            event=event,
+            on_peers=self._add_peers,
+            timeout=ANNOUNCE_TIMEOUT)
+        if response is None and self.dht:
+            # Look the peers up on the DHT now rather than at its next round
+            self._dht_wakeup.set()
+        return response
+
+    async def _dht_loop(self):
+        while not self.abort:
+            self._dht_wakeup.clear()
+            try:
+                peers = await self.dht.announce_peer(self.tracker.torrent.info_hash,
+                                                     self.tracker.port)
+            except (OSError, DHTError) as e:
+                logging.warning(f'DHT announce failed: {e}')
+            else:
+                logging.info(f'DHT found {len(peers)} peers')
+                self._add_peers(peers)
+            try:
+                await asyncio.wait_for(self._dht_wakeup.wait(), DHT_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    def _add_peers(self, peers):
+        self.scheduler.add(peers)
+
+    def accept(self, peer, reader, writer, handshake) -> bool:
+        """
+        Takes over a connection from a peer that sent a handshake for this
+        torrent.
+
+        :return False if the connection was refused
+        """
+        if self.abort or handshake.peer_id in self.piece_manager.banned:
+            return False
+        return self.scheduler.accept(peer, reader, writer, handshake)
+
+    def _new_connection(self):
+        return PeerConnection(None,
+                              self.tracker.torrent.info_hash,
+                              self.tracker.peer_id,
+                              self.piece_manager,
+                              self._on_block_retrieved,
+                              on_peers=self._add_peers,
+                              upload_limit=limiter(self.peer_upload_rate, self.upload_limit),
+                              download_limit=limiter(self.peer_download_rate, self.download_limit),
+                              port=self.listen_port)
+
+    def stop(self):
+        self.abort = True
+        if self._dht_task:
+            self._dht_task.cancel()
+        if self._announce_task:
+            self._announce_task.cancel()
+        self.choker.stop()
+        self.scheduler.stop()
+        self.tracker.close()
+
+    def set_file_priority(self, file: int, priority: int):
+        self.piece_manager.set_file_priority(file, priority)
+
+    def open(self, file: int, **kwargs) -> FileStream:
+        """
+        Opens a file of the torrent to read it while it downloads, see
+        `FileStream` for the arguments.
+        """
+        return FileStream(self.piece_manager, file, **kwargs)
+
+    def _on_have(self, index: int):
+        for connection in self.scheduler.connections():
+            connection.send_have(index)
+
+    def _on_cancel(self, peer_ids, block):
+        for connection in self.scheduler.connections():
+            if connection.remote_id in peer_ids:
+                connection.cancel_request(block)
+
+    def _on_ban(self, peer_id):
+        for (host, _), (connection, _) in list(self.scheduler.active.items()):
+            if connection.remote_id == peer_id:
+                self.scheduler.ban(host)
+
+    def _on_block_retrieved(self, peer_id, piece_index, block_offset, data):
+        self.piece_manager.block_received(
+            peer_id=peer_id, piece_index=piece_index,
+            block_offset=block_offset, data=data)
+
+
+class Block:
+    """
+    A block requested from a peer. Block objects only exist for requests in
+    flight, the status of every block is kept in `DownloadState`.
+    """
+    Missing = DownloadState.Missing
+    Pending = DownloadState.Pending
+    Retrieved = DownloadState.Retrieved
+
+    def __init__(self, piece: int, offset: int, length: int):
+        self.piece = piece
+        self.offset = offset
+        self.length = length
+        self.status = Block.Missing
+        self.data = None
+
+
+class Piece:
+    """
+    A piece currently being downloaded, holding the retrieved blocks and
+    the peers they came from until the piece is complete and can be verified
+    and written.
+
+    Blocks are copied at their offset into a single buffer of the size of
+    the piece, usually one allocated from a `PieceCache`.
+    """
+    def __init__(self, index: int, length: int, hash_value: bytes = None, buffer=None):
+        self.index = index
+        self.length = length
+        self.hash = hash_value
+        self.buffer = bytearray(length) if buffer is None else buffer
+        self.peers = set()
+
+    def reset(self):
+        self.peers.clear()
+
+    def block_received(self, offset: int, data: bytes, peer_id=None):
+        # The data may be a view into the connection's receive buffer
+        self.buffer[offset:offset + len(data)] = data
+        if peer_id is not None:
+            self.peers.add(peer_id)
+
+    def buffers(self):
+        """
+        The piece data, as a list of buffers to verify and write.
+        """
+        return [self.buffer]
+
+
+# The peers a block was requested from, more than one in endgame mode
+PendingRequest = namedtuple('PendingRequest', ['block', 'added', 'peers'])
+
+class PieceManager:
+    """
+    The PieceManager is responsible for keeping track of all the available
+    pieces for the connected peers as well as the pieces we have available for
+    other peers.
+
+    The download state of every block is kept in a compact `DownloadState`;
+    `Piece` and `Block` objects are only created for pieces and blocks that
+    are in flight. Which piece to start next is decided by a rarest-first
+    `PiecePicker`.
+
+    Completed pieces are verified on the `PieceVerifier` thread pool and
+    written by `Storage` without blocking the event loop. Peers that sent
+    blocks of pieces failing verification are scored, and banned after
+    `MAX_HASH_FAILURES`: `on_ban` is called with the peer to disconnect.
+
+    Every request times out after a delay derived from the round-trips of
+    the peer it was sent to (see `RttEstimator`). Deadlines are kept in a
+    `TimeoutQueue`, so checking for expired requests costs O(log n) per
+    expired request instead of a scan of every pending block. A request
+    that times out is cancelled, its block is requested from the next peer
+    asking for work, and the peer is snubbed: limited to a single
+    outstanding request until it delivers a block again.
+
+    Files can be given a priority with `set_file_priority`, 0 leaving them
+    out of the download. Pieces can also be given deadlines with
+    `set_deadlines`, e.g. the read-ahead window of a `FileStream` playing
+    a file while it downloads: they are picked before any other, the
+    earliest first. Pieces due within `CRITICAL_TIME` are left to the fast
+    peers (see `is_fast`), which also race slow or late requests for their
+    blocks, until they are overdue by `CRITICAL_TIME` and any peer may
+    help. `wait_for` waits until a piece is written.
+
+    Once every remaining block is requested, the manager enters endgame
+    mode: pending blocks are requested again from every other peer having
+    them, and when the first copy arrives `on_cancel` is called with the
+    other peers it was requested from so the requests can be cancelled. The
+    bytes received more than once are counted in `duplicate_bytes`.
+
+    Pieces being downloaded are buffered in a `PieceCache`, which may be
+    shared with other torrents, and no new piece is started while the
+    pieces in flight use up its budget. Written pieces stay in the cache to
+    serve uploads: `read_blocks` copies the requested blocks from there,
+    or reads them from disk straight into the caller's buffers. `on_have`
+    is called with the index of every piece written.
+
+    With a resume directory, the pieces written are journaled to a
+    `ResumeFile` so `load` can restore them on restart without rechecking.
+    Otherwise the data on disk is rechecked by a `Rechecker`, reporting its
+    progress in `checking`.
+    """
+    def __init__(self, torrent, resume_dir: str = None, on_have=None, on_cancel=None,
+                 on_ban=None, cache: PieceCache = None, disk_executor=None, hash_executor=None,
+                 files=None):
+        self.torrent = torrent
+        self.peers = {}
+        self.state = DownloadState(torrent.total_size, torrent.piece_length)
+        self.pending_blocks = {}
+        self.ongoing_pieces = {}
+        self.timing = {}  # peer_id -> RttEstimator
+        self.timeouts = TimeoutQueue()
+        self.total_pieces = self.state.num_pieces
+        self.picker = PiecePicker(self.total_pieces)
+        self.storage = Storage(torrent, executor=disk_executor, files=files)
+        self.cache = PieceCache() if cache is None else cache
+        self.verifier = PieceVerifier(executor=hash_executor)
+        self.hash_failures = Counter()
+        self.banned = set()
+        self._writes = set()
+        self.on_have = on_have
+        self.on_cancel = on_cancel
+        self.on_ban = on_ban
+        self.uploaded = 0
+        self.endgame = False
+        self.duplicate_bytes = 0
+        self.checking = None
+        self.file_priorities = [PiecePicker.DEFAULT_PRIORITY] * len(self.storage.files)
+        self.skipped = Bitset(self.total_pieces)  # Pieces of no selected file
+        self.deadlines = {}  # index -> time.monotonic() the piece is needed by
+        self._owned_deadlines = {}  # owner -> the deadlines it set
+        self._deadline_order = []  # (deadline, index), earliest first
+        self._deadline_priority = {}  # index -> priority from its deadline
+        self.rates = {}  # peer_id -> (download rate, time.monotonic() updated)
+        self._fastest = (0.0, 0.0)  # (best download rate, time.monotonic() updated)
+        self._waiters = {}  # index -> futures waiting for the piece
+        self.resume = None
+        if resume_dir:
+            self.resume = ResumeFile.for_torrent(
+                resume_dir, torrent.info_hash, self.total_pieces,
+                [entry.path for entry in self.storage.files])
+
+    async def load(self, force_recheck: bool = False):
+        """
+        Finds out which pieces are already on disk. Up to date resume data is
+        trusted as is; pieces in files changed since they were recorded, or
+        every piece if there is no resume data, are checked against their
+        hash instead.
+
+        :param force_recheck: Ignore the resume data and check every piece
+        """
+        existing = any(size > 0 for size, _ in
+                       (file_stat(entry.path) for entry in self.storage.files))
+        resume = self.resume.load() if self.resume and not force_recheck else None
+        if resume is None:
+            have = Bitset(self.total_pieces)
+            recheck = range(self.total_pieces) if existing else []
+        else:
+            have = resume.have
+            recheck = sorted({index for file in resume.stale
+                              for index in self._file_pieces(file)})
+            for index in recheck:
+                have.discard(index)
+            logging.info(f'Resuming with {have.count()} pieces, '
+                         f'{len(recheck)} pieces to recheck')
+
+        await self.storage.preallocate_async()
+        for index in have:
+            self._mark_have(index)
+        for index in await self._recheck(recheck):
+            self._mark_have(index)
+        if self.resume:
+            self.resume.compact(self.state.have)
+
+    async def _recheck(self, indexes):
+        """
+        Verifies the given pieces against the data on disk.
+
+        :return The indexes of the pieces that are complete on disk
+        """
+        if not indexes:
+            return []
+        rechecker = Rechecker(self.storage, self.torrent.pieces, self.verifier,
+                              self._on_check_progress)
+        try:
+            return await rechecker.run(indexes)
+        finally:
+            self.checking = None
+
+    def _on_check_progress(self, done: int, total: int):
+        self.checking = (done, total)
+
+    @property
+    def check_progress(self):
+        """
+        The fraction of the recheck done, or None if no recheck is running.
+        """
+        if self.checking is None:
+            return None
+        done, total = self.checking
+        return done / total if total else 1.0
+
+    def _file_pieces(self, file: int):
+        entry = self.storage.files[file]
+        if not entry.length:
+            return range(0)
+        first = entry.offset // self.torrent.piece_length
+        last = (entry.offset + entry.length - 1) // self.torrent.piece_length
+        return range(first, last + 1)
+
+    def _mark_have(self, index: int):
+        self.state.set_have(index)
+        self.picker.remove(index)
+        self._wake(index)
+
+    def set_file_priority(self, file: int, priority: int):
+        """
+        Sets the priority of a file, from 0 (not downloaded) to
+        `MAX_FILE_PRIORITY`. Pieces of files with a higher priority are
+        picked first; a piece shared by several files gets the highest
+        priority among them.
+        """
+        if not 0 <= priority <= MAX_FILE_PRIORITY:
+            raise ValueError(f'Invalid file priority: {priority}')
+        self.file_priorities[file] = priority
+        self._update_priorities(self._file_pieces(file))
+
+    def set_deadlines(self, deadlines, owner=None):
+        """
+        Sets the time (`time.monotonic()`) by which pieces are needed,
+        replacing the deadlines previously set by the same owner. Pieces of
+        unselected files are downloaded too when given a deadline.
+
+        :param deadlines: A dict of piece index -> deadline, empty to clear
+        :param owner: Who the deadlines are for, e.g. a `FileStream`
+        """
+        if deadlines:
+            self._owned_deadlines[owner] = dict(deadlines)
+        else:
+            self._owned_deadlines.pop(owner, None)
+        previous = self._deadline_priority
+        self.deadlines = {}
+        for owned in self._owned_deadlines.values():
+            for index, deadline in owned.items():
+                if not self.state.has(index) and deadline < self.deadlines.get(index, math.inf):
+                    self.deadlines[index] = deadline
+        self._deadline_order = sorted((deadline, index) for index, deadline in self.deadlines.items())
+        # Every deadline gets its own priority, as far as there are any
+        # above the file priorities
+        self._deadline_priority = {
+            index: max(DEADLINE_PRIORITY - rank, MAX_FILE_PRIORITY + 1)
+            for rank, (_, index) in enumerate(self._deadline_order)}
+        self._update_priorities(previous.keys() | self._deadline_priority.keys())
+
+    def _update_priorities(self, indexes):
+        for index in indexes:
+            priority = self._deadline_priority.get(index)
+            if priority is None:
+                priority = max(self.file_priorities[file]
+                               for file, _, _ in self.storage.piece_spans(index))
+            if priority != self.picker.priority[index]:
+                self.picker.set_priority(index, index + 1, priority)
+            self.skipped[index] = not priority
+
+    def _critical(self, now: float):
+        """
+        The pieces due within `CRITICAL_TIME` and overdue by less.
+
+        :return (end, lowest, highest): the number of pieces in
+                `_deadline_order` due within `CRITICAL_TIME`, and the range
+                of priorities left to fast peers, or None if there is none
+        """
+        order = self._deadline_order
+        start = bisect.bisect_right(order, (now - CRITICAL_TIME, math.inf))
+        end = bisect.bisect_right(order, (now + CRITICAL_TIME, math.inf))
+        if start == end:
+            return end, None, None
+        return (end, self._deadline_priority[order[end - 1][1]],
+                self._deadline_priority[order[start][1]])
+
+    async def wait_for(self, index: int):
+        """
+        Waits until the given piece is available, on disk or in the cache.
+
+        :raises TorrentError: If the manager is closed before
+        """
+        if self.state.has(index):
+            return
+        future = asyncio.get_running_loop().create_future()
+        waiters = self._waiters.setdefault(index, [])
+        waiters.append(future)
+        try:
+            await future
+        finally:
+            if future in waiters:
+                waiters.remove(future)
+            if not waiters and self._waiters.get(index) is waiters:
+                del self._waiters[index]
+
+    def _wake(self, index: int):
+        for future in self._waiters.pop(index, ()):
+            if not future.done():
+                future.set_result(None)
+
+    async def close_async(self):
+        """
+        Closes the manager from the event loop, once the pieces being
+        verified and written are on disk.
+        """
+        while self._writes:
+            await asyncio.gather(*self._writes, return_exceptions=True)
+        await self.storage.close_async()
+        # Closing the storage again is a no-op
+        self.close()
+
+    def close(self):
+        for waiters in self._waiters.values():
+            for future in waiters:
+                if not future.done():
+                    future.set_exception(TorrentError('Torrent closed'))
+        self._waiters.clear()
+        self.verifier.close()
+        self.storage.close()
+        if self.resume:
+            self.resume.compact(self.state.have)
+            self.resume.close()
+
+    @property
+    def complete(self):
+        """
+        Whether every piece of the selected files is downloaded.
+        """
+        if self.state.complete:
+            return True
+        return self.skipped.any() and (self.state.have | self.skipped).all()
+
+    @property
+    def have_pieces(self) -> List[int]:
+        return [index for index in range(self.total_pieces) if self.state.has(index)]
+
+    @property
+    def bytes_downloaded(self) -> int:
+        return self.state.bytes_have
+
+    @property
+    def bytes_uploaded(self) -> int:
+        return self.uploaded
+
+    def bitfield(self):
+        """
+        The pieces we have as a BitField payload, or None if we have none.
+        """
+        if not self.state.have_count:
+            return None
+        return self.state.have.tobytes()
+
+    def can_upload(self, index: int, begin: int, length: int) -> bool:
+        """
+        Whether a request for the given block is valid and the block is
+        available to upload.
+        """
+        return (0 <= index < self.total_pieces and self.state.has(index)
+                and 0 < length <= MAX_UPLOAD_BLOCK and begin >= 0
+                and begin + length <= self.state.piece_size(index))
+
+    async def read_blocks(self, blocks):
+        """
+        Reads blocks into the given buffers on the disk thread pool.
+
+        :param blocks: (piece index, block offset, buffer) tuples, the
+                       buffers being as long as the blocks to read
+        """
+        piece_length = self.torrent.piece_length
+        reads = []  # (offset, buffer) to fill from disk
+        copies = []  # (piece data, block offset, buffer) to fill from the cache
+        loading = {}  # index -> buffer of a popular piece read whole
+        missed = set()
+        for index, begin, buffer in blocks:
+            data = loading.get(index)
+            if data is None:
+                data = self.cache.get(self._cache_key(index))
+            if data is None and index not in missed:
+                missed.add(index)
+                if self.cache.should_cache(self._cache_key(index)):
+                    data = self.cache.allocate(self.state.piece_size(index))
+                    if data is not None:
+                        loading[index] = data
+                        reads.append((index * piece_length, data))
+            if data is None:
+                reads.append((index * piece_length + begin, buffer))
+            else:
+                copies.append((data, begin, buffer))
+        if reads:
+            try:
+                await self.storage.readinto_async(reads)
+            except BaseException:
+                for data in loading.values():
+                    self.cache.free(data)
+                raise
+        for index, data in loading.items():
+            self.cache.insert(self._cache_key(index), data)
+        for data, begin, buffer in copies:
+            view = memoryview(buffer)
+            view[:] = memoryview(data)[begin:begin + len(view)]
+
+    def _cache_key(self, index: int):
+        return (self.torrent.info_hash, index)
+
+    def record_upload(self, length: int):
+        self.uploaded += length
+
+    def add_peer(self, peer_id, bitfield):
+        """
+        Adds a peer and the bitfield representing the pieces the peer has.
+        """
+        self.remove_peer(peer_id)
+        self.peers[peer_id] = Bitset.from_bytes(self.total_pieces, bitfield.tobytes())
+        self.picker.add_peer(peer_id, self.peers[peer_id])
+
+    def update_peer(self, peer_id, index: int):
+        """
+        Updates the information about which pieces a peer has (reflects a Have
+        message).
+        """
+        if not 0 <= index < self.total_pieces:
+            return
+        if peer_id not in self.peers:
+            # Peers having no pieces may skip the bitfield altogether
+            self.peers[peer_id] = Bitset(self.total_pieces)
+            self.picker.add_peer(peer_id, self.peers[peer_id])
+        if not self.peers[peer_id][index]:
+            self.peers[peer_id][index] = 1
+            self.picker.peer_has(peer_id, index)
+
+    def remove_peer(self, peer_id):
+        """
+        Tries to remove a previously added peer (e.g. used if a peer connection
+        is dropped)
+        """
+        if peer_id in self.peers:
+            has = self.peers.pop(peer_id)
+            self.picker.remove_peer(peer_id, has)
+            self.release_requests(peer_id)
+            # Pieces no connected peer can finish would hold their buffers
+            # in the cache until one shows up
+            for index, piece in list(self.ongoing_pieces.items()):
+                if has[index] and not self.picker.peer_availability(index):
+                    logging.debug(f'Dropping piece {index}, no peer has it anymore')
+                    self._requeue(piece)
+        self.timing.pop(peer_id, None)
+        self.rates.pop(peer_id, None)
+
+    def release_requests(self, peer_id):
+        """
+        Forgets the requests sent to the given peer (e.g. used when the peer
+        chokes us, discarding them), so the blocks only it was asked for can
+        be requested from other peers right away. The peer is not snubbed.
+        """
+        for key, request in list(self.pending_blocks.items()):
+            request.peers.discard(peer_id)
+            if not request.peers:
+                self._release(key, request)
+
+    def is_snubbed(self, peer_id) -> bool:
+        """
+        Whether the given peer let a request time out and did not send any
+        block since.
+        """
+        timing = self.timing.get(peer_id)
+        return timing is not None and timing.snubbed
+
+    def is_interested(self, peer_id) -> bool:
+        """
+        Whether the given peer has any piece we do not have yet.
+        """
+        bitset = self.peers.get(peer_id)
+        if bitset is None:
+            return False
+        if self.skipped.any():
+            bitset = bitset - self.skipped
+        return bitset.difference_count(self.state.have) > 0
+
+    def download_rate(self, peer_id, now: float = None) -> float:
+        """
+        The rate the given peer sent us blocks at, in bytes per second,
+        averaged over the last `RATE_WINDOW` seconds or so.
+        """
+        if now is None:
+            now = time.monotonic()
+        rate, updated = self.rates.get(peer_id, (0.0, now))
+        return rate * math.exp((updated - now) / RATE_WINDOW)
+
+    def is_fast(self, peer_id, now: float = None) -> bool:
+        """
+        Whether the given peer is not snubbed and sends us blocks at least
+        at 1 / `FAST_PEER_RATIO` of the rate of the fastest peer. Until a
+        block arrives from any peer, every peer is fast.
+        """
+        if self.is_snubbed(peer_id):
+            return False
+        if now is None:
+            now = time.monotonic()
+        best, updated = self._fastest
+        best *= math.exp((updated - now) / RATE_WINDOW)
+        return self.download_rate(peer_id, now) * FAST_PEER_RATIO >= best
+
+    def next_request(self, peer_id) -> Block:
+        """
+        Get the next Block that should be requested from the given peer.
+
+        If there are no more blocks left to retrieve or if this peer does not
+        have any of the missing pieces None is returned
+        """
+        if peer_id not in self.peers or peer_id in self.banned:
+            return None
+
+        self._expire_requests()
+        block = None
+        barred = None  # The priorities this peer is too slow for
+        if self.deadlines:
+            now = time.monotonic()
+            end, lowest, highest = self._critical(now)
+            if self.is_fast(peer_id, now):
+                block = self._critical_request(peer_id, end, now)
+            elif lowest is not None:
+                barred = (lowest, highest)
+        if not block:
+            block = self._next_ongoing(peer_id, barred)
+        if not block:
+            index = self._get_rarest_piece(peer_id, barred)
+            if index is not None:
+                block = self._request(index, peer_id)
+        if not block and self._in_endgame():
+            block = self._endgame_request(peer_id)
+        return block
+
+    def block_received(self, peer_id, piece_index, block_offset, data):
+        """
+        This method must be called when a block has successfully been
+        retrieved by a peer.
+
+        Once a full piece have been retrieved, a SHA1 hash control is made. If
+        the check fails all the pieces blocks are put back in missing state to
+        be fetched again and the peers that sent blocks of it are scored. If
+        the hash succeeds the piece is written to disk and indicated as Have
+        once written.
+        """
+        logging.debug(f'Received block {block_offset} for piece {piece_index} from peer {peer_id}: ')
+
+        now = time.monotonic()
+        rate = self.download_rate(peer_id, now) + len(data) / RATE_WINDOW
+        self.rates[peer_id] = (rate, now)
+        # The best rate decays like the rates, a peer that leaves fades out
+        best, updated = self._fastest
+        if rate > best * math.exp((updated - now) / RATE_WINDOW):
+            self._fastest = (rate, now)
+        request = self.pending_blocks.pop((piece_index, block_offset), None)
+        if request is not None:
+            timing = self.timing.get(peer_id)
+            if timing is not None and request.peers == {peer_id}:
+                timing.sample(now - request.added)
+            others = request.peers - {peer_id}
+            if others and self.on_cancel:
+                self.on_cancel(others, request.block)
+        block = self.state.block_index(piece_index, block_offset)
+        if block is not None and self.state.block_status(piece_index, block) == DownloadState.Retrieved:
+            logging.debug(f'Discarding duplicate block {block_offset} for piece {piece_index}')
+            self.duplicate_bytes += len(data)
+            return
+        piece = self.ongoing_pieces.get(piece_index)
+        if block is None or piece is None:
+            logging.warning(f'Trying to update piece that is not ongoing: {piece_index}')
+            return
+        self.state.block_received(piece_index, block)
+        piece.block_received(block_offset, data, peer_id)
+
+        if self.state.is_complete(piece_index):
+            del self.ongoing_pieces[piece_index]
+            self._complete(piece)
+
+    def _piece_hash(self, index: int) -> bytes:
+        return self.torrent.pieces[index * 20:(index + 1) * 20]
+
+    def _request(self, index: int, peer_id) -> Block:
+        block = self.state.request_block(index)
+        if block is None:
+            return None
+        block = Block(index, block * REQUEST_SIZE, self.state.block_length(index, block))
+        block.status = Block.Pending
+        timing = self.timing.get(peer_id)
+        if timing is None:
+            timing = self.timing[peer_id] = RttEstimator()
+        now = time.monotonic()
+        key = (index, block.offset)
+        self.pending_blocks[key] = PendingRequest(block, now, {peer_id})
+        self.timeouts.push(now + timing.timeout, (key, now))
+        return block
+
+    def _expire_requests(self):
+        """
+        Releases the requests that were not answered in time so their blocks
+        are requested again, and snubs the peers they were sent to.
+        """
+        now = time.monotonic()
+        for key, added in self.timeouts.expired(now):
+            request = self.pending_blocks.get(key)
+            if request is None or request.added != added:
+                continue  # Answered, or released already
+            if len(request.peers) > 1:
+                # Endgame has other peers racing for it: check again later,
+                # in case they all leave but the one that stalled
+                timeout = min((self.timing[peer_id].timeout for peer_id in request.peers
+                               if peer_id in self.timing), default=INITIAL_TIMEOUT)
+                self.timeouts.push(now + timeout, (key, added))
+                continue
+            logging.info(f'Request for block {request.block.offset} of piece {request.block.piece} '
+                         f'timed out after {now - added:.1f}s')
+            for peer_id in request.peers:
+                timing = self.timing.get(peer_id)
+                if timing is not None:
+                    timing.timed_out()
+            if self.on_cancel:
+                self.on_cancel(set(request.peers), request.block)
+            self._release(key, request)
+
+    def _release(self, key, request):
+        """
+        Puts a pending block back to missing.
+        """
+        del self.pending_blocks[key]
+        index, offset = key
+        block = self.state.block_index(index, offset)
+        if block is not None:
+            self.state.block_missing(index, block)
+        self.endgame = False
+
+    def _in_endgame(self) -> bool:
+        """
+        Whether every block left to download has been requested.
+        """
+        if self.endgame:
+            return True
+        if not self.pending_blocks or (self.picker.wanted - self.skipped).any():
+            return False
+        state = self.state
+        for index in self.ongoing_pieces:
+            base = index * state.blocks_per_piece
+            if state.blocks.find(DownloadState.Missing, base, base + state.block_count(index)) != -1:
+                return False
+        logging.info(f'Entering endgame mode with {len(self.pending_blocks)} blocks pending')
+        self.endgame = True
+        return True
+
+    def _endgame_request(self, peer_id) -> Block:
+        """
+        Picks the pending block with the fewest requests among those the
+        given peer has and was not asked for yet.
+        """
+        has = self.peers[peer_id]
+        best = None
+        for request in self.pending_blocks.values():
+            if peer_id in request.peers or not has[request.block.piece]:
+                continue
+            if best is None or len(request.peers) < len(best.peers):
+                best = request
+                if len(best.peers) == 1:
+                    break
+        if best is None:
+            return None
+        best.peers.add(peer_id)
+        return best.block
+
+    def _critical_request(self, peer_id, end: int, now: float) -> Block:
+        """
+        Picks a block of the first `end` pieces with a deadline for a fast
+        peer: a missing block of the earliest one the peer has, starting it
+        if needed, or else a block pending from a slow peer, or for longer
+        than twice its round-trip, to race it.
+        """
+        has = self.peers[peer_id]
+        for _, index in self._deadline_order[:end]:
+            if not has[index] or self.state.has(index):
+                continue
+            if index not in self.ongoing_pieces:
+                if not self.picker.wanted[index] or not self._start_piece(index):
+                    continue
+                self.picker.remove(index)
+            block = self._request(index, peer_id)
+            if block:
+                return block
+        for _, index in self._deadline_order[:end]:
+            if not has[index] or index not in self.ongoing_pieces:
+                continue
+            for offset in range(0, self.state.piece_size(index), REQUEST_SIZE):
+                request = self.pending_blocks.get((index, offset))
+                if request is None or len(request.peers) != 1 or peer_id in request.peers:
+                    continue
+                other = next(iter(request.peers))
+                timing = self.timing.get(other)
+                rtt = timing.srtt if timing is not None and timing.srtt is not None else CRITICAL_TIME
+                if not self.is_fast(other, now) or now - request.added > 2 * rtt:
+                    request.peers.add(peer_id)
+                    return request.block
+        return None
+
+    def _next_ongoing(self, peer_id, barred=None) -> Block:
+        """
+        Go through the ongoing pieces and return the next block to be
+        requested or None if no block is left to be requested.
+
+        :param barred: A (lowest, highest) range of priorities to skip
+        """
+        for index in self.ongoing_pieces:
+            if barred and barred[0] <= self.picker.priority[index] <= barred[1]:
+                continue
+            if self.peers[peer_id][index]:
+                block = self._request(index, peer_id)
+                if block:
+                    return block
+        return None
+
+    def _get_rarest_piece(self, peer_id, barred=None):
+        """
+        Picks the rarest missing piece the given peer has and starts it as an
+        ongoing piece.
+
+        :param barred: A (lowest, highest) range of priorities to skip
+        :return The piece index, or None if the peer has no missing piece
+        """
+        if not self.cache.can_allocate(self.torrent.piece_length):
+            logging.debug('Piece cache full, not starting a new piece')
+            return None
+        has = self.peers[peer_id]
+        # Random first pieces would delay the pieces with a deadline
+        downloaded = None if self.deadlines else self.state.have_count
+        if barred:
+            index = self.picker.pick(peer_id, has, downloaded, min_priority=barred[1] + 1)
+            if index is None:
+                index = self.picker.pick(peer_id, has, downloaded, max_priority=barred[0] - 1)
+        else:
+            index = self.picker.pick(peer_id, has, downloaded)
+        if index is not None:
+            self._start_piece(index)
+        return index
+
+    def _start_piece(self, index: int) -> bool:
+        size = self.state.piece_size(index)
+        buffer = self.cache.allocate(size)
+        if buffer is None:
+            return False
+        self.ongoing_pieces[index] = Piece(index, size, self._piece_hash(index), buffer)
+        return True
+
+    def _complete(self, piece):
+        """
+        Verifies the completed piece and writes it to disk. Inside an event
+        loop both run on thread pools.
+        """
+        offset = piece.index * self.torrent.piece_length
+        buffers = piece.buffers()
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            if self.verifier.check(piece.hash, buffers):
+                self.storage.writev(offset, buffers)
+                self.cache.insert(self._cache_key(piece.index), piece.buffer)
+                self._piece_written(piece.index)
+            else:
+                self._hash_failed(piece)
+            return
+        task = loop.create_task(self._complete_async(piece, offset, buffers))
+        self._writes.add(task)
+        task.add_done_callback(self._writes.discard)
+
+    async def _complete_async(self, piece, offset: int, buffers):
+        if not await self.verifier.verify(piece.hash, buffers):
+            self._hash_failed(piece)
+            return
+        try:
+            await self.storage.write_async(offset, buffers)
+        except (OSError, TorrentError) as e:
+            logging.error(f'Unable to write piece {piece.index}: {e}')
+            self._requeue(piece)
+        else:
+            self.cache.insert(self._cache_key(piece.index), piece.buffer)
+            self._piece_written(piece.index)
+
+    def _hash_failed(self, piece):
+        logging.info(f'Discarding corrupt piece {piece.index}')
+        self._requeue(piece)
+        for peer_id in piece.peers:
+            self.hash_failures[peer_id] += 1
+            if self.hash_failures[peer_id] >= MAX_HASH_FAILURES and peer_id not in self.banned:
+                logging.warning(f'Banning peer {peer_id} after {MAX_HASH_FAILURES} corrupt pieces')
+                self.banned.add(peer_id)
+                if self.on_ban:
+                    self.on_ban(peer_id)
+
+    def _requeue(self, piece):
+        """
+        Throws away the data of a piece and frees its buffer, so the piece
+        is downloaded again from scratch.
+        """
+        self.ongoing_pieces.pop(piece.index, None)
+        self.endgame = False
+        self.cache.free(piece.buffer)
+        self.state.reset(piece.index)
+        self.picker.restore(piece.index)
+
+    def _piece_written(self, index: int):
+        self.state.set_have(index)
+        self.deadlines.pop(index, None)
+        self._wake(index)
+        logging.info(f'{self.state.have_count} / {self.total_pieces} pieces downloaded')
+        if self.on_have:
+            self.on_have(index)
+        if self.resume:
+            self.resume.record(index, [span[0] for span in self.storage.piece_spans(index)])
+            if self.resume.should_compact():
+                self.resume.compact(self.state.have)
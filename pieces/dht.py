@@ -0,0 +1,507 @@
+import asyncio
+import hashlib
+import heapq
+import logging
+import os
+import socket
+import struct
+import time
+from collections import Counter, OrderedDict, namedtuple
+from pieces.bencoding import Decoder, Encoder
+from pieces.exceptions import DHTError
+from pieces.peer import decode_peers, merge_peers
+
+K = 8  # Nodes per bucket, and nodes a lookup converges on
+ALPHA = 3  # Queries in flight per lookup
+QUERY_TIMEOUT = 2.0
+MAX_FAILURES = 2  # Failed queries before a node is dropped
+QUESTIONABLE_AFTER = 15 * 60
+TOKEN_ROTATION = 5 * 60
+PEER_LIFETIME = 30 * 60
+MAX_VALUES = 50  # Peers returned per get_peers response
+MAX_PEERS_PER_TORRENT = 2000
+ID_BITS = 160
+
+BOOTSTRAP_NODES = [('router.bittorrent.com', 6881), ('dht.transmissionbt.com', 6881),
+                   ('router.utorrent.com', 6881)]
+
+NodeInfo = namedtuple('NodeInfo', ['id', 'host', 'port'])
+
+_NODE = struct.Struct('!20s4sH')
+_PEER = struct.Struct('!4sH')
+
+
+def random_id() -> bytes:
+    return os.urandom(20)
+
+
+def distance(a: bytes, b: bytes) -> int:
+    return int.from_bytes(a, 'big') ^ int.from_bytes(b, 'big')
+
+
+def encode_nodes(nodes) -> bytes:
+    """
+    Encodes IPv4 nodes as compact node info (26 bytes per node).
+    """
+    return b''.join(_NODE.pack(node.id, socket.inet_aton(node.host), node.port)
+                    for node in nodes if ':' not in node.host)
+
+
+def decode_nodes(data):
+    view = memoryview(data).cast('B')
+    view = view[:len(view) - len(view) % _NODE.size]
+    return [NodeInfo(node_id, socket.inet_ntoa(ip), port)
+            for node_id, ip, port in _NODE.iter_unpack(view) if port]
+
+
+class RoutingTable:
+    """
+    The k-buckets of a DHT node: bucket `i` holds up to `K` nodes whose
+    distance to our id has its highest bit at position `ID_BITS - 1 - i`,
+    i.e. that share `i` leading bits with us. Nodes are kept in least
+    recently seen order.
+    """
+    def __init__(self, node_id: bytes):
+        self.node_id = node_id
+        self._own = int.from_bytes(node_id, 'big')
+        # node id -> NodeInfo, node id -> (last seen, failures)
+        self.buckets = [OrderedDict() for _ in range(ID_BITS)]
+        self.status = {}
+
+    def __len__(self):
+        return len(self.status)
+
+    def __contains__(self, node_id):
+        return node_id in self.status
+
+    def _bucket(self, node_id: bytes):
+        bits = (self._own ^ int.from_bytes(node_id, 'big')).bit_length()
+        return self.buckets[ID_BITS - bits] if bits else None
+
+    def nodes(self):
+        for bucket in self.buckets:
+            yield from bucket.values()
+
+    def add(self, node: NodeInfo, now: float = None):
+        """
+        Adds or refreshes a node that was heard from.
+
+        :return None if the node is in the table, or else the least recently
+                seen node of its full bucket, which should be pinged and
+                evicted if it doesn't answer
+        """
+        bucket = self._bucket(node.id)
+        if bucket is None:
+            return None
+        now = time.monotonic() if now is None else now
+        if node.id in bucket:
+            bucket[node.id] = node
+            bucket.move_to_end(node.id)
+            self.status[node.id] = (now, 0)
+            return None
+        if len(bucket) < K:
+            bucket[node.id] = node
+            self.status[node.id] = (now, 0)
+            return None
+        # Full bucket: replace a node that failed to answer, if there is one
+        for old in bucket.values():
+            if self.status[old.id][1]:
+                self.remove(old.id)
+                return self.add(node, now)
+        return next(iter(bucket.values()))
+
+    def remove(self, node_id: bytes):
+        bucket = self._bucket(node_id)
+        if bucket is not None and bucket.pop(node_id, None):
+            del self.status[node_id]
+
+    def failed(self, node_id: bytes):
+        """
+        Records a query the node didn't answer, dropping it after
+        `MAX_FAILURES` in a row.
+        """
+        if node_id not in self.status:
+            return
+        seen, failures = self.status[node_id]
+        if failures + 1 >= MAX_FAILURES:
+            self.remove(node_id)
+        else:
+            self.status[node_id] = (seen, failures + 1)
+
+    def questionable(self, node_id: bytes, now: float = None) -> bool:
+        now = time.monotonic() if now is None else now
+        seen, failures = self.status[node_id]
+        return failures > 0 or now - seen > QUESTIONABLE_AFTER
+
+    def closest(self, target: bytes, count: int = K):
+        """
+        The `count` known nodes closest to the target.
+        """
+        target = int.from_bytes(target, 'big')
+        return heapq.nsmallest(count, self.nodes(),
+                               key=lambda node: int.from_bytes(node.id, 'big') ^ target)
+
+    def save(self, path: str):
+        """
+        Writes our id and the nodes of the table, for a warm restart.
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temporary = path + '.tmp'
+        with open(temporary, 'wb') as f:
+            f.write(Encoder({b'id': self.node_id, b'nodes': encode_nodes(self.nodes())}).encode())
+        os.replace(temporary, path)
+
+    @staticmethod
+    def load(path: str):
+        """
+        Reads a saved table back.
+
+        :return A (node id, nodes) tuple, or None if there is no usable state
+        """
+        try:
+            with open(path, 'rb') as f:
+                state = Decoder(f.read()).decode()
+            node_id = state[b'id']
+            if len(node_id) != 20:
+                raise ValueError('Invalid node id')
+            return node_id, decode_nodes(state.get(b'nodes', b''))
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.warning(f'Ignoring DHT state {path}: {e}')
+            return None
+
+
+class KRPCProtocol(asyncio.DatagramProtocol):
+    """
+    The KRPC transport of a DHT node: bencoded queries, responses and errors
+    over UDP, matched by transaction id.
+    """
+    def __init__(self, node):
+        self.node = node
+        self.transport = None
+        self.waiters = {}
+        self._transaction = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        try:
+            message = Decoder(data).decode()
+            kind = message[b'y']
+            transaction = message[b't']
+        except (ValueError, KeyError, TypeError):
+            return
+        if not isinstance(transaction, bytes):
+            return
+        self.node.stats['received'] += 1
+        if kind == b'q':
+            self.node.handle_query(message, addr, transaction)
+            return
+        waiter = self.waiters.pop((transaction, addr[0], addr[1]), None)
+        if waiter is None or waiter.done():
+            return
+        if kind == b'r' and isinstance(message.get(b'r'), dict):
+            waiter.set_result(message[b'r'])
+        elif kind == b'e':
+            waiter.set_exception(DHTError(f'KRPC error: {message.get(b"e")!r}'))
+
+    def error_received(self, exc):
+        # ICMP errors can't be matched to a query, they time out instead
+        pass
+
+    def send(self, message: dict, addr):
+        self.node.stats['sent'] += 1
+        self.transport.sendto(Encoder(message).encode(), addr)
+
+    async def query(self, addr, name: bytes, args: dict, timeout: float):
+        self._transaction = (self._transaction + 1) & 0xFFFF
+        transaction = struct.pack('!H', self._transaction)
+        waiter = asyncio.get_running_loop().create_future()
+        key = (transaction, addr[0], addr[1])
+        self.waiters[key] = waiter
+        try:
+            self.send({b't': transaction, b'y': b'q', b'q': name, b'a': args}, addr)
+            return await asyncio.wait_for(waiter, timeout)
+        finally:
+            self.waiters.pop(key, None)
+
+
+class DHTNode:
+    """
+    A mainline DHT node (BEP 5) on a single asyncio UDP socket.
+
+    It answers `ping`, `find_node`, `get_peers` and `announce_peer` queries,
+    storing announced peers with write tokens that rotate every 5 minutes.
+    Lookups are iterative, keeping `ALPHA` queries in flight towards the
+    target, each with a strict `QUERY_TIMEOUT`, until the `K` closest nodes
+    have answered.
+
+    With a `state_path`, the node id and routing table are saved on close
+    and loaded back on start, so a restart doesn't need to bootstrap.
+    """
+    def __init__(self, node_id: bytes = None, host: str = '0.0.0.0', port: int = 0,
+                 state_path: str = None, query_timeout: float = QUERY_TIMEOUT):
+        self.state_path = state_path
+        self.host = host
+        self.port = port
+        self.query_timeout = query_timeout
+        nodes = []
+        state = RoutingTable.load(state_path) if state_path and node_id is None else None
+        if state:
+            node_id, nodes = state
+        self.node_id = node_id or random_id()
+        self.table = RoutingTable(self.node_id)
+        for node in nodes:
+            self.table.add(node)
+        self.peers = {}  # info hash -> OrderedDict of (host, port) -> expiry
+        self.stats = Counter()
+        self.protocol = None
+        self._secrets = [os.urandom(16), os.urandom(16)]
+        self._rotated = time.monotonic()
+        self._pings = set()
+
+    @property
+    def address(self):
+        return self.protocol.transport.get_extra_info('sockname')[:2]
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        _, self.protocol = await loop.create_datagram_endpoint(
+            lambda: KRPCProtocol(self), local_addr=(self.host, self.port))
+        return self
+
+    def close(self):
+        for task in self._pings:
+            task.cancel()
+        if self.protocol and self.protocol.transport:
+            self.protocol.transport.close()
+        if self.state_path:
+            self.table.save(self.state_path)
+
+    # Outgoing queries
+
+    async def _query(self, addr, name: bytes, args: dict, node_id: bytes = None):
+        """
+        Sends a query, keeping the routing table up to date with the outcome.
+
+        :return The response arguments, or None if the node didn't answer
+        """
+        args[b'id'] = self.node_id
+        try:
+            response = await self.protocol.query(addr, name, args, self.query_timeout)
+        except (asyncio.TimeoutError, DHTError, OSError):
+            self.stats['timeouts'] += 1
+            if node_id:
+                self.table.failed(node_id)
+            return None
+        responder = response.get(b'id')
+        if isinstance(responder, bytes) and len(responder) == 20:
+            self._heard_from(NodeInfo(responder, addr[0], addr[1]))
+        return response
+
+    def _heard_from(self, node: NodeInfo):
+        if node.id == self.node_id:
+            return
+        oldest = self.table.add(node)
+        if oldest is not None and self.table.questionable(oldest.id):
+            task = asyncio.ensure_future(self._replace(oldest, node))
+            self._pings.add(task)
+            task.add_done_callback(self._pings.discard)
+
+    async def _replace(self, oldest: NodeInfo, node: NodeInfo):
+        if await self._query((oldest.host, oldest.port), b'ping', {}, oldest.id) is None:
+            self.table.remove(oldest.id)
+            self.table.add(node)
+
+    async def ping(self, addr):
+        return await self._query(addr, b'ping', {})
+
+    async def bootstrap(self, addresses=BOOTSTRAP_NODES):
+        """
+        Joins the DHT through the given nodes, by looking up our own id.
+        """
+        loop = asyncio.get_running_loop()
+        resolved = []
+        # Responses are matched by address, so host names are resolved first
+        for host, port in addresses:
+            try:
+                infos = await loop.getaddrinfo(host, port, family=socket.AF_INET,
+                                               type=socket.SOCK_DGRAM)
+            except OSError as e:
+                logging.warning(f'Unable to resolve DHT bootstrap node {host}: {e}')
+                continue
+            resolved.append(infos[0][4][:2])
+        await asyncio.gather(*(self._query(addr, b'find_node', {b'target': self.node_id})
+                               for addr in resolved))
+        await self.find_node(self.node_id)
+        return len(self.table)
+
+    async def _lookup(self, target: bytes, name: bytes, args: dict, on_response=None):
+        """
+        Iteratively queries the nodes closest to `target`, with up to `ALPHA`
+        queries in flight, until the `K` closest nodes known have answered.
+
+        :return The nodes that answered, closest first
+        """
+        key = int.from_bytes(target, 'big')
+
+        def by_distance(node):
+            return int.from_bytes(node.id, 'big') ^ key
+        candidates = {node.id: node for node in self.table.closest(target, K)}
+        queried = set()
+        answered = {}
+        pending = {}
+        while True:
+            closest = sorted(candidates.values(), key=by_distance)
+            # Done once the K closest candidates have all been queried
+            frontier = [node for node in closest if node.id not in queried or node.id in answered]
+            todo = [node for node in frontier[:K] if node.id not in queried]
+            for node in todo[:ALPHA - len(pending)]:
+                queried.add(node.id)
+                task = asyncio.ensure_future(
+                    self._query((node.host, node.port), name, dict(args), node.id))
+                pending[task] = node
+            if not pending:
+                break
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                node = pending.pop(task)
+                response = task.result()
+                if response is None:
+                    candidates.pop(node.id, None)
+                    continue
+                answered[node.id] = node
+                if on_response:
+                    on_response(node, response)
+                nodes = response.get(b'nodes')
+                if isinstance(nodes, bytes):
+                    for found in decode_nodes(nodes):
+                        if found.id != self.node_id and found.id not in candidates:
+                            candidates[found.id] = found
+        return sorted(answered.values(), key=by_distance)
+
+    async def find_node(self, target: bytes):
+        """
+        Finds the `K` nodes closest to the target id.
+        """
+        return (await self._lookup(target, b'find_node', {b'target': target}))[:K]
+
+    async def get_peers(self, info_hash: bytes, tokens: dict = None):
+        """
+        Finds peers of a torrent.
+
+        :param tokens: Filled with node id -> (node, write token) of the
+                       nodes that answered, for `announce_peer`
+        :return A list of unique (host, port) tuples
+        """
+        found = []
+
+        def collect(node, response):
+            values = response.get(b'values')
+            if isinstance(values, list):
+                found.append(decode_peers(b''.join(value for value in values
+                                                   if isinstance(value, bytes))))
+            token = response.get(b'token')
+            if tokens is not None and isinstance(token, bytes):
+                tokens[node.id] = (node, token)
+        await self._lookup(info_hash, b'get_peers', {b'info_hash': info_hash}, collect)
+        return merge_peers(*found)
+
+    async def announce_peer(self, info_hash: bytes, port: int = 0):
+        """
+        Announces that we have a torrent to the nodes closest to it. A port
+        of 0 announces the port of our DHT socket instead.
+
+        :return The peers found on the way, as `get_peers`
+        """
+        tokens = {}
+        peers = await self.get_peers(info_hash, tokens)
+        closest = heapq.nsmallest(K, tokens.values(),
+                                  key=lambda entry: distance(entry[0].id, info_hash))
+        await asyncio.gather(*(
+            self._query((node.host, node.port), b'announce_peer',
+                        {b'info_hash': info_hash, b'port': port or self.address[1],
+                         b'implied_port': 0 if port else 1, b'token': token}, node.id)
+            for node, token in closest))
+        return peers
+
+    # Incoming queries
+
+    def _token(self, host: str, secret: bytes) -> bytes:
+        return hashlib.sha1(secret + host.encode()).digest()[:8]
+
+    def _rotate(self):
+        now = time.monotonic()
+        if now - self._rotated > TOKEN_ROTATION:
+            self._secrets = [os.urandom(16), self._secrets[0]]
+            self._rotated = now
+
+    def _valid_token(self, host: str, token) -> bool:
+        return any(token == self._token(host, secret) for secret in self._secrets)
+
+    def _store(self, info_hash: bytes, peer):
+        now = time.monotonic()
+        peers = self.peers.setdefault(info_hash, OrderedDict())
+        peers.pop(peer, None)
+        peers[peer] = now + PEER_LIFETIME
+        while peers and (len(peers) > MAX_PEERS_PER_TORRENT or next(iter(peers.values())) < now):
+            peers.popitem(last=False)
+
+    def _values(self, info_hash: bytes):
+        peers = self.peers.get(info_hash)
+        if not peers:
+            return None
+        now = time.monotonic()
+        values = []
+        # Most recently announced first
+        for (host, port), expiry in reversed(peers.items()):
+            if expiry < now or len(values) == MAX_VALUES:
+                break
+            if ':' not in host:
+                values.append(_PEER.pack(socket.inet_aton(host), port))
+        return values
+
+    def handle_query(self, message: dict, addr, transaction: bytes):
+        self._rotate()
+        try:
+            name = message[b'q']
+            args = message[b'a']
+            sender = args[b'id']
+            if not isinstance(sender, bytes) or len(sender) != 20:
+                raise KeyError(b'id')
+            response = {b'id': self.node_id}
+            if name == b'ping':
+                pass
+            elif name == b'find_node':
+                response[b'nodes'] = encode_nodes(self.table.closest(args[b'target']))
+            elif name == b'get_peers':
+                info_hash = args[b'info_hash']
+                response[b'token'] = self._token(addr[0], self._secrets[0])
+                values = self._values(info_hash)
+                if values:
+                    response[b'values'] = values
+                else:
+                    response[b'nodes'] = encode_nodes(self.table.closest(info_hash))
+            elif name == b'announce_peer':
+                if not self._valid_token(addr[0], args.get(b'token')):
+                    self._error(addr, transaction, 203, b'Bad token')
+                    return
+                port = addr[1] if args.get(b'implied_port') else args[b'port']
+                info_hash = args[b'info_hash']
+                if not isinstance(port, int) or not 0 < port < 65536 or \
+                        not isinstance(info_hash, bytes) or len(info_hash) != 20:
+                    raise TypeError('Invalid announce')
+                self._store(info_hash, (addr[0], port))
+            else:
+                self._error(addr, transaction, 204, b'Method Unknown')
+                return
+        except (KeyError, TypeError, AttributeError):
+            self._error(addr, transaction, 203, b'Protocol Error')
+            return
+        self._heard_from(NodeInfo(sender, addr[0], addr[1]))
+        self.protocol.send({b't': transaction, b'y': b'r', b'r': response}, addr)
+
+    def _error(self, addr, transaction: bytes, code: int, text: bytes):
+        self.protocol.send({b't': transaction, b'y': b'e', b'e': [code, text]}, addr)
@@ -1,2 +1,14 @@
 class TorrentError(Exception):
     pass
+
+
+class ProtocolError(TorrentError):
+    pass
+
+
+class TrackerError(TorrentError):
+    pass
+
+
+class DHTError(TorrentError):
+    pass
@@ -0,0 +1,108 @@
+import logging
+from pieces.bencoding import Decoder, Encoder
+from pieces.exceptions import ProtocolError
+from pieces.peer import decode_peers, encode_peers
+
+# Extended message ids, as carried in the first byte of an Extended payload
+EXTENDED_HANDSHAKE = 0
+UT_PEX = b'ut_pex'
+
+# The ids we ask remote peers to use when sending us extended messages
+LOCAL_EXTENSIONS = {UT_PEX: 1}
+
+CLIENT_VERSION = b'BitWave 0.1'
+MAX_PEX_PEERS = 200  # Added peers taken from a single ut_pex message
+PEX_MIN_INTERVAL = 45  # Seconds, peers should send ut_pex at most once a minute
+
+
+class ExtensionHandshake:
+    """
+    The BEP 10 extension handshake, sent right after the BitTorrent handshake
+    to peers that set the extension bit in the reserved bytes.
+
+    `extensions` maps extension names to the message id the sender wants to
+    receive that extension on. An id of 0 means the extension is disabled.
+    """
+    def __init__(self, extensions: dict = None, port: int = None,
+                 version: bytes = CLIENT_VERSION, reqq: int = None):
+        self.extensions = dict(LOCAL_EXTENSIONS if extensions is None else extensions)
+        self.port = port
+        self.version = version
+        self.reqq = reqq
+
+    def encode(self) -> bytes:
+        message = {b'm': self.extensions}
+        if self.port:
+            message[b'p'] = self.port
+        if self.version:
+            message[b'v'] = self.version
+        if self.reqq:
+            message[b'reqq'] = self.reqq
+        return Encoder(message).encode()
+
+    @classmethod
+    def decode(cls, payload):
+        message = _decode_dict(payload, 'extension handshake')
+        extensions = message.get(b'm', {})
+        if not isinstance(extensions, dict):
+            raise ProtocolError('Invalid extension handshake: m is not a dict')
+        port = message.get(b'p')
+        version = message.get(b'v')
+        reqq = message.get(b'reqq')
+        return cls(extensions={name: id for name, id in extensions.items()
+                               if isinstance(id, int) and 0 < id < 256},
+                   port=port if isinstance(port, int) and 0 < port < 65536 else None,
+                   version=version if isinstance(version, bytes) else None,
+                   reqq=reqq if isinstance(reqq, int) and reqq > 0 else None)
+
+    def __str__(self):
+        return f'ExtensionHandshake(m={self.extensions}, p={self.port})'
+
+
+class PexMessage:
+    """
+    A ut_pex message (BEP 11) with the peers the sender connected to and
+    disconnected from since its previous message, as compact peer lists.
+    """
+    def __init__(self, added=(), dropped=()):
+        self.added = list(added)
+        self.dropped = list(dropped)
+
+    def encode(self) -> bytes:
+        added, added6 = encode_peers(self.added)
+        dropped, dropped6 = encode_peers(self.dropped)
+        return Encoder({
+            b'added': added,
+            b'added.f': bytes(len(added) // 6),
+            b'added6': added6,
+            b'added6.f': bytes(len(added6) // 18),
+            b'dropped': dropped,
+            b'dropped6': dropped6,
+        }).encode()
+
+    @classmethod
+    def decode(cls, payload):
+        message = _decode_dict(payload, 'ut_pex message')
+        return cls(added=_peers(message, b'added') + _peers(message, b'added6', ipv6=True),
+                   dropped=_peers(message, b'dropped') + _peers(message, b'dropped6', ipv6=True))
+
+    def __str__(self):
+        return f'PexMessage(added={len(self.added)}, dropped={len(self.dropped)})'
+
+
+def _decode_dict(payload, name: str) -> dict:
+    try:
+        message = Decoder(payload).decode()
+    except ValueError as e:
+        raise ProtocolError(f'Invalid {name}: {e}')
+    if not isinstance(message, dict):
+        raise ProtocolError(f'Invalid {name}: not a dict')
+    return message
+
+
+def _peers(message: dict, key: bytes, ipv6: bool = False):
+    data = message.get(key, b'')
+    if not isinstance(data, bytes):
+        logging.debug(f'Ignoring ut_pex {key} of type {type(data).__name__}')
+        return []
+    return decode_peers(data, ipv6)
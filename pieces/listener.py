@@ -0,0 +1,157 @@
+import asyncio
+import logging
+import time
+from collections import Counter
+from pieces.exceptions import ProtocolError
+from pieces.protocol import Handshake
+
+ACCEPT_RATE = 50  # Incoming connections accepted per second on average...
+ACCEPT_BURST = 100  # ...with bursts of up to this many
+MAX_PER_IP = 4  # Connections from a single address at once
+MAX_PENDING = 64  # Connections whose handshake is being read at once
+HANDSHAKE_TIMEOUT = 10  # Seconds a peer has to send its handshake
+
+
+class Listener:
+    """
+    Accepts incoming peer connections and routes them to their torrent.
+
+    Every connection must send its 68 bytes handshake within
+    `handshake_timeout`. The torrent is then looked up by the info hash in
+    the handshake, in a table of the registered torrents, and the stream is
+    handed to its handler: a callable taking the (host, port) of the peer,
+    the stream reader and writer and the `Handshake`, returning False if it
+    doesn't take the connection (e.g. `TorrentClient.accept`).
+
+    A flood of connections is kept cheap by closing, right after accepting
+    them, connections beyond:
+
+    * `accept_rate` per second, with bursts of `accept_burst` (a token
+      bucket)
+    * `max_per_ip` connections open from the same address, counting those
+      handed to torrents until they close
+    * `max_pending` connections still to send their handshake
+    """
+    def __init__(self, port: int, host: str = None, accept_rate: float = ACCEPT_RATE,
+                 accept_burst: int = ACCEPT_BURST, max_per_ip: int = MAX_PER_IP,
+                 max_pending: int = MAX_PENDING, handshake_timeout: float = HANDSHAKE_TIMEOUT):
+        self.port = port
+        self.host = host
+        self.accept_rate = accept_rate
+        self.accept_burst = accept_burst
+        self.max_per_ip = max_per_ip
+        self.max_pending = max_pending
+        self.handshake_timeout = handshake_timeout
+        self.torrents = {}  # info_hash -> handler
+        self.per_ip = Counter()  # Address -> connections open from it
+        self.pending = 0
+        self.refused = 0  # Connections closed by the limits above
+        self.server = None
+        self._handshaking = set()  # Tasks of the connections yet to handshake
+        self._tokens = float(accept_burst)
+        self._refilled = time.monotonic()
+
+    def register(self, info_hash: bytes, handler):
+        self.torrents[info_hash] = handler
+
+    def unregister(self, info_hash: bytes):
+        self.torrents.pop(info_hash, None)
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._accept, self.host, self.port)
+        # The port actually bound, e.g. when asked for any with 0
+        self.port = self.server.sockets[0].getsockname()[1]
+        logging.info(f'Listening for peers on port {self.port}')
+
+    async def stop(self):
+        if self.server is None:
+            return
+        self.server.close()
+        # Connections still handshaking must not outlive the listener; those
+        # handed to a torrent are the torrent's to close
+        handlers = list(self._handshaking)
+        for task in handlers:
+            task.cancel()
+        await asyncio.gather(*handlers, return_exceptions=True)
+        await self.server.wait_closed()
+        self.server = None
+
+    def _take_token(self) -> bool:
+        now = time.monotonic()
+        self._tokens = min(self.accept_burst,
+                           self._tokens + (now - self._refilled) * self.accept_rate)
+        self._refilled = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    async def _accept(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        if peer is None:
+            # The connection was reset before we got to it
+            writer.close()
+            return
+        peer = peer[:2]
+        ip = peer[0]
+        if not self._take_token():
+            reason = 'accept rate exceeded'
+        elif self.per_ip[ip] >= self.max_per_ip:
+            reason = 'too many connections from address'
+        elif self.pending >= self.max_pending:
+            reason = 'too many pending handshakes'
+        else:
+            reason = None
+        if reason:
+            logging.debug(f'Refusing incoming peer {ip}: {reason}')
+            self.refused += 1
+            writer.close()
+            return
+
+        task = asyncio.current_task()
+        self._handshaking.add(task)
+        self.per_ip[ip] += 1
+        try:
+            # The server logs an error for every handler task that ends
+            # cancelled, so a cancelled handler returns instead
+            try:
+                handshake = await self._read_handshake(reader, peer)
+            except asyncio.CancelledError:
+                writer.close()
+                return
+            finally:
+                self._handshaking.discard(task)
+            handler = self.torrents.get(handshake.info_hash) if handshake else None
+            if handler is None or not handler(peer, reader, writer, handshake):
+                if handshake:
+                    logging.debug(f'Refusing incoming peer {ip} for {handshake.info_hash.hex()}')
+                writer.close()
+                return
+            # Hold on to the address until the torrent closes the connection
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, OSError, asyncio.CancelledError):
+                pass
+        finally:
+            self.per_ip[ip] -= 1
+            if not self.per_ip[ip]:
+                del self.per_ip[ip]
+
+    async def _read_handshake(self, reader, peer):
+        """
+        :return The peer's `Handshake`, or None if it didn't send a valid
+                one in time
+        """
+        self.pending += 1
+        try:
+            data = await asyncio.wait_for(reader.readexactly(Handshake.length),
+                                          self.handshake_timeout)
+            handshake = Handshake.decode(data)
+            if not handshake:
+                raise ProtocolError('Unable receive and parse a handshake')
+            return handshake
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, OSError, ProtocolError) as e:
+            logging.debug(f'Dropping incoming peer {peer[0]}: {e!r}')
+            return None
+        finally:
+            self.pending -= 1
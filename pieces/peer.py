@@ -0,0 +1,52 @@
+import socket
+import struct
+
+_IPV4 = struct.Struct('!4sH')
+_IPV6 = struct.Struct('!16sH')
+
+
+def decode_peers(data, ipv6: bool = False):
+    """
+    Decodes a compact peer list: 6 byte entries of IPv4 address and port,
+    or 18 byte entries of IPv6 address and port (`peers6`, BEP 7).
+
+    The whole buffer is unpacked in one `struct.iter_unpack` pass and
+    de-duplicated on the raw entries before any address is formatted, so
+    lists of tens of thousands of peers (DHT, PEX, trackers) stay cheap.
+    A trailing partial entry and entries with port 0 are dropped.
+
+    :return A list of unique (host, port) tuples, in the order received
+    """
+    record = _IPV6 if ipv6 else _IPV4
+    view = memoryview(data).cast('B')
+    view = view[:len(view) - len(view) % record.size]
+    entries = dict.fromkeys(record.iter_unpack(view))
+    if ipv6:
+        ntop = socket.inet_ntop
+        family = socket.AF_INET6
+        return [(ntop(family, ip), port) for ip, port in entries if port]
+    ntoa = socket.inet_ntoa
+    return [(ntoa(ip), port) for ip, port in entries if port]
+
+
+def encode_peers(peers):
+    """
+    Encodes (host, port) tuples as compact peer lists.
+
+    :return A (peers, peers6) tuple of the IPv4 and IPv6 compact lists
+    """
+    ipv4 = []
+    ipv6 = []
+    for host, port in peers:
+        if ':' in host:
+            ipv6.append(_IPV6.pack(socket.inet_pton(socket.AF_INET6, host), port))
+        else:
+            ipv4.append(_IPV4.pack(socket.inet_aton(host), port))
+    return b''.join(ipv4), b''.join(ipv6)
+
+
+def merge_peers(*lists):
+    """
+    Merges lists of (host, port) tuples, dropping duplicates.
+    """
+    return list(dict.fromkeys(peer for peers in lists for peer in peers))
@@ -0,0 +1,235 @@
+import random
+from array import array
+from itertools import islice
+from pieces.bitset import Bitset
+
+
+class PiecePicker:
+    """
+    Rarest-first piece picker.
+
+    The picker keeps the number of peers having each piece, updated
+    incrementally as peers join, announce pieces and leave. Pieces we still
+    want are kept in buckets per priority and availability, so the rarest
+    piece of the highest priority a peer has is found by walking the buckets
+    from the rarest one instead of rescanning every peer's bitfield. Buckets
+    are lists with the position of every piece recorded, so moving a piece
+    between buckets is O(1) and walking a bucket never skips holes.
+
+    Seeds are not counted per piece: having every piece they do not change
+    which piece is rarest, so adding or removing a seed is O(1).
+
+    Until `random_first` pieces are downloaded, pieces are picked at random
+    instead, to quickly get complete pieces to trade.
+
+    `pick` can be restricted to a band of priorities, e.g. to leave the
+    most urgent pieces to the fastest peers.
+
+    Peer bitfields are `Bitset`s, so a peer having none of the wanted pieces
+    is ruled out with a single AND instead of walking the buckets.
+
+    Empty buckets are skipped with a `bytearray.find` over the buckets in
+    use, so a seed picks from the first non-empty bucket in O(1). A partial
+    peer needs a piece of the bucket it has: the first `SCAN_LIMIT` pieces
+    of a bucket are tested one by one, which finds one almost always, then
+    larger buckets get a `Bitset` of their pieces, kept up to date from
+    then on, which is ANDed with the peer's. A pick thus costs at most
+    `SCAN_LIMIT` tests and one AND of num_pieces bits (a C-level pass over
+    num_pieces / 30 words) per non-empty bucket walked, whatever the size
+    of the buckets, plus the AND ruling out peers with no wanted piece.
+    """
+    DEFAULT_PRIORITY = 1
+    RANDOM_PROBES = 32
+    SCAN_LIMIT = 64
+
+    def __init__(self, num_pieces: int, random_first: int = 4, rng=None):
+        self.num_pieces = num_pieces
+        self.random_first = random_first
+        self.availability = array('I', bytes(4 * num_pieces))
+        self.priority = bytearray([PiecePicker.DEFAULT_PRIORITY]) * num_pieces
+        self.seeds = set()
+        self.wanted = Bitset.full(num_pieces)
+        self._buckets = {PiecePicker.DEFAULT_PRIORITY: [list(range(num_pieces))]}
+        # priority -> 1 for every availability whose bucket is not empty
+        self._occupied = {PiecePicker.DEFAULT_PRIORITY: bytearray([1 if num_pieces else 0])}
+        self._position = array('I', range(num_pieces))
+        self._masks = {}  # (priority, availability) -> Bitset of the pieces of a large bucket
+        self._random = rng or random.Random()
+
+    def add_peer(self, peer_id, pieces: Bitset):
+        """
+        Counts the pieces of a newly connected peer.
+        """
+        if pieces.all():
+            self.seeds.add(peer_id)
+            return
+        for index in pieces:
+            self._change(index, 1)
+
+    def peer_has(self, peer_id, index: int):
+        """
+        Counts a piece announced by a peer with a `Have` message.
+        """
+        if peer_id not in self.seeds and 0 <= index < self.num_pieces:
+            self._change(index, 1)
+
+    def remove_peer(self, peer_id, pieces: Bitset):
+        """
+        Stops counting the pieces of a disconnected peer, `pieces` being the
+        pieces the peer had when it left.
+        """
+        if peer_id in self.seeds:
+            self.seeds.discard(peer_id)
+            return
+        for index in pieces:
+            self._change(index, -1)
+
+    def peer_availability(self, index: int) -> int:
+        """
+        The number of connected peers having the given piece.
+        """
+        return self.availability[index] + len(self.seeds)
+
+    def set_priority(self, start: int, end: int, priority: int):
+        """
+        Sets the priority of the pieces in `range(start, end)`. Pieces with a
+        higher priority are always picked first, pieces with priority 0 are
+        never picked.
+        """
+        for index in range(max(0, start), min(end, self.num_pieces)):
+            if self.wanted[index]:
+                self._discard(index)
+                self.priority[index] = priority
+                self._insert(index)
+            else:
+                self.priority[index] = priority
+
+    def pick(self, peer_id, has, downloaded: int = None,
+             min_priority: int = 1, max_priority: int = 255):
+        """
+        Picks the next piece to start downloading from the given peer and
+        stops offering it to other peers until it is restored.
+
+        :param peer_id: The peer to download the piece from
+        :param has: The peer's `Bitset`
+        :param downloaded: The number of pieces already downloaded, used to
+                           decide if pieces should be picked at random
+        :param min_priority: Only pick pieces with at least this priority...
+        :param max_priority: ...and at most this one
+        :return The piece index, or None if the peer has no wanted piece
+        """
+        if not has.intersects(self.wanted):
+            return None
+        priorities = [p for p in self._buckets if max(min_priority, 1) <= p <= max_priority]
+        index = None
+        if downloaded is not None and downloaded < self.random_first:
+            index = self._pick_random(peer_id, has, priorities)
+        if index is None:
+            index = self._pick_rarest(peer_id, has, priorities)
+        if index is not None:
+            self._discard(index)
+            self.wanted.discard(index)
+        return index
+
+    def restore(self, index: int):
+        """
+        Offers a previously picked piece again, e.g. when it failed the hash
+        check or was abandoned.
+        """
+        if not self.wanted[index]:
+            self.wanted.add(index)
+            self._insert(index)
+
+    def remove(self, index: int):
+        """
+        Stops offering a piece, e.g. when it is already available on disk.
+        """
+        if self.wanted[index]:
+            self._discard(index)
+            self.wanted.discard(index)
+
+    def _pick_rarest(self, peer_id, has, priorities):
+        seed = peer_id in self.seeds
+        for priority in sorted(priorities, reverse=True):
+            buckets = self._buckets[priority]
+            occupied = self._occupied[priority]
+            # Pieces no partial peer has are only available from seeds
+            availability = occupied.find(1, 0 if seed else 1)
+            while availability != -1:
+                bucket = buckets[availability]
+                if seed:
+                    return bucket[-1]
+                for index in islice(bucket, PiecePicker.SCAN_LIMIT):
+                    if has[index]:
+                        return index
+                if len(bucket) > PiecePicker.SCAN_LIMIT:
+                    index = self._mask(priority, availability).first_common(has)
+                    if index is not None:
+                        return index
+                availability = occupied.find(1, availability + 1)
+        return None
+
+    def _mask(self, priority: int, availability: int) -> Bitset:
+        mask = self._masks.get((priority, availability))
+        if mask is None:
+            mask = Bitset(self.num_pieces)
+            for index in self._buckets[priority][availability]:
+                mask.add(index)
+            self._masks[priority, availability] = mask
+        return mask
+
+    def _pick_random(self, peer_id, has, priorities):
+        priorities = [p for p in priorities if any(self._buckets[p])]
+        if not priorities:
+            return None
+        top = max(priorities)
+        for _ in range(PiecePicker.RANDOM_PROBES):
+            index = self._random.randrange(self.num_pieces)
+            if self.wanted[index] and self.priority[index] == top and has[index]:
+                return index
+        return None
+
+    def _change(self, index: int, delta: int):
+        if self.wanted[index]:
+            self._discard(index)
+            self.availability[index] += delta
+            self._insert(index)
+        else:
+            self.availability[index] += delta
+
+    def _insert(self, index: int):
+        priority = self.priority[index]
+        availability = self.availability[index]
+        buckets = self._buckets.get(priority)
+        if buckets is None:
+            buckets = self._buckets[priority] = [[]]
+            self._occupied[priority] = bytearray(1)
+        while len(buckets) <= availability:
+            buckets.append([])
+            self._occupied[priority].append(0)
+        bucket = buckets[availability]
+        if not bucket:
+            self._occupied[priority][availability] = 1
+        self._position[index] = len(bucket)
+        bucket.append(index)
+        if self._masks:
+            mask = self._masks.get((priority, availability))
+            if mask is not None:
+                mask.add(index)
+
+    def _discard(self, index: int):
+        priority = self.priority[index]
+        availability = self.availability[index]
+        bucket = self._buckets[priority][availability]
+        # Move the last piece of the bucket into the freed slot
+        position = self._position[index]
+        last = bucket.pop()
+        if last != index:
+            bucket[position] = last
+            self._position[last] = position
+        elif not bucket:
+            self._occupied[priority][availability] = 0
+        if self._masks:
+            mask = self._masks.get((priority, availability))
+            if mask is not None:
+                mask.discard(index)
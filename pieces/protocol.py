@@ -1,268 +1,1043 @@
-import struct
-import logging
-import bitstring
-
-REQUEST_SIZE = 2**14  # 16KB default request size for blocks
-
-class PeerMessage:
-    """
-    Base class for all PeerMessages in the protocol. Each message type will inherit from this.
-    """
-    KeepAlive = -1
-    Choke = 0
-    Unchoke = 1
-    Interested = 2
-    NotInterested = 3
-    Have = 4
-    BitField = 5
-    Request = 6
-    Piece = 7
-    Cancel = 8
-
-    @staticmethod
-    def decode(data: bytes):
-        """
-        Decodes the raw bytes into the corresponding PeerMessage object.
-        """
-        length = struct.unpack('>I', data[:4])[0]
-        if length == 0:
-            return KeepAlive()
-        message_id = struct.unpack('>b', data[4:5])[0]
-        if message_id == PeerMessage.Choke:
-            return Choke()
-        elif message_id == PeerMessage.Unchoke:
-            return Unchoke()
-        elif message_id == PeerMessage.Interested:
-            return Interested()
-        elif message_id == PeerMessage.NotInterested:
-            return NotInterested()
-        elif message_id == PeerMessage.Have:
-            return Have.decode(data)
-        elif message_id == PeerMessage.BitField:
-            return BitField.decode(data)
-        elif message_id == PeerMessage.Request:
-            return Request.decode(data)
-        elif message_id == PeerMessage.Piece:
-            return Piece.decode(data)
-        elif message_id == PeerMessage.Cancel:
-            return Cancel.decode(data)
-        else:
-            raise ValueError(f"Unknown message id: {message_id}")
-
-class KeepAlive(PeerMessage):
-    """
-    The KeepAlive message is just used to keep the connection alive. It has no payload.
-    Message format:
-        <len=0000>
-    """
-    def __str__(self):
-        return 'KeepAlive'
-
-class PeerConnection:
-    def __init__(self, host: str, port: int):
-        self.host = host
-        self.port = port
-        self.socket = None  # Initialize socket connection
-
-    def stop(self):
-        if self.socket:
-            self.socket.close()
-            self.socket = None
-
-    def connect(self):
-        # Code to establish a connection to the peer
-        pass
-
-    def send_message(self, message: PeerMessage):
-        # Code to send a message to the peer
-        try:
-            self.socket.sendall(message.encode())
-            logging.debug(f'Sent message: {message}')
-        except Exception as e:
-            logging.error(f'Error sending message: {e}')
-
-    def receive_message(self):
-        # Code to receive a message from the peer
-        try:
-            data = self.socket.recv(4096)  # Adjust buffer size as needed
-            message = PeerMessage.decode(data)
-            logging.debug(f'Received message: {message}')
-            return message
-        except Exception as e:
-            logging.error(f'Error receiving message: {e}')
-            return None
-
-class BitField(PeerMessage):
-    """
-    The BitField is a message with variable length where the payload is a
-    bit array representing all the bits a peer has (1) or does not have (0).
-    Message format:
-        <len=0001+X><id=5><bitfield>
-    """
-    def __init__(self, data):
-        self.bitfield = bitstring.BitArray(bytes=data)
-
-    def encode(self) -> bytes:
-        """
-        Encodes this object instance to the raw bytes representing the entire message.
-        """
-        bits_length = len(self.bitfield)
-        return struct.pack('>Ib' + str(bits_length) + 's',
-                           1 + bits_length,
-                           PeerMessage.BitField,
-                           self.bitfield.bytes)
-
-    @classmethod
-    def decode(cls, data: bytes):
-        message_length = struct.unpack('>I', data[:4])[0]
-        logging.debug('Decoding BitField of length: {length}'.format(length=message_length))
-        parts = struct.unpack('>Ib' + str(message_length - 1) + 's', data)
-        return cls(parts[2])
-
-    def __str__(self):
-        return 'BitField'
-
-class Interested(PeerMessage):
-    """
-    The interested message is fixed length and has no payload other than the message identifier.
-    Message format:
-        <len=0001><id=2>
-    """
-    def encode(self) -> bytes:
-        """
-        Encodes this object instance to the raw bytes representing the entire message.
-        """
-        return struct.pack('>Ib', 1, PeerMessage.Interested)
-
-    def __str__(self):
-        return 'Interested'
-
-class NotInterested(PeerMessage):
-    """
-    The not interested message is fixed length and has no payload other than the message identifier.
-    Message format:
-        <len=0001><id=3>
-    """
-    def encode(self) -> bytes:
-        return struct.pack('>Ib', 1, PeerMessage.NotInterested)
-
-    def __str__(self):
-        return 'NotInterested'
-
-class Choke(PeerMessage):
-    """
-    The choke message tells the other peer to stop sending request messages until unchoked.
-    Message format:
-        <len=0001><id=0>
-    """
-    def encode(self) -> bytes:
-        return struct.pack('>Ib', 1, PeerMessage.Choke)
-
-    def __str__(self):
-        return 'Choke'
-
-class Unchoke(PeerMessage):
-    """
-    Unchoking a peer allows that peer to start requesting pieces.
-    Message format:
-        <len=0001><id=1>
-    """
-    def encode(self) -> bytes:
-        return struct.pack('>Ib', 1, PeerMessage.Unchoke)
-
-    def __str__(self):
-        return 'Unchoke'
-
-class Have(PeerMessage):
-    """
-    Represents a piece successfully downloaded by the remote peer.
-    Message format:
-        <len=0005><id=4><index>
-    """
-    def __init__(self, index: int):
-        self.index = index
-
-    def encode(self) -> bytes:
-        return struct.pack('>IbI', 5, PeerMessage.Have, self.index)
-
-    @classmethod
-    def decode(cls, data: bytes):
-        logging.debug('Decoding Have of length: {length}'.format(length=len(data)))
-        index = struct.unpack('>IbI', data)[2]
-        return cls(index)
-
-    def __str__(self):
-        return f'Have(index={self.index})'
-
-class Request(PeerMessage):
-    """
-    The message used to request a block of a piece (i.e., a partial piece).
-    Message format:
-        <len=0013><id=6><index><begin><length>
-    """
-    def __init__(self, index: int, begin: int, length: int = REQUEST_SIZE):
-        self.index = index
-        self.begin = begin
-        self.length = length
-
-    def encode(self) -> bytes:
-        return struct.pack('>IbIII', 13, PeerMessage.Request, self.index, self.begin, self.length)
-
-    @classmethod
-    def decode(cls, data: bytes):
-        logging.debug('Decoding Request of length: {length}'.format(length=len(data)))
-        parts = struct.unpack('>IbIII', data)
-        return cls(parts[2], parts[3], parts[4])
-
-    def __str__(self):
-        return f'Request(index={self.index}, begin={self.begin}, length={self.length})'
-
-class Piece(PeerMessage):
-    """
-    Represents a block of data (partial piece).
-    Message format:
-        <len><id=7><index><begin><block>
-    """
-    length = 9
-
-    def __init__(self, index: int, begin: int, block: bytes):
-        self.index = index
-        self.begin = begin
-        self.block = block
-
-    def encode(self) -> bytes:
-        message_length = Piece.length + len(self.block)
-        return struct.pack('>IbII' + str(len(self.block)) + 's', message_length, PeerMessage.Piece, self.index, self.begin, self.block)
-
-    @classmethod
-    def decode(cls, data: bytes):
-        logging.debug('Decoding Piece of length: {length}'.format(length=len(data)))
-        length = struct.unpack('>I', data[:4])[0]
-        parts = struct.unpack('>IbII' + str(length - Piece.length) + 's', data[:length + 4])
-        return cls(parts[2], parts[3], parts[4])
-
-    def __str__(self):
-        return f'Piece(index={self.index}, begin={self.begin}, block_size={len(self.block)})'
-
-class Cancel(PeerMessage):
-    """
-    The cancel message is used to cancel a previously requested block.
-    Message format:
-         <len=0013><id=8><index><begin><length>
-    """
-    def __init__(self, index, begin, length: int = REQUEST_SIZE):
-        self.index = index
-        self.begin = begin
-        self.length = length
-
-    def encode(self) -> bytes:
-        return struct.pack('>IbIII', 13, PeerMessage.Cancel, self.index, self.begin, self.length)
-
-    @classmethod
-    def decode(cls, data: bytes):
-        logging.debug('Decoding Cancel of length: {length}'.format(length=len(data)))
-        parts = struct.unpack('>IbIII', data)
-        return cls(parts[2], parts[3], parts[4])
-
-    def __str__(self):
-        return f'Cancel(index={self.index}, begin={self.begin}, length={self.length})'
+import asyncio
+import contextlib
+import math
+import struct
+import logging
+import time
+import bitstring
+from collections import OrderedDict
+from pieces.exceptions import ProtocolError, TorrentError
+from pieces.extension import (EXTENDED_HANDSHAKE, LOCAL_EXTENSIONS, MAX_PEX_PEERS,
+                              PEX_MIN_INTERVAL, UT_PEX, ExtensionHandshake, PexMessage)
+
+REQUEST_SIZE = 2**14  # 16KB default request size for blocks
+CONNECT_TIMEOUT = 10  # Seconds to wait for a TCP connection and handshake
+MIN_REQUEST_WINDOW = 5
+MAX_REQUEST_WINDOW = 250
+MAX_UPLOAD_QUEUE = 250  # Requests from a single peer waiting to be served
+UPLOAD_BATCH = 16  # Blocks read from disk per trip to the disk thread pool
+EXTENSION_BIT = (5, 0x10)  # Reserved byte and bit advertising BEP 10 support
+EXTENSION_RESERVED = bytes(5) + bytes([0x10]) + bytes(2)
+
+class PeerMessage:
+    """
+    Base class for all PeerMessages in the protocol. Each message type will inherit from this.
+    """
+    KeepAlive = -1
+    Choke = 0
+    Unchoke = 1
+    Interested = 2
+    NotInterested = 3
+    Have = 4
+    BitField = 5
+    Request = 6
+    Piece = 7
+    Cancel = 8
+    Extended = 20
+
+    @staticmethod
+    def decode(data: bytes):
+        """
+        Decodes the raw bytes into the corresponding PeerMessage object.
+        """
+        length = struct.unpack('>I', data[:4])[0]
+        if length == 0:
+            return KeepAlive()
+        message_id = struct.unpack('>b', data[4:5])[0]
+        if message_id == PeerMessage.Choke:
+            return Choke()
+        elif message_id == PeerMessage.Unchoke:
+            return Unchoke()
+        elif message_id == PeerMessage.Interested:
+            return Interested()
+        elif message_id == PeerMessage.NotInterested:
+            return NotInterested()
+        elif message_id == PeerMessage.Have:
+            return Have.decode(data)
+        elif message_id == PeerMessage.BitField:
+            return BitField.decode(data)
+        elif message_id == PeerMessage.Request:
+            return Request.decode(data)
+        elif message_id == PeerMessage.Piece:
+            return Piece.decode(data)
+        elif message_id == PeerMessage.Cancel:
+            return Cancel.decode(data)
+        elif message_id == PeerMessage.Extended:
+            return Extended.decode(data)
+        else:
+            raise ValueError(f"Unknown message id: {message_id}")
+
+class Handshake:
+    """
+    The handshake message is the first message sent and then received from a
+    remote peer. It is not length prefixed like the other messages.
+    Message format:
+        <pstrlen=19><pstr=BitTorrent protocol><reserved=8 bytes><info_hash><peer_id>
+    """
+    length = 49 + 19
+
+    def __init__(self, info_hash: bytes, peer_id: bytes, reserved: bytes = bytes(8)):
+        if isinstance(info_hash, str):
+            info_hash = info_hash.encode('utf-8')
+        if isinstance(peer_id, str):
+            peer_id = peer_id.encode('utf-8')
+        self.info_hash = info_hash
+        self.peer_id = peer_id
+        self.reserved = reserved
+
+    @property
+    def supports_extensions(self) -> bool:
+        """
+        True if the extension protocol (BEP 10) is advertised.
+        """
+        byte, bit = EXTENSION_BIT
+        return bool(self.reserved[byte] & bit)
+
+    def encode(self) -> bytes:
+        return struct.pack('>B19s8s20s20s', 19, b'BitTorrent protocol',
+                           self.reserved, self.info_hash, self.peer_id)
+
+    @classmethod
+    def decode(cls, data: bytes):
+        logging.debug('Decoding Handshake of length: {length}'.format(length=len(data)))
+        if len(data) < cls.length:
+            return None
+        parts = struct.unpack('>B19s8s20s20s', data[:cls.length])
+        if parts[0] != 19 or parts[1] != b'BitTorrent protocol':
+            return None
+        return cls(info_hash=parts[3], peer_id=parts[4], reserved=parts[2])
+
+    def __str__(self):
+        return 'Handshake'
+
+class KeepAlive(PeerMessage):
+    """
+    The KeepAlive message is just used to keep the connection alive. It has no payload.
+    Message format:
+        <len=0000>
+    """
+    def encode(self) -> bytes:
+        return struct.pack('>I', 0)
+
+    def __str__(self):
+        return 'KeepAlive'
+
+class BitField(PeerMessage):
+    """
+    The BitField is a message with variable length where the payload is a
+    bit array representing all the bits a peer has (1) or does not have (0).
+    Message format:
+        <len=0001+X><id=5><bitfield>
+    """
+    def __init__(self, data):
+        self.bitfield = bitstring.BitArray(bytes=data)
+
+    def encode(self) -> bytes:
+        """
+        Encodes this object instance to the raw bytes representing the entire message.
+        """
+        data = self.bitfield.tobytes()
+        return struct.pack('>Ib' + str(len(data)) + 's',
+                           1 + len(data),
+                           PeerMessage.BitField,
+                           data)
+
+    @classmethod
+    def decode(cls, data: bytes):
+        message_length = struct.unpack('>I', data[:4])[0]
+        logging.debug('Decoding BitField of length: {length}'.format(length=message_length))
+        parts = struct.unpack('>Ib' + str(message_length - 1) + 's', data)
+        return cls(parts[2])
+
+    def __str__(self):
+        return 'BitField'
+
+class Interested(PeerMessage):
+    """
+    The interested message is fixed length and has no payload other than the message identifier.
+    Message format:
+        <len=0001><id=2>
+    """
+    def encode(self) -> bytes:
+        """
+        Encodes this object instance to the raw bytes representing the entire message.
+        """
+        return struct.pack('>Ib', 1, PeerMessage.Interested)
+
+    def __str__(self):
+        return 'Interested'
+
+class NotInterested(PeerMessage):
+    """
+    The not interested message is fixed length and has no payload other than the message identifier.
+    Message format:
+        <len=0001><id=3>
+    """
+    def encode(self) -> bytes:
+        return struct.pack('>Ib', 1, PeerMessage.NotInterested)
+
+    def __str__(self):
+        return 'NotInterested'
+
+class Choke(PeerMessage):
+    """
+    The choke message tells the other peer to stop sending request messages until unchoked.
+    Message format:
+        <len=0001><id=0>
+    """
+    def encode(self) -> bytes:
+        return struct.pack('>Ib', 1, PeerMessage.Choke)
+
+    def __str__(self):
+        return 'Choke'
+
+class Unchoke(PeerMessage):
+    """
+    Unchoking a peer allows that peer to start requesting pieces.
+    Message format:
+        <len=0001><id=1>
+    """
+    def encode(self) -> bytes:
+        return struct.pack('>Ib', 1, PeerMessage.Unchoke)
+
+    def __str__(self):
+        return 'Unchoke'
+
+class Have(PeerMessage):
+    """
+    Represents a piece successfully downloaded by the remote peer.
+    Message format:
+        <len=0005><id=4><index>
+    """
+    def __init__(self, index: int):
+        self.index = index
+
+    def encode(self) -> bytes:
+        return struct.pack('>IbI', 5, PeerMessage.Have, self.index)
+
+    @classmethod
+    def decode(cls, data: bytes):
+        logging.debug('Decoding Have of length: {length}'.format(length=len(data)))
+        index = struct.unpack('>IbI', data)[2]
+        return cls(index)
+
+    def __str__(self):
+        return f'Have(index={self.index})'
+
+class Request(PeerMessage):
+    """
+    The message used to request a block of a piece (i.e., a partial piece).
+    Message format:
+        <len=0013><id=6><index><begin><length>
+    """
+    def __init__(self, index: int, begin: int, length: int = REQUEST_SIZE):
+        self.index = index
+        self.begin = begin
+        self.length = length
+
+    def encode(self) -> bytes:
+        return struct.pack('>IbIII', 13, PeerMessage.Request, self.index, self.begin, self.length)
+
+    @classmethod
+    def decode(cls, data: bytes):
+        logging.debug('Decoding Request of length: {length}'.format(length=len(data)))
+        parts = struct.unpack('>IbIII', data)
+        return cls(parts[2], parts[3], parts[4])
+
+    def __str__(self):
+        return f'Request(index={self.index}, begin={self.begin}, length={self.length})'
+
+class Piece(PeerMessage):
+    """
+    Represents a block of data (partial piece).
+    Message format:
+        <len><id=7><index><begin><block>
+    """
+    length = 9
+
+    def __init__(self, index: int, begin: int, block: bytes):
+        self.index = index
+        self.begin = begin
+        self.block = block
+
+    @staticmethod
+    def allocate(index: int, begin: int, length: int):
+        """
+        Allocates an encoded Piece message for a block of the given length,
+        with the header filled in.
+
+        :return The message and a view of its block, to read the block into
+        """
+        message = bytearray(4 + Piece.length + length)
+        struct.pack_into('>IbII', message, 0, Piece.length + length, PeerMessage.Piece, index, begin)
+        return message, memoryview(message)[4 + Piece.length:]
+
+    def encode(self) -> bytes:
+        message_length = Piece.length + len(self.block)
+        return struct.pack('>IbII' + str(len(self.block)) + 's', message_length, PeerMessage.Piece, self.index, self.begin, self.block)
+
+    @classmethod
+    def decode(cls, data: bytes):
+        logging.debug('Decoding Piece of length: {length}'.format(length=len(data)))
+        length = struct.unpack('>I', data[:4])[0]
+        parts = struct.unpack('>IbII' + str(length - Piece.length) + 's', data[:length + 4])
+        return cls(parts[2], parts[3], parts[4])
+
+    def __str__(self):
+        return f'Piece(index={self.index}, begin={self.begin}, block_size={len(self.block)})'
+
+class Cancel(PeerMessage):
+    """
+    The cancel message is used to cancel a previously requested block.
+    Message format:
+         <len=0013><id=8><index><begin><length>
+    """
+    def __init__(self, index, begin, length: int = REQUEST_SIZE):
+        self.index = index
+        self.begin = begin
+        self.length = length
+
+    def encode(self) -> bytes:
+        return struct.pack('>IbIII', 13, PeerMessage.Cancel, self.index, self.begin, self.length)
+
+    @classmethod
+    def decode(cls, data: bytes):
+        logging.debug('Decoding Cancel of length: {length}'.format(length=len(data)))
+        parts = struct.unpack('>IbIII', data)
+        return cls(parts[2], parts[3], parts[4])
+
+    def __str__(self):
+        return f'Cancel(index={self.index}, begin={self.begin}, length={self.length})'
+
+class Extended(PeerMessage):
+    """
+    A message of the extension protocol (BEP 10). The extended message id
+    selects the extension, id 0 being the extension handshake. The payload
+    is interpreted by `pieces.extension`.
+    Message format:
+        <len=0002+X><id=20><extended id><payload>
+    """
+    def __init__(self, extended_id: int, payload: bytes = b''):
+        self.extended_id = extended_id
+        self.payload = payload
+
+    def encode(self) -> bytes:
+        return struct.pack('>IbB', 2 + len(self.payload), PeerMessage.Extended,
+                           self.extended_id) + self.payload
+
+    @classmethod
+    def decode(cls, data: bytes):
+        logging.debug('Decoding Extended of length: {length}'.format(length=len(data)))
+        length = struct.unpack('>I', data[:4])[0]
+        return cls(data[5], bytes(data[6:length + 4]))
+
+    def __str__(self):
+        return f'Extended(id={self.extended_id}, payload_size={len(self.payload)})'
+
+class MessageFramer:
+    """
+    Incremental framer splitting a stream of bytes into peer wire messages.
+
+    Received data is copied once into a reusable buffer and messages are
+    decoded in place with precompiled `struct.Struct` objects, without
+    slicing the buffer. Messages split across reads are kept until the rest
+    of the message has been fed.
+
+    The block of a decoded `Piece` message is a memoryview into the framer's
+    buffer and is only valid until the next call to `feed`. Consumers that
+    need to keep the data around must copy it (or write it out) before
+    feeding more data.
+    """
+    LENGTH = struct.Struct('>I')
+    INDEX = struct.Struct('>I')
+    BLOCK = struct.Struct('>III')
+    PIECE = struct.Struct('>II')
+    MAX_MESSAGE_LENGTH = 2**20 + 9  # Large enough for the largest bitfield
+    DEFAULT_CAPACITY = 256 * 1024
+
+    def __init__(self, capacity: int = DEFAULT_CAPACITY):
+        self._buffer = bytearray(capacity)
+        self._view = memoryview(self._buffer)
+        self._start = 0  # Offset of the first byte not yet parsed
+        self._end = 0  # Offset past the last byte fed
+        self.bytes_moved = 0  # Bytes moved around while compacting
+        self._decoders = {
+            PeerMessage.Choke: self._decode_choke,
+            PeerMessage.Unchoke: self._decode_unchoke,
+            PeerMessage.Interested: self._decode_interested,
+            PeerMessage.NotInterested: self._decode_not_interested,
+            PeerMessage.Have: self._decode_have,
+            PeerMessage.BitField: self._decode_bitfield,
+            PeerMessage.Request: self._decode_request,
+            PeerMessage.Piece: self._decode_piece,
+            PeerMessage.Cancel: self._decode_cancel,
+            PeerMessage.Extended: self._decode_extended,
+        }
+
+    def __len__(self):
+        return self._end - self._start
+
+    def __iter__(self):
+        message = self.next_message()
+        while message is not None:
+            yield message
+            message = self.next_message()
+
+    def feed(self, data):
+        """
+        Appends the received data to the buffer.
+        """
+        size = len(data)
+        if self._end + size > len(self._buffer):
+            self._make_room(size)
+        self._buffer[self._end:self._end + size] = data
+        self._end += size
+
+    def _make_room(self, size: int):
+        pending = self._end - self._start
+        tail = bytes(self._view[self._start:self._end])
+        if pending + size > len(self._buffer):
+            # Views handed out earlier keep referencing the old buffer
+            self._buffer = bytearray(max(pending + size, 2 * len(self._buffer)))
+            self._view = memoryview(self._buffer)
+        self._buffer[0:pending] = tail
+        self.bytes_moved += pending
+        self._start = 0
+        self._end = pending
+
+    def next_message(self):
+        """
+        Decodes the next complete message from the buffer.
+
+        :return The parsed message, or None if no complete message is buffered
+        """
+        available = self._end - self._start
+        if available < 4:
+            return None
+        length = self.LENGTH.unpack_from(self._buffer, self._start)[0]
+        if length > self.MAX_MESSAGE_LENGTH:
+            raise ProtocolError(f'Message too long: {length}')
+        if available < 4 + length:
+            return None
+
+        offset = self._start + 4
+        self._start = offset + length
+        if self._start == self._end:
+            # Everything is consumed, start over from the front of the buffer
+            self._start = self._end = 0
+        if length == 0:
+            return KeepAlive()
+
+        message_id = self._buffer[offset]
+        decoder = self._decoders.get(message_id)
+        if decoder is None:
+            raise ProtocolError(f'Unknown message id: {message_id}')
+        return decoder(offset + 1, length - 1)
+
+    @staticmethod
+    def _expect(name: str, length: int, expected: int):
+        if length != expected:
+            raise ProtocolError(f'Invalid {name} payload length: {length}')
+
+    def _decode_choke(self, offset: int, length: int):
+        self._expect('Choke', length, 0)
+        return Choke()
+
+    def _decode_unchoke(self, offset: int, length: int):
+        self._expect('Unchoke', length, 0)
+        return Unchoke()
+
+    def _decode_interested(self, offset: int, length: int):
+        self._expect('Interested', length, 0)
+        return Interested()
+
+    def _decode_not_interested(self, offset: int, length: int):
+        self._expect('NotInterested', length, 0)
+        return NotInterested()
+
+    def _decode_have(self, offset: int, length: int):
+        self._expect('Have', length, self.INDEX.size)
+        return Have(self.INDEX.unpack_from(self._buffer, offset)[0])
+
+    def _decode_bitfield(self, offset: int, length: int):
+        return BitField(bytes(self._view[offset:offset + length]))
+
+    def _decode_request(self, offset: int, length: int):
+        self._expect('Request', length, self.BLOCK.size)
+        return Request(*self.BLOCK.unpack_from(self._buffer, offset))
+
+    def _decode_cancel(self, offset: int, length: int):
+        self._expect('Cancel', length, self.BLOCK.size)
+        return Cancel(*self.BLOCK.unpack_from(self._buffer, offset))
+
+    def _decode_extended(self, offset: int, length: int):
+        if length < 1:
+            raise ProtocolError('Invalid Extended payload length: 0')
+        return Extended(self._buffer[offset], bytes(self._view[offset + 1:offset + length]))
+
+    def _decode_piece(self, offset: int, length: int):
+        if length < self.PIECE.size:
+            raise ProtocolError(f'Invalid Piece payload length: {length}')
+        index, begin = self.PIECE.unpack_from(self._buffer, offset)
+        block = self._view[offset + self.PIECE.size:offset + length]
+        return Piece(index, begin, block)
+
+class PeerStreamIterator:
+    """
+    The `PeerStreamIterator` is an async iterator that continuously reads from
+    the given stream reader and tries to parse valid BitTorrent messages from
+    that stream of bytes.
+
+    If the connection is dropped, something fails the iterator will abort by
+    raising the `StopAsyncIteration` error ending the calling iteration.
+
+    The block of a yielded `Piece` message is only valid until the iterator
+    is advanced again, see `MessageFramer`.
+
+    With a `TokenBucket` as `limit`, the bytes read are charged to it and
+    the next read waits for bandwidth; not reading lets TCP flow control
+    slow down the remote peer.
+    """
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, reader, initial: bytes = None, limit=None):
+        self.reader = reader
+        self.limit = limit
+        self.framer = MessageFramer()
+        if initial:
+            self.framer.feed(initial)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        # Read data from the socket. When we have enough data to parse, parse
+        # it and return the message. Until then keep reading from stream
+        while True:
+            message = self.parse()
+            if message:
+                return message
+            try:
+                data = await self.reader.read(PeerStreamIterator.CHUNK_SIZE)
+            except ConnectionResetError:
+                logging.debug('Connection closed by peer')
+                raise StopAsyncIteration()
+            if not data:
+                logging.debug('No data read from stream')
+                raise StopAsyncIteration()
+            self.framer.feed(data)
+            if self.limit:
+                await self.limit.acquire(len(data))
+
+    def parse(self):
+        """
+        Tries to parse protocol messages if there is enough bytes read in the
+        buffer.
+
+        :return The parsed message, or None if no message could be parsed
+        """
+        return self.framer.next_message()
+
+class RequestWindow:
+    """
+    Keeps track of the `Request` messages sent to a single peer that have not
+    been answered yet.
+
+    The number of requests allowed to be outstanding is sized to the measured
+    bandwidth-delay product of the connection: twice the observed download
+    rate times the smallest observed block round-trip, in blocks. The window
+    starts at `min_size` and is never allowed to grow past `max_size`.
+    """
+    RATE_INTERVAL = 1.0  # Seconds between download rate samples
+    SMOOTHING = 0.3
+
+    def __init__(self, min_size: int = MIN_REQUEST_WINDOW, max_size: int = MAX_REQUEST_WINDOW,
+                 block_size: int = REQUEST_SIZE):
+        if min_size < 1 or max_size < min_size:
+            raise ValueError(f'Invalid request window bounds: {min_size}-{max_size}')
+        self.min_size = min_size
+        self.max_size = max_size
+        self.block_size = block_size
+        self.outstanding = {}  # (piece index, block offset) -> (block, time sent)
+        self.min_rtt = None
+        self.rtt = None
+        self.rate = 0.0
+        self._sample_start = None
+        self._sample_bytes = 0
+
+    def __len__(self):
+        return len(self.outstanding)
+
+    @property
+    def size(self) -> int:
+        if self.min_rtt is None or not self.rate:
+            return self.min_size
+        bdp = 2 * self.rate * self.min_rtt
+        return max(self.min_size, min(self.max_size, math.ceil(bdp / self.block_size)))
+
+    @property
+    def available(self) -> int:
+        return max(0, self.size - len(self.outstanding))
+
+    def add(self, block, now: float = None):
+        now = time.monotonic() if now is None else now
+        self.outstanding[(block.piece, block.offset)] = (block, now)
+        if self._sample_start is None:
+            self._sample_start = now
+
+    def complete(self, index: int, begin: int, length: int, now: float = None):
+        """
+        Marks the request for the given block as answered and updates the
+        round-trip and rate estimates.
+
+        :return The request block, or None if the block was never requested
+        """
+        now = time.monotonic() if now is None else now
+        entry = self.outstanding.pop((index, begin), None)
+        if entry is None:
+            return None
+        block, sent = entry
+        rtt = now - sent
+        self.min_rtt = rtt if self.min_rtt is None else min(self.min_rtt, rtt)
+        self.rtt = rtt if self.rtt is None else \
+            (1 - self.SMOOTHING) * self.rtt + self.SMOOTHING * rtt
+
+        self._sample_bytes += length
+        elapsed = now - self._sample_start
+        if elapsed >= self.RATE_INTERVAL:
+            sample = self._sample_bytes / elapsed
+            self.rate = sample if not self.rate else \
+                (1 - self.SMOOTHING) * self.rate + self.SMOOTHING * sample
+            self._sample_start = now
+            self._sample_bytes = 0
+        return block
+
+    def discard(self, index: int, begin: int) -> bool:
+        """
+        Forgets the request for the given block without counting it as
+        answered, e.g. when it is cancelled.
+
+        :return True if the block was outstanding
+        """
+        return self.outstanding.pop((index, begin), None) is not None
+
+    def clear(self):
+        """
+        Drops all outstanding requests, returning the blocks that were pending.
+        """
+        blocks = [block for block, _ in self.outstanding.values()]
+        self.outstanding.clear()
+        self._sample_start = None
+        self._sample_bytes = 0
+        return blocks
+
+class PeerConnection:
+    """
+    A peer connection used to download and upload pieces.
+
+    The peer connection will consume one available peer from the given queue.
+    Based on the peer details the PeerConnection will try to open a connection
+    and perform a BitTorrent handshake.
+
+    After a successful handshake, the PeerConnection will be in a *choked*
+    state, not allowed to request any data from the remote peer. After sending
+    an interested message the PeerConnection will be waiting to get *unchoked*.
+
+    Once the remote peer unchoked us, we start requesting pieces, keeping up
+    to `RequestWindow.size` requests outstanding at all times so the link is
+    never idle waiting for a round-trip.
+
+    The remote peer is choked until a `Choker` decides to unchoke it. While
+    unchoked, its requests are queued and served in batches: blocks are read
+    straight into preallocated `Piece` messages on the disk thread pool.
+
+    Transfers can be rate limited with the `TokenBucket`s `upload_limit`
+    and `download_limit`.
+
+    Peers supporting the extension protocol (BEP 10) are sent an extension
+    handshake advertising ut_pex and the port we listen on, and the peers they tell us about through
+    peer exchange (BEP 11) are handed to `on_peers`.
+
+    If the connection with a remote peer drops, the PeerConnection will
+    consume the next available peer from off the queue and try to connect to
+    that one instead. Peers that connected to us are served with `accept`.
+    """
+    def __init__(self, queue, info_hash, peer_id, piece_manager, on_block_cb=None,
+                 min_window: int = MIN_REQUEST_WINDOW, max_window: int = MAX_REQUEST_WINDOW,
+                 on_peers=None, upload_limit=None, download_limit=None, port: int = None):
+        """
+        Constructs a PeerConnection and add it to the asyncio event-loop.
+
+        :param queue: The async Queue containing available peers, or None
+                      to connect to peers given to `run` only
+        :param info_hash: The SHA1 hash for the meta-data's info
+        :param peer_id: Our peer ID used to to identify ourselves
+        :param piece_manager: The manager responsible to determine which
+                              pieces to request
+        :param on_block_cb: The callback function to call when a block is
+                            received from the remote peer. The block data
+                            is a memoryview only valid during the call
+        :param min_window: The smallest number of outstanding requests
+        :param max_window: The largest number of outstanding requests
+        :param on_peers: The callback function to call with the list of
+                         (host, port) tuples learnt through peer exchange
+        :param upload_limit: An optional `TokenBucket` charged with the
+                             blocks we send
+        :param download_limit: An optional `TokenBucket` charged with the
+                               bytes we receive
+        :param port: The port we accept peer connections on, if any, sent
+                     in the extension handshake
+        """
+        self.my_state = set()
+        self.peer_state = set()
+        self.queue = queue
+        self.info_hash = info_hash
+        self.peer_id = peer_id.encode('utf-8') if isinstance(peer_id, str) else peer_id
+        self.remote_id = None
+        self.writer = None
+        self.reader = None
+        self.piece_manager = piece_manager
+        self.on_block_cb = on_block_cb
+        self.on_peers = on_peers
+        self.upload_limit = upload_limit
+        self.download_limit = download_limit
+        self.port = port
+        self.window = RequestWindow(min_window, max_window)
+        self.remote_extensions = {}  # Extension name -> the peer's message id
+        self._last_pex = None
+        self.connected = False  # Whether the current peer completed the handshake
+        self.downloaded = 0  # Block bytes received from the current peer
+        self.uploaded = 0  # Block bytes sent to the current peer
+        self.upload_queue = OrderedDict()  # (index, begin, length) of requests to serve
+        self._upload_task = None
+        # Without a queue the owner drives the connection through `run`
+        self.future = asyncio.ensure_future(self.start()) if queue is not None else None
+
+    async def start(self):
+        while 'stopped' not in self.my_state:
+            ip, port = await self.queue.get()
+            await self.run(ip, port)
+
+    async def run(self, ip, port, dial_limit=None, timeout: float = CONNECT_TIMEOUT):
+        """
+        Connects to a single peer and exchanges messages with it until the
+        connection drops.
+
+        :param dial_limit: An optional semaphore held while connecting and
+                           handshaking, bounding the half-open connections
+        :param timeout: Seconds allowed for each of the TCP connection and
+                        the handshake
+        """
+        logging.info(f'Got assigned peer with: {ip}')
+        await self._serve(self._connect(ip, port, dial_limit, timeout), ip)
+
+    async def accept(self, reader, writer, handshake: 'Handshake',
+                     timeout: float = CONNECT_TIMEOUT):
+        """
+        Exchanges messages with a peer that connected to us, once its
+        handshake has been read from `reader`, until the connection drops.
+        """
+        ip = writer.get_extra_info('peername', ('?',))[0]
+        logging.info(f'Accepted peer: {ip}')
+        await self._serve(self._answer(reader, writer, handshake, timeout), ip)
+
+    async def _connect(self, ip, port, dial_limit, timeout: float) -> bool:
+        async with dial_limit or contextlib.nullcontext():
+            self.reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(ip, port), timeout)
+            logging.info(f'Connection open to peer: {ip}')
+            return await asyncio.wait_for(self._handshake(), timeout)
+
+    async def _answer(self, reader, writer, handshake: 'Handshake', timeout: float) -> bool:
+        self.reader, self.writer = reader, writer
+        if handshake.info_hash != self.info_hash:
+            raise ProtocolError('Handshake with invalid info_hash')
+        if handshake.peer_id == self.peer_id:
+            raise ProtocolError('Connected to ourselves')
+        if handshake.peer_id in self.piece_manager.banned:
+            raise ProtocolError('Banned peer')
+        self.writer.write(Handshake(self.info_hash, self.peer_id, EXTENSION_RESERVED).encode())
+        await asyncio.wait_for(self.writer.drain(), timeout)
+        self.remote_id = handshake.peer_id
+        return handshake.supports_extensions
+
+    async def _serve(self, handshake, ip):
+        """
+        Runs a connection once `handshake`, an awaitable opening it and
+        returning whether the peer supports the extension protocol, is done.
+        """
+        self.connected = False
+        self.downloaded = 0
+        self.uploaded = 0
+        try:
+            supports_extensions = await handshake
+            self.connected = True
+            # Peers are choked until the choker unchokes them
+            self.peer_state.add('choked')
+
+            bitfield = self.piece_manager.bitfield()
+            if bitfield:
+                await self._send_message(BitField(bitfield))
+            if supports_extensions:
+                await self._send_message(Extended(EXTENDED_HANDSHAKE,
+                                                  ExtensionHandshake(port=self.port).encode()))
+
+            # The default state for a connection is that peer is not
+            # interested and we are choked. We let the peer know we're
+            # interested once it announces pieces we are missing
+            self.my_state.add('choked')
+
+            async for message in PeerStreamIterator(self.reader, limit=self.download_limit):
+                if 'stopped' in self.my_state:
+                    break
+                await self._handle_message(message)
+                await self._fill_window()
+        except ProtocolError:
+            logging.exception('Protocol error')
+        except (ConnectionRefusedError, asyncio.TimeoutError, OSError):
+            logging.warning(f'Unable to connect to peer: {ip}')
+        except asyncio.CancelledError:
+            self.cancel()
+            raise
+        except Exception:
+            logging.exception('An error occurred')
+        self.cancel()
+
+    async def _handle_message(self, message):
+        if isinstance(message, BitField):
+            self.piece_manager.add_peer(self.remote_id, message.bitfield)
+            await self._update_interest()
+        elif isinstance(message, Interested):
+            self.peer_state.add('interested')
+        elif isinstance(message, NotInterested):
+            self.peer_state.discard('interested')
+        elif isinstance(message, Choke):
+            self.my_state.add('choked')
+            # The remote peer discards our queued requests when choking us
+            self.window.clear()
+            self.piece_manager.release_requests(self.remote_id)
+        elif isinstance(message, Unchoke):
+            self.my_state.discard('choked')
+        elif isinstance(message, Have):
+            self.piece_manager.update_peer(self.remote_id, message.index)
+            await self._update_interest()
+        elif isinstance(message, KeepAlive):
+            pass
+        elif isinstance(message, Piece):
+            block = self.window.complete(message.index, message.begin, len(message.block))
+            self.downloaded += len(message.block)
+            if block is None:
+                logging.debug(f'Received unrequested block {message.index}:{message.begin}')
+            if self.on_block_cb:
+                self.on_block_cb(
+                    peer_id=self.remote_id,
+                    piece_index=message.index,
+                    block_offset=message.begin,
+                    data=message.block)
+        elif isinstance(message, Request):
+            self._queue_upload(message)
+        elif isinstance(message, Cancel):
+            self.upload_queue.pop((message.index, message.begin, message.length), None)
+        elif isinstance(message, Extended):
+            self._handle_extended(message)
+
+    def _handle_extended(self, message):
+        if message.extended_id == EXTENDED_HANDSHAKE:
+            handshake = ExtensionHandshake.decode(message.payload)
+            self.remote_extensions = handshake.extensions
+            logging.debug(f'Peer {self.remote_id} supports {handshake}')
+        elif message.extended_id == LOCAL_EXTENSIONS[UT_PEX]:
+            # Peers should send ut_pex at most once a minute, don't let a
+            # misbehaving one flood the peer queue
+            now = time.monotonic()
+            if self._last_pex is not None and now - self._last_pex < PEX_MIN_INTERVAL:
+                logging.debug(f'Ignoring early ut_pex from peer {self.remote_id}')
+                return
+            self._last_pex = now
+            pex = PexMessage.decode(message.payload)
+            logging.debug(f'Peer {self.remote_id} sent {pex}')
+            if pex.added and self.on_peers:
+                self.on_peers(pex.added[:MAX_PEX_PEERS])
+        else:
+            logging.debug(f'Ignoring unknown extended message {message.extended_id}')
+
+    def _queue_upload(self, request):
+        key = (request.index, request.begin, request.length)
+        if 'choked' in self.peer_state:
+            logging.debug(f'Ignoring request from choked peer {self.remote_id}')
+            return
+        if len(self.upload_queue) >= MAX_UPLOAD_QUEUE:
+            logging.debug(f'Upload queue of peer {self.remote_id} is full')
+            return
+        if not self.piece_manager.can_upload(*key):
+            logging.info(f'Ignoring invalid request {request} from peer {self.remote_id}')
+            return
+        self.upload_queue[key] = None
+        if self._upload_task is None or self._upload_task.done():
+            self._upload_task = asyncio.ensure_future(self._upload())
+
+    async def _upload(self):
+        """
+        Serves the queued requests until the queue is empty.
+        """
+        try:
+            while self.upload_queue and self.writer:
+                batch = [key for key, _ in zip(self.upload_queue, range(UPLOAD_BATCH))]
+                messages = [Piece.allocate(*key) for key in batch]
+                await self.piece_manager.read_blocks(
+                    [(index, begin, view) for (index, begin, _), (_, view) in zip(batch, messages)])
+                if self.upload_limit:
+                    # One wait per batch, for the blocks still wanted
+                    await self.upload_limit.acquire(
+                        sum(key[2] for key in batch if key in self.upload_queue))
+                for key, (message, _) in zip(batch, messages):
+                    # Requests cancelled, or dropped by choking the peer,
+                    # while the blocks were read are not sent
+                    if key not in self.upload_queue or not self.writer:
+                        continue
+                    del self.upload_queue[key]
+                    self.writer.write(message)
+                    self.uploaded += key[2]
+                    self.piece_manager.record_upload(key[2])
+                if self.writer:
+                    await self.writer.drain()
+        except (ConnectionError, OSError, TorrentError) as e:
+            logging.warning(f'Unable to upload to peer {self.remote_id}: {e}')
+            self.upload_queue.clear()
+
+    def choke(self):
+        """
+        Chokes the remote peer, dropping the requests it queued.
+        """
+        if self.writer and 'choked' not in self.peer_state:
+            self.peer_state.add('choked')
+            self.upload_queue.clear()
+            self.writer.write(Choke().encode())
+
+    def unchoke(self):
+        """
+        Allows the remote peer to request blocks.
+        """
+        if self.writer and 'choked' in self.peer_state:
+            self.peer_state.discard('choked')
+            self.writer.write(Unchoke().encode())
+
+    def cancel_request(self, block):
+        """
+        Cancels an outstanding request, e.g. when another peer sent the
+        block first in endgame mode.
+        """
+        if self.writer and self.window.discard(block.piece, block.offset):
+            self.writer.write(Cancel(block.piece, block.offset, block.length).encode())
+
+    def send_have(self, index: int):
+        """
+        Tells the remote peer that we have a new piece.
+        """
+        if self.writer:
+            self.writer.write(Have(index).encode())
+
+    def cancel(self):
+        """
+        Sends the cancel message to the remote peer and closes the connection.
+        """
+        logging.info(f'Closing peer {self.remote_id}')
+        if self.remote_id is not None:
+            self.piece_manager.remove_peer(self.remote_id)
+        self.window.clear()
+        self.remote_extensions = {}
+        self._last_pex = None
+        self.upload_queue.clear()
+        if self._upload_task:
+            self._upload_task.cancel()
+            self._upload_task = None
+        if self.writer:
+            self.writer.close()
+        self.writer = None
+        self.reader = None
+        self.remote_id = None
+        self.my_state.clear()
+        self.peer_state.clear()
+
+    def stop(self):
+        """
+        Stop this connection from the current peer (if a connection exist) and
+        from connecting to any new peer.
+        """
+        # Set state to stopped and cancel our future to break out of the loop.
+        # The rest of the cleanup will eventually be managed by loop calling
+        # `cancel`.
+        self.my_state.add('stopped')
+        if self.future and not self.future.done():
+            self.future.cancel()
+
+    async def _fill_window(self):
+        """
+        Sends as many `Request` messages as the request window allows.
+        """
+        if 'choked' in self.my_state or 'interested' not in self.my_state:
+            return
+        sent = False
+        # A snubbed peer gets a single request at a time until it delivers
+        limit = 1 if self.piece_manager.is_snubbed(self.remote_id) else self.window.size
+        while self.window.available and len(self.window) < limit:
+            block = self.piece_manager.next_request(self.remote_id)
+            if not block:
+                if not self.window:
+                    await self._update_interest()
+                break
+            message = Request(block.piece, block.offset, block.length)
+            logging.debug(f'Requesting block {block.offset} for piece {block.piece} '
+                          f'of {block.length} bytes from peer {self.remote_id}')
+            self.writer.write(message.encode())
+            self.window.add(block)
+            sent = True
+        if sent:
+            await self.writer.drain()
+
+    async def _handshake(self) -> bool:
+        """
+        Send the initial handshake to the remote peer and wait for the peer
+        to respond with its handshake.
+
+        :return True if the peer supports the extension protocol
+        """
+        self.writer.write(Handshake(self.info_hash, self.peer_id, EXTENSION_RESERVED).encode())
+        await self.writer.drain()
+
+        try:
+            data = await self.reader.readexactly(Handshake.length)
+        except asyncio.IncompleteReadError:
+            raise ProtocolError('Unable receive and parse a handshake')
+        response = Handshake.decode(data)
+        if not response:
+            raise ProtocolError('Unable receive and parse a handshake')
+        if not response.info_hash == self.info_hash:
+            raise ProtocolError('Handshake with invalid info_hash')
+
+        # Trackers hand out our own address along with the other peers
+        if response.peer_id == self.peer_id:
+            raise ProtocolError('Connected to ourselves')
+        if response.peer_id in self.piece_manager.banned:
+            raise ProtocolError('Banned peer')
+        self.remote_id = response.peer_id
+        logging.info('Handshake with peer was successful')
+        return response.supports_extensions
+
+    async def _update_interest(self):
+        """
+        Sends Interested or NotInterested when the remote peer starts or
+        stops having pieces we are missing.
+        """
+        interested = self.piece_manager.is_interested(self.remote_id)
+        if interested and 'interested' not in self.my_state:
+            await self._send_message(Interested())
+            self.my_state.add('interested')
+        elif not interested and 'interested' in self.my_state:
+            await self._send_message(NotInterested())
+            self.my_state.discard('interested')
+
+    async def _send_message(self, message):
+        logging.debug(f'Sending message: {message}')
+        self.writer.write(message.encode())
+        await self.writer.drain()
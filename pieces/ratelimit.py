@@ -0,0 +1,135 @@
+import asyncio
+import time
+from collections import deque
+
+RATE_INTERVAL = 0.05  # Seconds between releases of bandwidth to waiting transfers
+BURST_TIME = 0.1  # Seconds of transfer a bucket saves up while idle
+MIN_BURST = 2**16
+
+
+class TokenBucket:
+    """
+    Limits a transfer rate, in bytes per second, with a token bucket.
+
+    Buckets form a hierarchy, e.g. global -> torrent -> peer: a transfer is
+    charged to its bucket and then to every parent, waiting at each one
+    until it has tokens.
+
+    A transfer is granted once the bucket holds enough tokens for it, and
+    a transfer larger than the burst once the bucket is full, leaving it in
+    debt. Large socket reads and batches of blocks thus never stall, and
+    the rate evens out over the following transfers, which wait until the
+    debt is paid off.
+
+    Transfers that have to wait are queued in order, so peers moving
+    chunks of similar sizes (socket reads, upload batches) get equal shares.
+    A single timer per bucket releases them in batches every `interval`,
+    instead of every transfer sleeping and waking up on its own.
+
+    A bucket without a rate only counts the bytes and forwards to its
+    parent.
+    """
+    def __init__(self, rate: float = None, parent: 'TokenBucket' = None,
+                 burst: float = None, interval: float = RATE_INTERVAL):
+        self.parent = parent
+        self.interval = interval
+        self.transferred = 0
+        self.rate = None
+        self.burst = burst
+        self.tokens = 0.0
+        self._updated = time.monotonic()
+        self._waiters = deque()  # (amount, future), in arrival order
+        self._timer = None
+        self.set_rate(rate, burst)
+        if self.rate is not None:
+            self.tokens = self.burst
+
+    def set_rate(self, rate: float = None, burst: float = None):
+        """
+        Changes the rate, None or 0 meaning unlimited.
+        """
+        self._refill()
+        self.rate = rate or None
+        if self.rate is not None:
+            self.burst = burst or max(MIN_BURST, self.rate * BURST_TIME)
+            self.tokens = min(self.tokens, self.burst)
+        else:
+            self._release_all()
+
+    async def acquire(self, amount: int):
+        """
+        Waits until `amount` bytes may be transferred.
+        """
+        if self.rate is not None:
+            # Waiting transfers are served first
+            if self._waiters or not self._take(amount):
+                future = asyncio.get_running_loop().create_future()
+                self._waiters.append((amount, future))
+                self._schedule()
+                await future
+            else:
+                # Writes to a socket with room in its buffer don't yield, so
+                # let the other transfers take their turn before the next
+                # one rather than have the first draining the bucket
+                await asyncio.sleep(0)
+        self.transferred += amount
+        if self.parent is not None:
+            await self.parent.acquire(amount)
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _take(self, amount: int) -> bool:
+        self._refill()
+        if self.tokens < min(amount, self.burst):
+            return False
+        self.tokens -= amount
+        return True
+
+    def _schedule(self):
+        if self._timer is None:
+            # Wait at least an interval, to release many transfers at once
+            amount = min(self._waiters[0][0], self.burst)
+            delay = max(self.interval, (amount - self.tokens) / self.rate)
+            self._timer = asyncio.get_running_loop().call_later(delay, self._release)
+
+    def _release(self):
+        self._timer = None
+        waiters = self._waiters
+        while waiters:
+            amount, future = waiters[0]
+            if future.done():
+                # The waiting transfer was cancelled
+                waiters.popleft()
+                continue
+            if not self._take(amount):
+                break
+            waiters.popleft()
+            future.set_result(None)
+        if waiters:
+            self._schedule()
+
+    def _release_all(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self._waiters:
+            _, future = self._waiters.popleft()
+            if not future.done():
+                future.set_result(None)
+
+
+def limiter(rate: float = None, parent: TokenBucket = None):
+    """
+    A bucket limiting to `rate` under `parent`, skipping levels without a
+    rate.
+
+    :return The new bucket, `parent` if there is no rate, or None if
+            nothing needs limiting
+    """
+    if not rate:
+        return parent
+    return TokenBucket(rate, parent)
@@ -0,0 +1,138 @@
+import asyncio
+import logging
+import mmap
+import threading
+from hashlib import sha1
+
+BATCH_SIZE = 64 * 2**20  # Bytes of contiguous pieces hashed per job
+
+
+class Rechecker:
+    """
+    Verifies data already on disk against the piece hashes of a torrent.
+
+    Files are memory-mapped and pieces are hashed straight from the mapping
+    (across file boundaries when needed), without copying them into Python
+    memory. Runs of contiguous pieces are hashed as jobs on the verifier's
+    thread pool; hashlib releases the GIL, so the check is spread over every
+    core and bound by disk bandwidth.
+    """
+    def __init__(self, storage, hashes: bytes, verifier, progress=None):
+        """
+        :param storage: The `Storage` mapping pieces onto files
+        :param hashes: The concatenated 20 byte SHA1 digests of every piece
+        :param verifier: The `PieceVerifier` whose thread pool to hash on
+        :param progress: Called with (pieces checked, pieces to check) as
+                         the check progresses
+        """
+        self.storage = storage
+        self.hashes = hashes
+        self.verifier = verifier
+        self.progress = progress
+        self._maps = {}
+        self._lock = threading.Lock()
+        self._stopped = False
+
+    def _map(self, file: int):
+        with self._lock:
+            if file not in self._maps:
+                try:
+                    with open(self.storage.files[file].path, 'rb') as f:
+                        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    if hasattr(mapping, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+                        mapping.madvise(mmap.MADV_SEQUENTIAL)
+                except (OSError, ValueError):
+                    # Missing and empty files can't be mapped
+                    mapping = None
+                self._maps[file] = mapping
+            return self._maps[file]
+
+    def check_piece(self, index: int) -> bool:
+        """
+        Verifies a single piece against the data on disk (blocking).
+        """
+        hasher = sha1()
+        for file, position, size in self.storage.piece_spans(index):
+            mapping = self._map(file)
+            if mapping is None or position + size > len(mapping):
+                return False
+            with memoryview(mapping) as view, view[position:position + size] as chunk:
+                hasher.update(chunk)
+        return hasher.digest() == self.hashes[index * 20:(index + 1) * 20]
+
+    def check_batch(self, indexes):
+        """
+        Verifies the given pieces (blocking).
+
+        :return The indexes of the pieces that are complete on disk
+        """
+        verified = []
+        for index in indexes:
+            if self._stopped:
+                break
+            if self.check_piece(index):
+                verified.append(index)
+        return verified
+
+    def _batches(self, indexes):
+        per_batch = max(1, BATCH_SIZE // self.storage.piece_length)
+        batch = []
+        for index in indexes:
+            if batch and (len(batch) == per_batch or index != batch[-1] + 1):
+                yield batch
+                batch = []
+            batch.append(index)
+        if batch:
+            yield batch
+
+    async def run(self, indexes):
+        """
+        Verifies the given pieces in parallel.
+
+        :return The sorted indexes of the pieces that are complete on disk
+        """
+        indexes = sorted(indexes)
+        verified = []
+        done = 0
+        if self.progress:
+            self.progress(done, len(indexes))
+        # Keep every worker busy without queuing every batch at once
+        pending = {}
+        batches = iter(self._batches(indexes))
+        try:
+            while True:
+                while len(pending) < 2 * self.verifier.max_workers:
+                    batch = next(batches, None)
+                    if batch is None:
+                        break
+                    future = asyncio.ensure_future(self.verifier.run(self.check_batch, batch))
+                    pending[future] = len(batch)
+                if not pending:
+                    break
+                finished, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in finished:
+                    verified.extend(future.result())
+                    done += pending.pop(future)
+                if self.progress:
+                    self.progress(done, len(indexes))
+        finally:
+            # Jobs already running on the pool can't be cancelled: stop them
+            # at their next piece, and only unmap the files once none of
+            # them uses the mappings anymore, even if cancelled again
+            self._stopped = True
+            if pending:
+                jobs = asyncio.gather(*pending, return_exceptions=True)
+                jobs.add_done_callback(lambda _: self.close())
+                await asyncio.shield(jobs)
+            else:
+                self.close()
+        verified.sort()
+        logging.info(f'Recheck found {len(verified)} of {len(indexes)} pieces on disk')
+        return verified
+
+    def close(self):
+        with self._lock:
+            for mapping in self._maps.values():
+                if mapping is not None:
+                    mapping.close()
+            self._maps.clear()
@@ -0,0 +1,158 @@
+import logging
+import os
+import struct
+from collections import namedtuple
+from pieces.bitset import Bitset
+
+ResumeState = namedtuple('ResumeState', ['have', 'stale'])
+
+_HEADER = struct.Struct('>4sB20sII')
+_FILE = struct.Struct('>qq')
+_RECORD = struct.Struct('>IH')
+_RECORD_FILE = struct.Struct('>Iqq')
+
+
+def file_stat(path: str):
+    """
+    The (size, mtime in ns) of the given file, or (-1, -1) if it is missing.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return -1, -1
+    return stat.st_size, stat.st_mtime_ns
+
+
+class ResumeFile:
+    """
+    Fast-resume data for a single torrent: the pieces we have along with the
+    size and modification time of every file, so a restart can trust the
+    files on disk instead of downloading or hashing them again.
+
+    The file starts with a snapshot of that state and continues as an
+    append-only journal with one record per piece written, carrying the new
+    size and mtime of the files the piece touched. The journal is compacted
+    into a new snapshot every `COMPACT_EVERY` records and on close.
+
+    Snapshot format:
+        <magic=BWRS><version=1><info_hash><pieces><files>
+        [<size><mtime>] * files
+        <have bitfield>
+    Record format:
+        <index><files touched>[<file><size><mtime>] * files touched
+    """
+    MAGIC = b'BWRS'
+    VERSION = 1
+    COMPACT_EVERY = 1024
+
+    def __init__(self, path: str, info_hash: bytes, num_pieces: int, files):
+        self.path = path
+        self.info_hash = info_hash
+        self.num_pieces = num_pieces
+        self.files = list(files)
+        self.records = 0
+        self._journal = None
+
+    @classmethod
+    def for_torrent(cls, directory: str, info_hash: bytes, num_pieces: int, files):
+        return cls(os.path.join(directory, info_hash.hex() + '.resume'),
+                   info_hash, num_pieces, files)
+
+    def load(self):
+        """
+        Reads the resume data back.
+
+        :return A `ResumeState` with the pieces we have and the indexes of the
+                files that changed since they were recorded, or None if there
+                is no usable resume data
+        """
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+
+        try:
+            magic, version, info_hash, num_pieces, num_files = _HEADER.unpack_from(data, 0)
+        except struct.error:
+            logging.warning(f'Ignoring truncated resume data: {self.path}')
+            return None
+        if (magic, version, info_hash, num_pieces, num_files) != \
+                (self.MAGIC, self.VERSION, self.info_hash, self.num_pieces, len(self.files)):
+            logging.warning(f'Ignoring resume data for another torrent: {self.path}')
+            return None
+
+        offset = _HEADER.size
+        expected = []
+        bitfield_size = (num_pieces + 7) // 8
+        if len(data) < offset + num_files * _FILE.size + bitfield_size:
+            logging.warning(f'Ignoring truncated resume data: {self.path}')
+            return None
+        for _ in range(num_files):
+            expected.append(_FILE.unpack_from(data, offset))
+            offset += _FILE.size
+        have = Bitset.from_bytes(num_pieces, data[offset:offset + bitfield_size])
+        offset += bitfield_size
+
+        # Replay the journal, a record cut short by a crash is ignored
+        records = 0
+        while offset + _RECORD.size <= len(data):
+            index, touched = _RECORD.unpack_from(data, offset)
+            end = offset + _RECORD.size + touched * _RECORD_FILE.size
+            if end > len(data) or index >= num_pieces:
+                break
+            for position in range(offset + _RECORD.size, end, _RECORD_FILE.size):
+                file, size, mtime = _RECORD_FILE.unpack_from(data, position)
+                if file < num_files:
+                    expected[file] = (size, mtime)
+            have.add(index)
+            records += 1
+            offset = end
+        self.records = records
+
+        stale = {index for index, path in enumerate(self.files)
+                 if file_stat(path) != expected[index]}
+        return ResumeState(have, stale)
+
+    def record(self, index: int, files):
+        """
+        Appends a record for a piece just written to the given files.
+        """
+        if self._journal is None:
+            if not os.path.exists(self.path):
+                return
+            self._journal = open(self.path, 'ab')
+        stats = [(file,) + file_stat(self.files[file]) for file in files]
+        self._journal.write(_RECORD.pack(index, len(stats)) +
+                            b''.join(_RECORD_FILE.pack(*stat) for stat in stats))
+        self._journal.flush()
+        self.records += 1
+
+    def should_compact(self) -> bool:
+        return self.records >= self.COMPACT_EVERY
+
+    def compact(self, have: Bitset):
+        """
+        Replaces the journal with a snapshot of the current state.
+        """
+        self._close_journal()
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        snapshot = [_HEADER.pack(self.MAGIC, self.VERSION, self.info_hash,
+                                 self.num_pieces, len(self.files))]
+        snapshot.extend(_FILE.pack(*file_stat(path)) for path in self.files)
+        snapshot.append(have.tobytes())
+        temporary = self.path + '.tmp'
+        with open(temporary, 'wb') as f:
+            f.write(b''.join(snapshot))
+        os.replace(temporary, self.path)
+        self.records = 0
+
+    def _close_journal(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    def close(self):
+        self._close_journal()
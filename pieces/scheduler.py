@@ -0,0 +1,271 @@
+import asyncio
+import logging
+import time
+from pieces.protocol import CONNECT_TIMEOUT
+
+MAX_CONNECTIONS = 40
+MAX_HALF_OPEN = 8  # Connections allowed to be dialing or handshaking at once
+BACKOFF_BASE = 30  # Seconds before retrying an endpoint after its first failure
+MAX_BACKOFF = 30 * 60
+MAX_FAILURES = 5  # Consecutive failures before an endpoint is forgotten
+RECONNECT_DELAY = 60  # Seconds before redialing a peer that closed a working connection
+EVICT_INTERVAL = 60  # Seconds between looking for slow peers to replace
+EVICT_FRACTION = 0.05  # Share of the connections replaced each interval
+EVICT_BACKOFF = 10 * 60  # Seconds before redialing a peer replaced for being slow
+
+
+class PeerStats:
+    """
+    What we know about a peer endpoint across connections.
+    """
+    __slots__ = ('failures', 'next_attempt', 'downloaded', 'connected_time')
+
+    def __init__(self):
+        self.failures = 0
+        self.next_attempt = 0.0
+        self.downloaded = 0
+        self.connected_time = 0.0
+
+    @property
+    def rate(self):
+        """
+        The average download rate while connected, or None if the peer
+        was never connected to.
+        """
+        if not self.connected_time:
+            return None
+        return self.downloaded / self.connected_time
+
+    def sort_key(self):
+        # Proven fast peers first, then untried ones, then the ones that
+        # failed us the least
+        rate = self.rate
+        return (rate is None, -(rate or 0), self.failures)
+
+
+class ConnectionScheduler:
+    """
+    Keeps up to `max_connections` peers connected at all times.
+
+    Candidates are dialed as soon as a connection slot is free, with at most
+    `max_half_open` connections in their connect and handshake phase at once
+    so a list full of unreachable peers doesn't stall the healthy ones.
+
+    Every endpoint is scored by its download rate over all connections. The
+    best candidates are dialed first, endpoints that fail are retried with
+    an exponential backoff and dropped after `MAX_FAILURES` failures in a row.
+    When every slot is taken and candidates are waiting, the slowest
+    connections are regularly closed to make room for them.
+
+    Peers that connected to us are handed over with `accept` and count
+    against the same limit. Hosts are banned with `ban`: their connections
+    are closed, and they are neither dialed nor accepted again.
+
+    Connections are created by `factory`, returning an object with async
+    `run(host, port, dial_limit, timeout)` and `accept(reader, writer,
+    handshake, timeout)` methods for one session and the `connected` and
+    `downloaded` attributes, like `PeerConnection`. Several schedulers can
+    share one `dial_limit` semaphore to bound half-open connections
+    globally.
+    """
+    def __init__(self, factory, max_connections: int = MAX_CONNECTIONS,
+                 max_half_open: int = MAX_HALF_OPEN, connect_timeout: float = CONNECT_TIMEOUT,
+                 evict_interval: float = EVICT_INTERVAL, dial_limit: asyncio.Semaphore = None):
+        if max_connections < 1 or max_half_open < 1:
+            raise ValueError('At least one connection must be allowed')
+        self.factory = factory
+        self.max_connections = max_connections
+        self.connect_timeout = connect_timeout
+        self.evict_interval = evict_interval
+        self.peers = {}  # (host, port) -> PeerStats
+        self.active = {}  # (host, port) -> (connection, task)
+        self.dial_limit = dial_limit or asyncio.Semaphore(max_half_open)
+        self._wakeup = asyncio.Event()
+        self._evicted = set()
+        self.banned = set()  # Hosts never to connect to again
+        self._snapshots = {}  # (host, port) -> bytes downloaded at the last eviction check
+        self._task = None
+
+    def __len__(self):
+        return len(self.active)
+
+    def add(self, peers):
+        """
+        Adds (host, port) candidates. Endpoints already known keep their
+        history and backoff.
+        """
+        added = False
+        for peer in peers:
+            if peer not in self.peers and peer[0] not in self.banned:
+                self.peers[peer] = PeerStats()
+                added = True
+        if added:
+            self._wakeup.set()
+
+    def set_limit(self, max_connections: int):
+        """
+        Changes the number of connections to keep. Going below the current
+        number closes no connection, sessions ending are just not replaced.
+        """
+        self.max_connections = max_connections
+        self._wakeup.set()
+
+    def demand(self) -> int:
+        """
+        The number of connections that could be used right now.
+        """
+        return len(self.active) + len(self.candidates())
+
+    def accept(self, peer, reader, writer, handshake) -> bool:
+        """
+        Runs a connection for a peer that connected to us, if a connection
+        slot is free.
+
+        :return False if the connection was refused
+        """
+        if len(self.active) >= self.max_connections or peer in self.active:
+            return False
+        if peer[0] in self.banned:
+            return False
+        connection = self.factory()
+        self._start_session(peer, connection, connection.accept(
+            reader, writer, handshake, self.connect_timeout))
+        return True
+
+    def ban(self, host):
+        """
+        Closes the connections to the given host and forgets its endpoints.
+        """
+        self.banned.add(host)
+        for peer in [peer for peer in self.peers if peer[0] == host]:
+            del self.peers[peer]
+        for peer, (connection, task) in list(self.active.items()):
+            if peer[0] == host:
+                logging.info(f'Disconnecting banned peer {peer[0]}:{peer[1]}')
+                self._evicted.add(peer)
+                connection.stop()
+                task.cancel()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        for connection, task in list(self.active.values()):
+            connection.stop()
+            task.cancel()
+
+    def connections(self):
+        """
+        The connections that completed their handshake.
+        """
+        return [connection for connection, _ in self.active.values() if connection.connected]
+
+    def candidates(self, now: float = None):
+        """
+        The endpoints that may be dialed now, best first.
+        """
+        now = time.monotonic() if now is None else now
+        due = [(stats.sort_key(), peer) for peer, stats in self.peers.items()
+               if peer not in self.active and stats.next_attempt <= now]
+        due.sort()
+        return [peer for _, peer in due]
+
+    async def _run(self):
+        last_evict = time.monotonic()
+        # wait_for may swallow the cancellation from `stop` when a session
+        # ends at the same time, so the loop also checks it is still wanted
+        while self._task is asyncio.current_task():
+            self._wakeup.clear()
+            now = time.monotonic()
+            free = self.max_connections - len(self.active)
+            waiting = self.candidates(now)
+            for peer in waiting[:free]:
+                self._launch(peer)
+
+            if now - last_evict >= self.evict_interval:
+                if len(waiting) > free:
+                    self._evict_slowest(now - last_evict)
+                self._snapshots = {peer: _transferred(connection)
+                                   for peer, (connection, _) in self.active.items()}
+                last_evict = now
+
+            # Sleep until a candidate's backoff expires, a session ends, new
+            # peers arrive or it is time to look for slow peers again
+            wake = last_evict + self.evict_interval
+            pending = [stats.next_attempt for peer, stats in self.peers.items()
+                       if peer not in self.active and stats.next_attempt > now]
+            if pending:
+                wake = min(wake, min(pending))
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), max(0.0, wake - now))
+            except asyncio.TimeoutError:
+                pass
+
+    def _launch(self, peer):
+        connection = self.factory()
+        host, port = peer
+        self._start_session(peer, connection, connection.run(
+            host, port, self.dial_limit, self.connect_timeout))
+
+    def _start_session(self, peer, connection, run):
+        task = asyncio.ensure_future(self._session(peer, connection, run))
+        self.active[peer] = (connection, task)
+
+    async def _session(self, peer, connection, run):
+        started = time.monotonic()
+        try:
+            await run
+        except asyncio.CancelledError:
+            if peer not in self._evicted:
+                raise
+        finally:
+            del self.active[peer]
+            self._snapshots.pop(peer, None)
+            self._session_ended(peer, connection, time.monotonic() - started)
+            self._wakeup.set()
+
+    def _session_ended(self, peer, connection, duration: float):
+        stats = self.peers.get(peer)
+        evicted = peer in self._evicted
+        self._evicted.discard(peer)
+        if stats is None:
+            return
+        now = time.monotonic()
+        if connection.connected:
+            stats.failures = 0
+            stats.downloaded += connection.downloaded
+            stats.connected_time += duration
+            # Slow peers sit out longer so they don't just push out the
+            # next slowest peer as soon as they are due again
+            stats.next_attempt = now + (EVICT_BACKOFF if evicted else RECONNECT_DELAY)
+            return
+        stats.failures += 1
+        if stats.failures >= MAX_FAILURES:
+            logging.debug(f'Giving up on peer {peer[0]}:{peer[1]}')
+            del self.peers[peer]
+            return
+        stats.next_attempt = now + min(MAX_BACKOFF, BACKOFF_BASE * 2 ** (stats.failures - 1))
+
+    def _evict_slowest(self, elapsed: float):
+        """
+        Closes the connections that transferred the least, in either
+        direction, of those that were already up at the previous check.
+        """
+        rates = sorted(
+            ((_transferred(connection) - self._snapshots[peer]) / elapsed, peer)
+            for peer, (connection, _) in self.active.items()
+            if connection.connected and peer in self._snapshots)
+        count = max(1, int(len(self.active) * EVICT_FRACTION))
+        for rate, peer in rates[:count]:
+            logging.info(f'Replacing slow peer {peer[0]}:{peer[1]} ({rate:.0f} B/s)')
+            connection, task = self.active[peer]
+            self._evicted.add(peer)
+            task.cancel()
+
+
+def _transferred(connection) -> int:
+    return connection.downloaded + connection.uploaded
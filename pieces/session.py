@@ -0,0 +1,305 @@
+import asyncio
+import concurrent.futures
+import logging
+import os
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from pieces.cache import CACHE_SIZE, PieceCache
+from pieces.choker import UPLOAD_SLOTS
+from pieces.client import MAX_HALF_OPEN, RESUME_DIRECTORY, TorrentClient
+from pieces.listener import Listener
+from pieces.ratelimit import limiter
+from pieces.storage import MAX_DISK_WORKERS, MAX_OPEN_FILES, FilePool
+from pieces.tracker import Tracker
+
+LISTEN_PORT = 6881
+MAX_ACTIVE = 100  # Torrents running at once, the others wait their turn
+MAX_CONNECTIONS = 500  # Peer connections of all torrents together
+MAX_UPLOAD_SLOTS = 4 * UPLOAD_SLOTS  # Peers unchoked for their rate, all torrents together
+REBALANCE_INTERVAL = 10  # Seconds between sharing out the limits again
+FILE_IDLE_TIME = 60  # Seconds files without disk I/O are kept open
+
+
+def fair_shares(total: int, demands):
+    """
+    Splits `total` between consumers max-min fairly: nobody gets more than
+    its demand, and what one doesn't need is split between the others.
+
+    :param demands: A dict of consumer -> the amount it could use
+    :return A dict of consumer -> its share
+    """
+    shares = {}
+    remaining = len(demands)
+    for key, demand in sorted(demands.items(), key=lambda item: item[1]):
+        shares[key] = min(demand, total // remaining)
+        total -= shares[key]
+        remaining -= 1
+    return shares
+
+
+class FairExecutor:
+    """
+    Runs the jobs of many owners on one bounded thread pool, taking turns
+    between owners (round-robin) so one with a deep backlog doesn't hold
+    back the others.
+
+    Every owner submits to its own `lane`, a `concurrent.futures.Executor`
+    that can be handed to `loop.run_in_executor`. Jobs are queued in their
+    lane and at most `max_workers` jobs run at once.
+    """
+    def __init__(self, max_workers: int, thread_name_prefix: str = ''):
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix=thread_name_prefix)
+        self._ready = OrderedDict()  # Lanes with queued jobs, next turn first
+        self._running = 0
+        self._lock = threading.Lock()
+
+    def lane(self) -> '_Lane':
+        return _Lane(self)
+
+    def _submit(self, lane, job):
+        with self._lock:
+            lane.queue.append(job)
+            self._ready[lane] = None
+        self._dispatch()
+
+    def _dispatch(self):
+        with self._lock:
+            jobs = []
+            while self._ready and self._running + len(jobs) < self.max_workers:
+                lane, _ = self._ready.popitem(last=False)
+                jobs.append(lane.queue.popleft())
+                if lane.queue:
+                    self._ready[lane] = None
+            self._running += len(jobs)
+        for job in jobs:
+            self._executor.submit(self._run, job)
+
+    def _run(self, job):
+        future, fn, args, kwargs = job
+        try:
+            if future.set_running_or_notify_cancel():
+                try:
+                    result = fn(*args, **kwargs)
+                except BaseException as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+        finally:
+            with self._lock:
+                self._running -= 1
+            self._dispatch()
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
+
+
+class _Lane(Executor):
+    """
+    The jobs of one owner of a `FairExecutor`. Shutting a lane down only
+    waits for its own jobs.
+    """
+    def __init__(self, parent: FairExecutor):
+        self.parent = parent
+        self.max_workers = parent.max_workers
+        self.queue = deque()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._shutdown = False
+
+    def submit(self, fn, *args, **kwargs):
+        if self._shutdown:
+            raise RuntimeError('cannot schedule new futures after shutdown')
+        future = Future()
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+        self.parent._submit(self, (future, fn, args, kwargs))
+        return future
+
+    def _done(self, future):
+        with self._lock:
+            self._pending.discard(future)
+
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False):
+        self._shutdown = True
+        with self._lock:
+            pending = list(self._pending)
+        if cancel_futures:
+            for future in pending:
+                future.cancel()
+        if wait:
+            concurrent.futures.wait(pending)
+
+
+class Session:
+    """
+    Runs many torrents on one event loop.
+
+    Incoming peers connect to a single `Listener` and are handed to the
+    torrent whose info hash they send in their handshake.
+
+    Up to `max_active` torrents run at once, in the order they were added;
+    the others only keep their metainfo until a running torrent finishes.
+    Running torrents share:
+
+    * `max_connections` peer connections and `max_upload_slots` upload
+      slots, shared out max-min fairly every `REBALANCE_INTERVAL`
+      according to how many peers each torrent has to connect to and how
+      many of its peers are interested
+    * the semaphore bounding half-open connections
+    * one `PieceCache` and its byte budget
+    * the `upload_rate` and `download_rate` bandwidth limits, under which
+      every torrent may have its own
+    * the disk and hashing thread pools, which take turns between torrents
+      (see `FairExecutor`)
+    * a `FilePool` keeping at most `max_open_files` files open, closing
+      the files of torrents with no disk I/O for `FILE_IDLE_TIME`
+
+    A torrent that is idle thus costs no threads and no file descriptors.
+    """
+    def __init__(self, port: int = LISTEN_PORT, host: str = None,
+                 resume_dir: str = RESUME_DIRECTORY, dht=None,
+                 max_active: int = MAX_ACTIVE, max_connections: int = MAX_CONNECTIONS,
+                 max_half_open: int = MAX_HALF_OPEN, max_upload_slots: int = MAX_UPLOAD_SLOTS,
+                 cache_size: int = CACHE_SIZE, disk_workers: int = MAX_DISK_WORKERS,
+                 hash_workers: int = None, max_open_files: int = MAX_OPEN_FILES,
+                 upload_rate: int = None, download_rate: int = None):
+        self.listener = Listener(port, host)
+        self.resume_dir = resume_dir
+        self.dht = dht
+        self.max_active = max_active
+        self.max_connections = max_connections
+        self.max_upload_slots = max_upload_slots
+        self.torrents = {}  # info_hash -> (torrent, seed, force_recheck, upload_rate, download_rate)
+        self.queued = deque()  # Info hashes of the torrents waiting to run
+        self.clients = {}  # info_hash -> running TorrentClient
+        self.cache = PieceCache(cache_size)
+        self.dial_limit = asyncio.Semaphore(max_half_open)
+        self.disk = FairExecutor(disk_workers, 'storage')
+        self.hashing = FairExecutor(hash_workers or os.cpu_count() or 1, 'verify')
+        self.files = FilePool(max_open_files)
+        # Bandwidth limits of all torrents together, in bytes per second
+        self.upload_limit = limiter(upload_rate)
+        self.download_limit = limiter(download_rate)
+        self.started = False
+        self._tasks = {}  # info_hash -> task running the client
+        self._rebalance_task = None
+
+    @property
+    def port(self) -> int:
+        return self.listener.port
+
+    def add(self, torrent, seed: bool = False, force_recheck: bool = False,
+            upload_rate: int = None, download_rate: int = None):
+        """
+        Adds a torrent, started as soon as fewer than `max_active` run.
+
+        :param upload_rate: The upload limit of the torrent in bytes per
+                            second, within the session's
+        :param download_rate: The download limit of the torrent in bytes
+                              per second, within the session's
+        """
+        info_hash = torrent.info_hash
+        if info_hash in self.torrents:
+            return
+        self.torrents[info_hash] = (torrent, seed, force_recheck, upload_rate, download_rate)
+        self.queued.append(info_hash)
+        if self.started:
+            self._activate()
+
+    def remove(self, info_hash: bytes):
+        """
+        Stops a torrent and forgets it.
+        """
+        self.torrents.pop(info_hash, None)
+        try:
+            self.queued.remove(info_hash)
+        except ValueError:
+            pass
+        task = self._tasks.get(info_hash)
+        if task:
+            task.cancel()
+
+    async def start(self):
+        """
+        Starts listening for peers and running the torrents.
+        """
+        await self.listener.start()
+        Tracker.http_pool.acquire()
+        self.started = True
+        self._rebalance_task = asyncio.ensure_future(self._rebalance_loop())
+        self._activate()
+
+    async def stop(self):
+        started, self.started = self.started, False
+        await self.listener.stop()
+        if self._rebalance_task:
+            self._rebalance_task.cancel()
+            self._rebalance_task = None
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if started:
+            await Tracker.http_pool.release()
+        self.disk.shutdown()
+        self.hashing.shutdown()
+        self.files.close()
+
+    def _activate(self):
+        while self.queued and len(self.clients) < self.max_active:
+            info_hash = self.queued.popleft()
+            torrent, seed, force_recheck, upload_rate, download_rate = self.torrents[info_hash]
+            client = TorrentClient(
+                torrent, self.resume_dir, force_recheck, self.dht, seed=seed,
+                cache=self.cache, dial_limit=self.dial_limit, port=self.listener.port,
+                disk_executor=self.disk.lane(), hash_executor=self.hashing.lane(),
+                files=self.files,
+                upload_limit=limiter(upload_rate, self.upload_limit),
+                download_limit=limiter(download_rate, self.download_limit))
+            self.clients[info_hash] = client
+            self.listener.register(info_hash, client.accept)
+            self._tasks[info_hash] = asyncio.ensure_future(self._run(info_hash, client))
+        self._rebalance()
+
+    async def _run(self, info_hash: bytes, client: TorrentClient):
+        try:
+            await client.run()
+        except asyncio.CancelledError:
+            client.stop()
+            raise
+        except Exception:
+            logging.exception(f'Torrent {info_hash.hex()} failed')
+            client.stop()
+        finally:
+            del self.clients[info_hash]
+            self.listener.unregister(info_hash)
+            del self._tasks[info_hash]
+            if self.started:
+                self._activate()
+
+    async def _rebalance_loop(self):
+        while True:
+            await asyncio.sleep(REBALANCE_INTERVAL)
+            self._rebalance()
+            self.files.close_idle(FILE_IDLE_TIME)
+
+    def _rebalance(self):
+        """
+        Shares the connections and upload slots out between the running
+        torrents.
+        """
+        clients = self.clients
+        if not clients:
+            return
+        # Every torrent gets a connection, at least to accept a peer
+        connections = fair_shares(self.max_connections, {
+            info_hash: max(1, client.scheduler.demand()) for info_hash, client in clients.items()})
+        slots = fair_shares(self.max_upload_slots, {
+            info_hash: sum('interested' in c.peer_state for c in client.scheduler.connections())
+            for info_hash, client in clients.items()})
+        for info_hash, client in clients.items():
+            client.scheduler.set_limit(connections[info_hash])
+            client.choker.slots = slots[info_hash]
@@ -0,0 +1,151 @@
+import math
+from array import array
+from pieces.bitset import Bitset
+from pieces.protocol import REQUEST_SIZE
+
+
+class DownloadState:
+    """
+    The compact download state of every piece and block of a torrent.
+
+    Block statuses are kept in a single `bytearray` indexed by
+    `piece * blocks_per_piece + block`, next to a status byte and a counter
+    of retrieved blocks per piece and a bitmap of the pieces we have. No
+    Python object is created per block, and completion checks are O(1).
+    """
+    Missing = 0
+    Pending = 1
+    Retrieved = 2
+
+    def __init__(self, total_size: int, piece_length: int, block_size: int = REQUEST_SIZE):
+        self.total_size = total_size
+        self.piece_length = piece_length
+        self.block_size = block_size
+        self.num_pieces = math.ceil(total_size / piece_length)
+        self.blocks_per_piece = math.ceil(piece_length / block_size)
+
+        last_length = total_size - (self.num_pieces - 1) * piece_length
+        self.last_piece_length = last_length
+        self.last_piece_blocks = math.ceil(last_length / block_size)
+
+        self.blocks = bytearray(self.num_pieces * self.blocks_per_piece)
+        self.pieces = bytearray(self.num_pieces)
+        self.retrieved = array('I', bytes(4 * self.num_pieces))
+        self.have = Bitset(self.num_pieces)
+        self.have_count = 0
+
+    @property
+    def complete(self) -> bool:
+        return self.have_count == self.num_pieces
+
+    @property
+    def bytes_have(self) -> int:
+        if self.num_pieces and self.has(self.num_pieces - 1):
+            return (self.have_count - 1) * self.piece_length + self.last_piece_length
+        return self.have_count * self.piece_length
+
+    def piece_size(self, index: int) -> int:
+        if index == self.num_pieces - 1:
+            return self.last_piece_length
+        return self.piece_length
+
+    def block_count(self, index: int) -> int:
+        if index == self.num_pieces - 1:
+            return self.last_piece_blocks
+        return self.blocks_per_piece
+
+    def block_length(self, index: int, block: int) -> int:
+        return min(self.block_size, self.piece_size(index) - block * self.block_size)
+
+    def block_index(self, index: int, offset: int):
+        """
+        Translates a block offset within a piece to the block number, or None
+        if the offset does not start a block of that piece.
+        """
+        if not 0 <= index < self.num_pieces or offset % self.block_size:
+            return None
+        block = offset // self.block_size
+        if block >= self.block_count(index):
+            return None
+        return block
+
+    def next_missing_piece(self, start: int = 0):
+        """
+        Returns the index of the first piece from `start` with no block
+        requested yet, or None.
+        """
+        index = self.pieces.find(DownloadState.Missing, start)
+        return None if index == -1 else index
+
+    def request_block(self, index: int):
+        """
+        Marks the first missing block of the given piece as pending.
+
+        :return The block number, or None if no block of the piece is missing
+        """
+        base = index * self.blocks_per_piece
+        position = self.blocks.find(DownloadState.Missing, base, base + self.block_count(index))
+        if position == -1:
+            return None
+        self.blocks[position] = DownloadState.Pending
+        self.pieces[index] = DownloadState.Pending
+        return position - base
+
+    def block_missing(self, index: int, block: int):
+        """
+        Puts a pending block back to missing, e.g. when its request was
+        dropped.
+        """
+        position = index * self.blocks_per_piece + block
+        if self.blocks[position] == DownloadState.Pending:
+            self.blocks[position] = DownloadState.Missing
+
+    def block_received(self, index: int, block: int) -> bool:
+        """
+        Marks the given block as retrieved.
+
+        :return True if the block was not retrieved before
+        """
+        position = index * self.blocks_per_piece + block
+        if self.blocks[position] == DownloadState.Retrieved:
+            return False
+        self.blocks[position] = DownloadState.Retrieved
+        self.pieces[index] = DownloadState.Pending
+        self.retrieved[index] += 1
+        return True
+
+    def block_status(self, index: int, block: int) -> int:
+        return self.blocks[index * self.blocks_per_piece + block]
+
+    def is_complete(self, index: int) -> bool:
+        return self.retrieved[index] == self.block_count(index)
+
+    def reset(self, index: int):
+        """
+        Marks every block of the given piece as missing again.
+        """
+        base = index * self.blocks_per_piece
+        count = self.block_count(index)
+        self.blocks[base:base + count] = bytes(count)
+        self.retrieved[index] = 0
+        if self.has(index):
+            self.have.discard(index)
+            self.have_count -= 1
+        self.pieces[index] = DownloadState.Missing
+
+    def has(self, index: int) -> bool:
+        return self.have[index]
+
+    def set_have(self, index: int):
+        """
+        Marks the given piece as downloaded and verified.
+        """
+        if self.has(index):
+            return
+        base = index * self.blocks_per_piece
+        count = self.block_count(index)
+        self.blocks[base:base + count] = bytes([DownloadState.Retrieved]) * count
+        self.retrieved[index] = count
+        self.pieces[index] = DownloadState.Retrieved
+        self.have.add(index)
+        self.have_count += 1
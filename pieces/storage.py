@@ -0,0 +1,369 @@
+import asyncio
+import bisect
+import logging
+import os
+import threading
+import time
+from array import array
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pieces.exceptions import TorrentError
+
+MAX_DISK_WORKERS = 4
+MAX_OPEN_FILES = 256  # File descriptors a `FilePool` keeps open at most
+
+try:
+    IOV_MAX = max(os.sysconf('SC_IOV_MAX'), 16)
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+FileEntry = namedtuple('FileEntry', ['path', 'offset', 'length'])
+
+
+def _open_flags():
+    return os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+
+
+class _OpenFile:
+    __slots__ = ('fd', 'users', 'used')
+
+    def __init__(self, fd: int):
+        self.fd = fd
+        self.users = 0  # Reads and writes using the descriptor right now
+        self.used = time.monotonic()
+
+
+class FilePool:
+    """
+    The files the storages sharing the pool have open, at most `max_open`
+    of them.
+
+    Files are opened on first use. Opening one more closes the least
+    recently used file no read or write is using; if every file is in use
+    the pool goes over `max_open` until they are done. `close_idle` closes
+    the files unused for a while, so a torrent with no disk I/O holds no
+    file descriptors.
+    """
+    def __init__(self, max_open: int = MAX_OPEN_FILES):
+        self.max_open = max_open
+        self._files = OrderedDict()  # (owner, file index) -> _OpenFile, least recently used first
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._files)
+
+    @contextmanager
+    def open(self, owner, index: int, path: str):
+        """
+        Lends the descriptor of a file, opening it if needed; it is not
+        closed while lent.
+
+        :param owner: The storage the file belongs to
+        :param index: The index of the file in the storage
+        """
+        key = (owner, index)
+        with self._lock:
+            file = self._files.get(key)
+            if file is None:
+                self._evict(self.max_open - 1)
+                directory = os.path.dirname(path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                file = self._files[key] = _OpenFile(os.open(path, _open_flags(), 0o644))
+            else:
+                self._files.move_to_end(key)
+            file.users += 1
+        try:
+            yield file.fd
+        finally:
+            with self._lock:
+                file.users -= 1
+                file.used = time.monotonic()
+
+    def close_idle(self, max_idle: float):
+        """
+        Closes the files not used for `max_idle` seconds.
+        """
+        now = time.monotonic()
+        with self._lock:
+            for key, file in list(self._files.items()):
+                if not file.users and now - file.used >= max_idle:
+                    self._close(key)
+
+    def close(self, owner=None):
+        """
+        Closes the files of the given storage, or every file.
+        """
+        with self._lock:
+            for key in list(self._files):
+                if owner is None or key[0] is owner:
+                    self._close(key)
+
+    def _evict(self, limit: int):
+        for key, file in list(self._files.items()):
+            if len(self._files) <= limit:
+                break
+            if not file.users:
+                self._close(key)
+
+    def _close(self, key):
+        try:
+            os.close(self._files.pop(key).fd)
+        except OSError as e:
+            logging.warning(f'Unable to close file: {e}')
+
+
+class Storage:
+    """
+    Maps the linear byte space of a torrent onto the files it contains.
+
+    Pieces are written at their position with positional writes, so pieces
+    can be written in any order, and pieces spanning file boundaries are
+    split over the files they cover. The first file of every piece is
+    precomputed, so locating a piece costs no search.
+
+    All disk I/O can be run on a bounded thread pool (see `write_async` and
+    `read_async`) so it never blocks the event loop. The pool may be given
+    as `executor`, e.g. a lane of a `FairExecutor` shared with other
+    torrents. The files are opened as needed through a `FilePool`, which
+    may be shared with other torrents too to bound the descriptors they
+    keep open together.
+    """
+    def __init__(self, torrent, max_workers: int = MAX_DISK_WORKERS, executor=None,
+                 files: FilePool = None):
+        self.torrent = torrent
+        self.piece_length = torrent.piece_length
+        self.total_size = torrent.total_size
+        self.files = self._layout(torrent)
+        self._starts = [entry.offset for entry in self.files]
+        num_pieces = (self.total_size + self.piece_length - 1) // self.piece_length
+        self._piece_files = array('I', (self._file_at(index * self.piece_length)
+                                        for index in range(num_pieces)))
+        self._pool = FilePool() if files is None else files
+        self._lock = threading.Lock()
+        self._executor = executor or ThreadPoolExecutor(max_workers, thread_name_prefix='storage')
+
+    @staticmethod
+    def _layout(torrent):
+        if not torrent.files:
+            return [FileEntry(torrent.output_file, 0, torrent.total_size)]
+        entries = []
+        offset = 0
+        for file in torrent.files:
+            parts = [torrent.sanitize_file_name(part.decode('utf-8', 'replace'))
+                     for part in file[b'path']]
+            parts = [part for part in parts if part not in ('', '.', '..')]
+            if not parts:
+                raise TorrentError(f'Invalid file path in torrent: {file[b"path"]}')
+            entries.append(FileEntry(os.path.join(torrent.output_file, *parts), offset, file[b'length']))
+            offset += file[b'length']
+        return entries
+
+    def _file_at(self, offset: int) -> int:
+        index = bisect.bisect_right(self._starts, offset) - 1
+        # Skip empty files sharing their offset with the next file
+        while index < len(self.files) - 1 and self.files[index].length == 0:
+            index += 1
+        return index
+
+    def spans(self, offset: int, length: int, file_index: int = None):
+        """
+        Splits a range of the torrent into the file ranges it covers.
+
+        :return A list of (file index, offset in file, length) tuples
+        """
+        if offset < 0 or offset + length > self.total_size:
+            raise TorrentError(f'Range outside of torrent: {offset}+{length}')
+        index = self._file_at(offset) if file_index is None else file_index
+        spans = []
+        while length > 0:
+            entry = self.files[index]
+            position = offset - entry.offset
+            size = min(length, entry.length - position)
+            if size > 0:
+                spans.append((index, position, size))
+                offset += size
+                length -= size
+            index += 1
+        return spans
+
+    def piece_spans(self, index: int):
+        """
+        The file ranges covered by the given piece.
+        """
+        offset = index * self.piece_length
+        length = min(self.piece_length, self.total_size - offset)
+        return self.spans(offset, length, self._piece_files[index])
+
+    def preallocate(self, sparse: bool = True):
+        """
+        Creates every file at its final size. Sparse files only reserve the
+        size, otherwise the disk blocks are allocated up front where the
+        platform supports it.
+        """
+        for index, entry in enumerate(self.files):
+            with self._open(index) as fd:
+                if os.fstat(fd).st_size >= entry.length:
+                    continue
+                if not sparse and entry.length and hasattr(os, 'posix_fallocate'):
+                    os.posix_fallocate(fd, 0, entry.length)
+                else:
+                    os.ftruncate(fd, entry.length)
+
+    async def preallocate_async(self, sparse: bool = True):
+        """
+        Creates every file at its final size on the disk thread pool, see
+        `preallocate`.
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self.preallocate, sparse)
+
+    def _open(self, index: int):
+        return self._pool.open(self, index, self.files[index].path)
+
+    def write(self, offset: int, data):
+        """
+        Writes the data at the given offset of the torrent (blocking).
+        """
+        self.writev(offset, [data])
+
+    def writev(self, offset: int, buffers):
+        """
+        Writes the given buffers back to back from the given offset of the
+        torrent (blocking), with one gathering write per file covered.
+        """
+        buffers = [memoryview(buffer).cast('B') for buffer in buffers]
+        length = sum(len(buffer) for buffer in buffers)
+        for index, position, size in self.spans(offset, length):
+            chunk = []
+            while size > 0:
+                buffer = buffers[0]
+                if len(buffer) <= size:
+                    chunk.append(buffer)
+                    buffers.pop(0)
+                    size -= len(buffer)
+                else:
+                    chunk.append(buffer[:size])
+                    buffers[0] = buffer[size:]
+                    size = 0
+            with self._open(index) as fd:
+                self._pwritev(fd, chunk, position)
+
+    def _pwritev(self, fd: int, buffers, position: int):
+        while buffers:
+            batch = buffers[:IOV_MAX]
+            if hasattr(os, 'pwritev'):
+                written = os.pwritev(fd, batch, position)
+            else:
+                written = self._pwrite(fd, batch[0], position)
+            position += written
+            # Drop what was written, keeping the rest of a partially written buffer
+            while written:
+                if len(buffers[0]) <= written:
+                    written -= len(buffers[0])
+                    buffers.pop(0)
+                else:
+                    buffers[0] = buffers[0][written:]
+                    written = 0
+
+    def _pwrite(self, fd: int, data, position: int) -> int:
+        if hasattr(os, 'pwrite'):
+            return os.pwrite(fd, data, position)
+        with self._lock:
+            os.lseek(fd, position, os.SEEK_SET)
+            return os.write(fd, data)
+
+    def read(self, offset: int, length: int) -> bytes:
+        """
+        Reads a range of the torrent (blocking). Parts of files not written
+        yet read as zeros.
+        """
+        chunks = []
+        for index, position, size in self.spans(offset, length):
+            with self._open(index) as fd:
+                while size > 0:
+                    data = self._pread(fd, size, position)
+                    if not data:
+                        data = bytes(size)
+                    chunks.append(data)
+                    position += len(data)
+                    size -= len(data)
+        return chunks[0] if len(chunks) == 1 else b''.join(chunks)
+
+    def readinto(self, offset: int, buffer) -> None:
+        """
+        Reads a range of the torrent straight into the given writable buffer
+        (blocking), with one positional read per file covered and no
+        intermediate copy. Parts of files not written yet read as zeros.
+        """
+        view = memoryview(buffer).cast('B')
+        for index, position, size in self.spans(offset, len(view)):
+            with self._open(index) as fd:
+                while size > 0:
+                    read = self._preadinto(fd, view[:size], position)
+                    if not read:
+                        view[:size] = bytes(size)
+                        read = size
+                    view = view[read:]
+                    position += read
+                    size -= read
+
+    def readinto_many(self, ranges) -> None:
+        """
+        Fills every (offset, buffer) pair of `ranges`, see `readinto`.
+        """
+        for offset, buffer in ranges:
+            self.readinto(offset, buffer)
+
+    def _preadinto(self, fd: int, view, position: int) -> int:
+        if hasattr(os, 'preadv'):
+            return os.preadv(fd, [view], position)
+        data = self._pread(fd, len(view), position)
+        view[:len(data)] = data
+        return len(data)
+
+    def _pread(self, fd: int, size: int, position: int) -> bytes:
+        if hasattr(os, 'pread'):
+            return os.pread(fd, size, position)
+        with self._lock:
+            os.lseek(fd, position, os.SEEK_SET)
+            return os.read(fd, size)
+
+    def read_piece(self, index: int) -> bytes:
+        offset = index * self.piece_length
+        return self.read(offset, min(self.piece_length, self.total_size - offset))
+
+    async def write_async(self, offset: int, buffers):
+        """
+        Writes the given buffers on the disk thread pool.
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self.writev, offset, list(buffers))
+
+    async def read_async(self, offset: int, length: int) -> bytes:
+        """
+        Reads a range of the torrent on the disk thread pool.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self.read, offset, length)
+
+    async def readinto_async(self, ranges):
+        """
+        Fills every (offset, buffer) pair of `ranges` on the disk thread
+        pool, in a single hop to the pool.
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self.readinto_many, list(ranges))
+
+    async def close_async(self):
+        """
+        Closes the files once the reads and writes queued are done, waiting
+        on a thread rather than blocking the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.close)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self._pool.close(self)
@@ -0,0 +1,113 @@
+import os
+import time
+
+READ_AHEAD = 2**24  # Bytes ahead of the playhead to download first
+BITRATE = 2**20  # Bytes per second a file is assumed to be played at
+
+
+class FileStream:
+    """
+    Reads a file of a torrent while it downloads, like a binary file opened
+    for reading whose `read` is a coroutine, waiting for missing pieces.
+
+    The stream keeps a read-ahead window of `read_ahead` bytes from its
+    position (the playhead) and gives the pieces in it deadlines at which
+    they will be played at `bitrate` bytes per second, so the piece at the
+    playhead is downloaded first, from the fastest peers, then the ones
+    after it in order (see `PieceManager.set_deadlines`). The window moves
+    with every read or seek crossing a piece boundary, so a seek starts
+    downloading around its new position right away.
+
+    The data is read through `PieceManager.read_blocks`, from the piece
+    cache if the pieces were just downloaded.
+    """
+    def __init__(self, piece_manager, file: int, read_ahead: int = READ_AHEAD,
+                 bitrate: float = BITRATE):
+        entry = piece_manager.storage.files[file]
+        self.piece_manager = piece_manager
+        self.name = entry.path
+        self.offset = entry.offset  # Of the file in the torrent
+        self.size = entry.length
+        self.piece_length = piece_manager.torrent.piece_length
+        self.read_ahead = read_ahead
+        self.bitrate = bitrate
+        self.position = 0
+        self.closed = False
+        self._window = None  # The piece at the playhead when the window was set
+        self._update_window()
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        elif whence != os.SEEK_SET:
+            raise ValueError(f'Invalid whence: {whence}')
+        if offset < 0:
+            raise ValueError(f'Negative seek position: {offset}')
+        self.position = offset
+        self._update_window()
+        return self.position
+
+    async def read(self, size: int = -1) -> bytes:
+        """
+        Reads up to `size` bytes, or up to the end of the file if `size` is
+        negative, waiting for the pieces to download.
+
+        :return The data, only shorter than `size` at the end of the file
+        """
+        if self.closed:
+            raise ValueError('Read from a closed stream')
+        if size < 0 or self.position + size > self.size:
+            size = max(0, self.size - self.position)
+        data = bytearray(size)
+        view = memoryview(data)
+        done = 0
+        while done < size:
+            start = self.offset + self.position
+            index, begin = divmod(start, self.piece_length)
+            length = min(size - done, self.piece_length - begin)
+            await self.piece_manager.wait_for(index)
+            await self.piece_manager.read_blocks([(index, begin, view[done:done + length])])
+            done += length
+            self.position += length
+            self._update_window()
+        return bytes(data)
+
+    def close(self):
+        """
+        Clears the deadlines of the stream, leaving the rest of the download
+        to the usual piece order.
+        """
+        if not self.closed:
+            self.closed = True
+            self.piece_manager.set_deadlines({}, owner=self)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    def _update_window(self):
+        if self.closed or not self.size:
+            return
+        start = self.offset + min(self.position, self.size - 1)
+        first = start // self.piece_length
+        if first == self._window:
+            return
+        self._window = first
+        end = self.offset + min(self.position + self.read_ahead, self.size)
+        last = max(first, (end - 1) // self.piece_length)
+        state = self.piece_manager.state
+        now = time.monotonic()
+        deadlines = {}
+        for index in range(first, last + 1):
+            if not state.has(index):
+                # The time the piece will be played at from the playhead
+                played = max(0, index * self.piece_length - start)
+                deadlines[index] = now + played / self.bitrate
+        self.piece_manager.set_deadlines(deadlines, owner=self)
@@ -0,0 +1,99 @@
+import heapq
+import itertools
+
+INITIAL_TIMEOUT = 20.0  # Seconds allowed for a request before the first sample
+MIN_TIMEOUT = 2.0
+MAX_TIMEOUT = 60.0
+
+
+class RttEstimator:
+    """
+    Estimates how long a peer takes to answer a request, from the time
+    between sending each `Request` and receiving its block.
+
+    The smoothed round-trip and its mean deviation are exponentially
+    weighted moving averages as in TCP's retransmission timer (RFC 6298);
+    the request timeout is the smoothed round-trip plus four deviations,
+    clamped between `min_timeout` and `max_timeout`. The round-trips
+    include the time a request spends queued behind the others we have
+    pipelined to the peer, so the timeout follows the depth of the queue.
+
+    A peer letting a request time out is *snubbed* until it sends a block
+    again. Every consecutive timeout doubles the timeout (exponential
+    backoff).
+    """
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+
+    def __init__(self, initial: float = INITIAL_TIMEOUT, min_timeout: float = MIN_TIMEOUT,
+                 max_timeout: float = MAX_TIMEOUT):
+        self.initial = initial
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.srtt = None
+        self.rttvar = None
+        self.timeouts = 0  # Consecutive requests that timed out
+        self.snubbed = False
+
+    @property
+    def timeout(self) -> float:
+        if self.srtt is None:
+            timeout = self.initial
+        else:
+            timeout = self.srtt + 4 * self.rttvar
+        timeout *= 2 ** min(self.timeouts, 6)
+        return max(self.min_timeout, min(self.max_timeout, timeout))
+
+    def sample(self, rtt: float):
+        """
+        Records the round-trip of an answered request.
+        """
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+        self.timeouts = 0
+        self.snubbed = False
+
+    def timed_out(self):
+        """
+        Records a request that was not answered in time.
+        """
+        self.timeouts += 1
+        self.snubbed = True
+
+
+class TimeoutQueue:
+    """
+    A min-heap of deadlines. Pushing and popping are O(log n) and finding
+    out whether anything expired is O(1).
+
+    Entries are never removed when the request they time is answered;
+    `expired` yields them anyway and the caller skips the stale ones, which
+    is cheaper than keeping the heap in sync.
+    """
+    def __init__(self):
+        self._heap = []
+        self._counter = itertools.count()  # Breaks ties without comparing items
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, deadline: float, item):
+        heapq.heappush(self._heap, (deadline, next(self._counter), item))
+
+    def next_deadline(self):
+        return self._heap[0][0] if self._heap else None
+
+    def expired(self, now: float):
+        """
+        Pops and yields the items whose deadline is past.
+        """
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            yield heapq.heappop(heap)[2]
+
+    def clear(self):
+        self._heap.clear()
@@ -1,10 +1,16 @@
-import bencodepy
 import os
 import re
 import hashlib
+from pieces.bencoding import Decoder, Encoder
 
 class Torrent:
     def __init__(self, meta_info, output_path=None):
+        # The raw bencoded info dictionary, hashed as is when available
+        self.raw_info = None
+        if isinstance(meta_info, (bytes, bytearray, memoryview)):
+            decoder = Decoder(meta_info)
+            meta_info = decoder.decode()
+            self.raw_info = decoder.raw_info
         self.meta_info = meta_info
         self.torrent_data = meta_info
         self.name = self.torrent_data[b'info'][b'name']
@@ -25,8 +31,11 @@ class Torrent:
         self.pieces_downloaded = 0
     
     def calculate_info_hash(self):
-        # Create a hash of the info dictionary
-        info_encoded = bencodepy.encode(self.torrent_data[b'info'])
+        # Create a hash of the info dictionary, as it was in the .torrent
+        # file if we have it so keys and values are hashed byte for byte
+        info_encoded = self.raw_info
+        if info_encoded is None:
+            info_encoded = Encoder(self.torrent_data[b'info']).encode()
         return hashlib.sha1(info_encoded).digest()
     
     def calculate_total_size(self):
@@ -94,6 +103,4 @@ def load_torrent_file(file_path):
         raise FileNotFoundError(f'Torrent file not found: {file_path}')
 
     with open(file_path, 'rb') as f:
-        torrent_data = bencodepy.decode(f.read())
-
-    return Torrent(torrent_data)
+        return Torrent(f.read())
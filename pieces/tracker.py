@@ -1,138 +1,460 @@
-import aiohttp
-import asyncio
-import bencodepy
-import random
-import socket
-import struct
-
-class Tracker:
-    def __init__(self, torrent):
-        self.torrent = torrent  # Store the torrent object
-        self.url = 'udp://tracker.opentrackr.org:1337'
-        self.peer_id = self.generate_peer_id()  # Generate peer ID on initialization
-
-    def generate_peer_id(self):
-        # Generate a unique peer ID
-        return "-PC0001-" + "".join([str(random.randint(0, 9)) for _ in range(12)])
-
-    async def connect(self, uploaded=0, downloaded=0, event=None):
-        if self.url.startswith('http'):
-            return await self._http_connect(uploaded, downloaded, event)
-        elif self.url.startswith('udp'):
-            return await self._udp_connect(uploaded, downloaded, event)
-        else:
-            raise ValueError("Unsupported tracker protocol")
-
-    async def _http_connect(self, uploaded, downloaded, event):
-        params = {
-            'info_hash': self.torrent.info_hash,  # The info hash from the torrent
-            'peer_id': self.peer_id,
-            'port': 6881,  # Default port for BitTorrent
-            'uploaded': uploaded,
-            'downloaded': downloaded,
-            'compact': 1,
-            'event': event
-        }
-
-        async with aiohttp.ClientSession() as session:
-            async with session.get(self.url, params=params) as response:
-                if response.status == 200:
-                    response_data = await response.read()
-                    return self.parse_response(response_data)
-                else:
-                    raise Exception(f"Tracker response error: {response.status}")
-
-    async def _udp_connect(self, uploaded, downloaded, event):
-       tracker_address = self.url.split('://')[1]  # Get the address without "udp://"
-       host, port = tracker_address.split(':')
-       port = port.split('/')[0]
-
-       sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-       sock.settimeout(20)  # Increased timeout
-
-       # Build the UDP connection request
-       connection_id = 0x41727101980
-       action = 0
-       transaction_id = random.randint(0, 0xFFFFFFFF)
-
-       request = struct.pack('!QQI', connection_id, action, transaction_id)
-       print(f"Connecting to tracker at {host}:{port}")
-       print(f"Sending request to tracker...")
-       sock.sendto(request, (host, int(port)))
-       print(f"Waiting for response from tracker...")
-
-       try:
-           response, _ = sock.recvfrom(4096)
-       except socket.timeout:
-           raise Exception("UDP Tracker request timed out")
-
-       if len(response) < 16:
-           raise Exception("Invalid UDP response")
-
-       action, transaction_id = struct.unpack('!II', response[:8])
-       if action != 0:
-           raise Exception("UDP tracker error")
-
-       # Send announce request
-       action = 1
-       request = struct.pack('!QQI20s20sII', connection_id, action, transaction_id,
-                             self.torrent.info_hash, self.peer_id.encode(), 6881, 0)
-
-       sock.sendto(request, (host, int(port)))
-       try:
-           response, _ = sock.recvfrom(4096)
-       except socket.timeout:
-           raise Exception("UDP Tracker announce request timed out")
-
-       return self.parse_udp_response(response)
-
-
-
-    def parse_response(self, response_data):
-        decoded = bencodepy.decode(response_data)
-        return {
-            'interval': decoded.get(b'interval', 30),  # Default interval if not specified
-            'peers': self.decode_peers(decoded.get(b'peers', b'')),
-        }
-
-    def parse_udp_response(self, response_data):
-       print(f"Raw response: {response_data}") 
-       if len(response_data) < 20:
-           raise Exception(f"Invalid UDP response: response too short (length: {len(response_data)})")
-    
-       action, transaction_id = struct.unpack('!I', response_data[:4])[0]
-       if action != 0:  # 0 indicates a successful response
-           raise Exception(f"Unexpected action in response: {action}")
-
-       peer_list = []
-       peer_count = (len(response_data) - 8) // 6
-       for i in range(peer_count):
-           peer = response_data[8 + i * 6: 8 + (i + 1) * 6]
-           ip = peer[:4]
-           port = peer[4:]
-           peer_list.append((self.bytes_to_ip(ip), self.bytes_to_port(port)))
-
-       return {
-           'interval': 30,  # Default interval for UDP response
-           'peers': peer_list,
-       }
-
-
-    def decode_peers(self, peers):
-        # Assuming compact format for HTTP response
-        peer_list = []
-        for i in range(0, len(peers), 6):
-            ip = peers[i:i + 4]
-            port = peers[i + 4:i + 6]
-            peer_list.append((self.bytes_to_ip(ip), self.bytes_to_port(port)))
-        return peer_list
-
-    def bytes_to_ip(self, byte_ip):
-        return ".".join(str(x) for x in byte_ip)
-
-    def bytes_to_port(self, byte_port):
-        return int.from_bytes(byte_port, 'big')
-
-    def close(self):
-        # Clean up any connections or resources
-        pass
+import aiohttp
+import asyncio
+import logging
+import random
+import struct
+import time
+from collections import defaultdict, namedtuple
+from urllib.parse import quote, urlencode, urlsplit
+from yarl import URL
+from pieces.bencoding import Decoder
+from pieces.exceptions import TrackerError
+from pieces.peer import decode_peers, merge_peers
+
+UDP_TIMEOUT = 15  # BEP 15: wait 15 * 2 ^ n seconds for the n-th retry...
+UDP_MAX_RETRIES = 3  # ... where BEP 15 allows n up to 8
+TRACKER_TIMEOUT = 60  # Seconds a tracker has to answer before the next of its tier is tried
+HTTP_TIMEOUT = 30
+HTTP_CONNECTIONS = 100
+HTTP_CONNECTIONS_PER_HOST = 4
+HTTP_KEEPALIVE = 60
+CONNECTION_ID_LIFETIME = 60
+MAX_HTTP_SCRAPE = 50  # Info hashes per scrape, keeping the URL short enough
+MAX_UDP_SCRAPE = 74  # Info hashes that fit a BEP 15 scrape packet
+
+UDP_PROTOCOL_ID = 0x41727101980
+ACTION_CONNECT = 0
+ACTION_ANNOUNCE = 1
+ACTION_SCRAPE = 2
+ACTION_ERROR = 3
+UDP_EVENTS = {None: 0, 'completed': 1, 'started': 2, 'stopped': 3}
+
+_CONNECT = struct.Struct('!QII')
+_ANNOUNCE = struct.Struct('!QII20s20sQQQIIIiH')
+_HEADER = struct.Struct('!II')
+_CONNECTED = struct.Struct('!IIQ')
+_ANNOUNCED = struct.Struct('!IIIII')
+_SCRAPE = struct.Struct('!QII')
+_SCRAPED = struct.Struct('!III')
+
+ScrapeStats = namedtuple('ScrapeStats', ['seeders', 'completed', 'leechers'])
+
+
+def scrape_url(url: str):
+    """
+    The scrape URL of a tracker, or None if it doesn't support scraping
+    (BEP 48: only HTTP announce URLs whose last path part starts with
+    'announce' do).
+    """
+    if url.startswith('udp'):
+        return url
+    head, _, tail = url.rpartition('/')
+    if not tail.startswith('announce'):
+        return None
+    return f'{head}/scrape{tail[len("announce"):]}'
+
+
+class HTTPPool:
+    """
+    A process-wide pool of keep-alive HTTP connections to trackers, shared
+    by every `Tracker`, with a limit on the connections per host.
+
+    The underlying `aiohttp.ClientSession` is created on first use and
+    again if the event loop it was bound to is gone. The owners of the
+    event loops using the pool (a `Session`, or a `TorrentClient` running
+    on its own) hold it with `acquire`, and `release` closes it once the
+    last of them is done.
+    """
+    def __init__(self, limit: int = HTTP_CONNECTIONS,
+                 limit_per_host: int = HTTP_CONNECTIONS_PER_HOST,
+                 keepalive_timeout: float = HTTP_KEEPALIVE):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self._session = None
+        self._loop = None
+        self._users = 0
+
+    def acquire(self):
+        self._users += 1
+
+    async def release(self):
+        """
+        Lets go of the pool, closing it if nobody else holds it.
+        """
+        self._users = max(0, self._users - 1)
+        if not self._users:
+            await self.close()
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._loop is not loop:
+            connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host,
+                                             keepalive_timeout=self.keepalive_timeout)
+            self._session = aiohttp.ClientSession(
+                connector=connector, timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT))
+            self._loop = loop
+        return self._session
+
+    async def get(self, url, params) -> bytes:
+        """
+        Fetches a tracker URL with the given query parameters, a list of
+        (name, value) pairs whose values may be raw bytes.
+        """
+        # aiohttp only takes str values, so the query is encoded here
+        query = urlencode(params, quote_via=quote)
+        url = URL(f"{url}{'&' if '?' in url else '?'}{query}", encoded=True)
+        async with self.session.get(url) as response:
+            if response.status != 200:
+                raise TrackerError(f"Tracker response error: {response.status}")
+            return await response.read()
+
+    async def close(self):
+        if self._session is not None:
+            if not self._session.closed:
+                await self._session.close()
+            self._session = None
+            self._loop = None
+
+
+class UDPTrackerProtocol(asyncio.DatagramProtocol):
+    """
+    A datagram endpoint talking to one UDP tracker, matching responses to
+    requests by their transaction id.
+    """
+    def __init__(self):
+        self.transport = None
+        self.ipv6 = False
+        self.waiters = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+        # Trackers reached over IPv6 answer with 18 byte peer entries
+        self.ipv6 = len(transport.get_extra_info('sockname') or ()) == 4
+
+    def datagram_received(self, data, addr):
+        if len(data) < _HEADER.size:
+            return
+        _, transaction_id = _HEADER.unpack_from(data)
+        waiter = self.waiters.pop(transaction_id, None)
+        if waiter and not waiter.done():
+            waiter.set_result(data)
+
+    def error_received(self, exc):
+        for waiter in self.waiters.values():
+            if not waiter.done():
+                waiter.set_exception(TrackerError(f'UDP tracker unreachable: {exc}'))
+        self.waiters.clear()
+
+    def connection_lost(self, exc):
+        self.error_received(exc or 'connection closed')
+
+    async def request(self, build, timeout: float) -> bytes:
+        """
+        Sends the packet made by `build(transaction_id)` and waits for the
+        response to it.
+        """
+        transaction_id = random.getrandbits(32)
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters[transaction_id] = waiter
+        try:
+            self.transport.sendto(build(transaction_id))
+            data = await asyncio.wait_for(waiter, timeout)
+        finally:
+            self.waiters.pop(transaction_id, None)
+        action, _ = _HEADER.unpack_from(data)
+        if action == ACTION_ERROR:
+            raise TrackerError(f'Tracker error: {data[8:].decode("utf-8", "replace")}')
+        return data
+
+
+class Tracker:
+    """
+    Announces to the trackers of a torrent.
+
+    The trackers are grouped in tiers as listed in `announce-list` (BEP 12),
+    falling back to `announce`. Every tier is announced to concurrently;
+    within a tier the trackers are tried in (shuffled) order, each given
+    `announce_timeout` seconds, and the first to respond is moved to the
+    front. The peers of every tracker are merged
+    and de-duplicated.
+
+    UDP trackers (BEP 15) are spoken to with an asyncio datagram endpoint.
+    Their connection ids are cached for their 60 second lifetime across all
+    `Tracker` instances, so an announce usually costs a single round trip.
+    Lost requests are retried after 15 * 2 ^ n seconds.
+
+    HTTP trackers are spoken to through the process-wide `http_pool`, so
+    announces reuse keep-alive connections across torrents. Many torrents
+    can be scraped with one request per tracker with `scrape_all`.
+    """
+    # (host, port) -> (connection id, expiry time)
+    connection_ids = {}
+    http_pool = HTTPPool()
+
+    def __init__(self, torrent, udp_timeout: float = UDP_TIMEOUT,
+                 udp_retries: int = UDP_MAX_RETRIES, announce_timeout: float = TRACKER_TIMEOUT):
+        self.torrent = torrent  # Store the torrent object
+        self.peer_id = self.generate_peer_id()  # Generate peer ID on initialization
+        self.port = 6881
+        self.udp_timeout = udp_timeout
+        self.udp_retries = udp_retries
+        self.announce_timeout = announce_timeout
+        self._tiers = None
+
+    def generate_peer_id(self):
+        # Generate a unique peer ID
+        return "-PC0001-" + "".join([str(random.randint(0, 9)) for _ in range(12)])
+
+    @property
+    def tiers(self):
+        """
+        The announce URLs of the torrent, as a list of tiers.
+        """
+        if self._tiers is None:
+            meta_info = self.torrent.meta_info
+            tiers = []
+            for tier in meta_info.get(b'announce-list') or []:
+                urls = [url.decode('utf-8', 'replace') for url in tier if url]
+                if urls:
+                    random.shuffle(urls)
+                    tiers.append(urls)
+            if not tiers and self.torrent.announce:
+                tiers = [[self.torrent.announce]]
+            self._tiers = tiers
+        return self._tiers
+
+    async def connect(self, uploaded=0, downloaded=0, event=None, on_peers=None,
+                      timeout: float = None):
+        """
+        Announces to every tier concurrently.
+
+        :param on_peers: Called with the new peers of every tracker as soon
+                         as it responds, rather than when all are done
+        :param timeout: Seconds after which the tiers still announcing are
+                        given up, keeping what the others returned
+        :return A dict with the shortest `interval` asked for and the merged
+                `peers`, or None if no tracker responded
+        """
+        seen = set()
+        intervals = []
+
+        def merge(response):
+            peers = [peer for peer in response['peers'] if peer not in seen]
+            seen.update(peers)
+            intervals.append(response['interval'])
+            if on_peers and peers:
+                on_peers(peers)
+
+        tasks = [asyncio.ensure_future(self._announce_tier(tier, uploaded, downloaded, event, merge))
+                 for tier in self.tiers]
+        try:
+            if tasks:
+                _, pending = await asyncio.wait(tasks, timeout=timeout)
+                if pending:
+                    logging.warning(f'{len(pending)} tracker tiers did not respond in {timeout}s')
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        if not intervals:
+            return None
+        return {
+            'interval': min(intervals),
+            'peers': list(seen),
+        }
+
+    async def _announce_tier(self, tier, uploaded, downloaded, event, merge):
+        for url in list(tier):
+            try:
+                response = await asyncio.wait_for(self.announce(url, uploaded, downloaded, event),
+                                                  self.announce_timeout)
+            except (TrackerError, OSError, asyncio.TimeoutError, aiohttp.ClientError, ValueError) as e:
+                logging.warning(f'Announce to {url} failed: {e!r}')
+                continue
+            # BEP 12: the tracker that responded goes first in its tier
+            tier.remove(url)
+            tier.insert(0, url)
+            merge(response)
+            return
+
+    async def announce(self, url, uploaded=0, downloaded=0, event=None):
+        """
+        Announces to a single tracker.
+        """
+        if url.startswith('http'):
+            return await self._http_connect(url, uploaded, downloaded, event)
+        elif url.startswith('udp'):
+            return await self._udp_connect(url, uploaded, downloaded, event)
+        else:
+            raise ValueError("Unsupported tracker protocol")
+
+    async def _http_connect(self, url, uploaded, downloaded, event):
+        params = [
+            ('info_hash', self.torrent.info_hash),  # The info hash from the torrent
+            ('peer_id', self.peer_id),
+            ('port', self.port),
+            ('uploaded', uploaded),
+            ('downloaded', downloaded),
+            ('left', max(self.torrent.total_size - downloaded, 0)),
+            ('compact', 1),
+        ]
+        if event:
+            params.append(('event', event))
+        return self.parse_response(await self.http_pool.get(url, params))
+
+    async def _udp_connect(self, url, uploaded, downloaded, event):
+        def build(connection_id, transaction_id):
+            return _ANNOUNCE.pack(
+                connection_id, ACTION_ANNOUNCE, transaction_id,
+                self.torrent.info_hash, self.peer_id.encode(),
+                downloaded, max(self.torrent.total_size - downloaded, 0),
+                uploaded, UDP_EVENTS.get(event, 0), 0,
+                random.getrandbits(32), -1, self.port)
+        return self.parse_udp_response(*await self._udp_request(url, build))
+
+    async def _udp_request(self, url, build):
+        """
+        Sends the packet made by `build(connection id, transaction id)` to a
+        UDP tracker, connecting first unless the connection id is cached, and
+        retrying with the BEP 15 backoff.
+
+        :return The response, and whether the tracker was reached over IPv6
+        """
+        address = urlsplit(url)
+        if not address.hostname or not address.port:
+            raise ValueError(f"Invalid UDP tracker URL: {url}")
+        key = (address.hostname, address.port)
+        loop = asyncio.get_running_loop()
+        transport, protocol = await loop.create_datagram_endpoint(
+            UDPTrackerProtocol, remote_addr=key)
+        try:
+            for attempt in range(self.udp_retries + 1):
+                timeout = self.udp_timeout * 2 ** attempt
+                try:
+                    connection_id = await self._connection_id(protocol, key, timeout)
+                    response = await protocol.request(
+                        lambda transaction_id: build(connection_id, transaction_id), timeout)
+                    return response, protocol.ipv6
+                except asyncio.TimeoutError:
+                    # The connection id may have been what got lost
+                    self.connection_ids.pop(key, None)
+            raise TrackerError(f'UDP tracker timed out: {url}')
+        finally:
+            transport.close()
+
+    async def _connection_id(self, protocol, key, timeout):
+        cached = self.connection_ids.get(key)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+        response = await protocol.request(
+            lambda transaction_id: _CONNECT.pack(UDP_PROTOCOL_ID, ACTION_CONNECT, transaction_id),
+            timeout)
+        if len(response) < _CONNECTED.size:
+            raise TrackerError("Invalid UDP connect response")
+        _, _, connection_id = _CONNECTED.unpack_from(response)
+        self.connection_ids[key] = (connection_id, time.monotonic() + CONNECTION_ID_LIFETIME)
+        return connection_id
+
+    async def scrape(self, url, info_hashes):
+        """
+        Fetches the swarm statistics of many torrents from one tracker, with
+        as few requests as the protocol allows.
+
+        :return A dict of info hash to `ScrapeStats`, missing the torrents
+                the tracker doesn't know
+        """
+        stats = {}
+        info_hashes = list(info_hashes)
+        if url.startswith('udp'):
+            for start in range(0, len(info_hashes), MAX_UDP_SCRAPE):
+                batch = info_hashes[start:start + MAX_UDP_SCRAPE]
+
+                def build(connection_id, transaction_id):
+                    return _SCRAPE.pack(connection_id, ACTION_SCRAPE, transaction_id) + b''.join(batch)
+                response, _ = await self._udp_request(url, build)
+                stats.update(self.parse_udp_scrape(response, batch))
+        else:
+            scrape = scrape_url(url)
+            if scrape is None:
+                raise TrackerError(f'Tracker does not support scrape: {url}')
+            for start in range(0, len(info_hashes), MAX_HTTP_SCRAPE):
+                params = [('info_hash', info_hash)
+                          for info_hash in info_hashes[start:start + MAX_HTTP_SCRAPE]]
+                stats.update(self.parse_scrape(await self.http_pool.get(scrape, params)))
+        return stats
+
+    @staticmethod
+    async def scrape_all(trackers):
+        """
+        Scrapes the torrents of many trackers, batching every torrent that
+        announces to the same tracker (the first of its first tier) into the
+        same requests.
+
+        :return A dict of info hash to `ScrapeStats`
+        """
+        batches = defaultdict(list)
+        for tracker in trackers:
+            if tracker.tiers:
+                batches[tracker.tiers[0][0]].append(tracker)
+        stats = {}
+
+        async def scrape(url, group):
+            try:
+                stats.update(await group[0].scrape(
+                    url, [tracker.torrent.info_hash for tracker in group]))
+            except (TrackerError, OSError, asyncio.TimeoutError, aiohttp.ClientError, ValueError) as e:
+                logging.warning(f'Scrape of {url} failed: {e!r}')
+        await asyncio.gather(*(scrape(url, group) for url, group in batches.items()))
+        return stats
+
+    def parse_scrape(self, response_data):
+        decoded = Decoder(response_data).decode()
+        if b'failure reason' in decoded:
+            raise TrackerError(f"Tracker error: {decoded[b'failure reason'].decode('utf-8', 'replace')}")
+        return {info_hash: ScrapeStats(entry.get(b'complete', 0), entry.get(b'downloaded', 0),
+                                       entry.get(b'incomplete', 0))
+                for info_hash, entry in decoded.get(b'files', {}).items()}
+
+    def parse_udp_scrape(self, response_data, info_hashes):
+        action, _ = _HEADER.unpack_from(response_data)
+        if action != ACTION_SCRAPE:
+            raise TrackerError(f"Unexpected action in response: {action}")
+        return {info_hash: ScrapeStats(*_SCRAPED.unpack_from(response_data, offset))
+                for info_hash, offset in zip(info_hashes, range(_HEADER.size, len(response_data)
+                                                                 - _SCRAPED.size + 1, _SCRAPED.size))}
+
+    def parse_response(self, response_data):
+        decoded = Decoder(response_data).decode()
+        if b'failure reason' in decoded:
+            raise TrackerError(f"Tracker error: {decoded[b'failure reason'].decode('utf-8', 'replace')}")
+        peers = decoded.get(b'peers', b'')
+        if isinstance(peers, list):
+            # Non-compact response
+            peers = merge_peers((peer[b'ip'].decode(), peer[b'port']) for peer in peers)
+        else:
+            peers = decode_peers(peers)
+        if b'peers6' in decoded:
+            peers = merge_peers(peers, decode_peers(decoded[b'peers6'], ipv6=True))
+        return {
+            'interval': decoded.get(b'interval', 30),  # Default interval if not specified
+            'peers': peers,
+        }
+
+    def parse_udp_response(self, response_data, ipv6=False):
+        if len(response_data) < _ANNOUNCED.size:
+            raise TrackerError(f"Invalid UDP response: response too short (length: {len(response_data)})")
+
+        action, _, interval, _, _ = _ANNOUNCED.unpack_from(response_data)
+        if action != ACTION_ANNOUNCE:
+            raise TrackerError(f"Unexpected action in response: {action}")
+
+        return {
+            'interval': interval,
+            'peers': decode_peers(memoryview(response_data)[_ANNOUNCED.size:], ipv6),
+        }
+
+    def close(self):
+        # Clean up any connections or resources
+        pass
@@ -0,0 +1,55 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha1
+
+
+def digest(buffers) -> bytes:
+    """
+    The SHA1 digest of the given buffers hashed back to back, without
+    joining them first.
+    """
+    hasher = sha1()
+    for buffer in buffers:
+        hasher.update(buffer)
+    return hasher.digest()
+
+
+class PieceVerifier:
+    """
+    Verifies completed pieces against their SHA1 digest on a thread pool.
+
+    hashlib releases the GIL while hashing, so pieces are verified in
+    parallel on every core while the event loop keeps serving peers. The
+    pool may be given as `executor`, e.g. a lane of a `FairExecutor`
+    shared with other torrents.
+    """
+    def __init__(self, max_workers: int = None, executor=None):
+        self.max_workers = max_workers or getattr(executor, 'max_workers', None) or os.cpu_count() or 1
+        self._executor = executor or ThreadPoolExecutor(self.max_workers, thread_name_prefix='verify')
+
+    def check(self, expected: bytes, buffers) -> bool:
+        """
+        Verifies the given buffers against the expected digest (blocking).
+        """
+        return digest(buffers) == expected
+
+    async def verify(self, expected: bytes, buffers) -> bool:
+        """
+        Verifies the given buffers against the expected digest on the thread
+        pool.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self.check, expected, list(buffers))
+
+    async def run(self, func, *args):
+        """
+        Runs a blocking hashing job on the thread pool.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def close(self):
+        # Never block the event loop behind queued pieces: jobs not started
+        # yet are cancelled, running ones finish in the background
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,21 @@
+import hashlib
+from pieces.torrent import Torrent
+
+
+def make_torrent(output_path: str, data: bytes, piece_length: int, files=None,
+                 name: bytes = b'test.bin', announce: bytes = b'http://localhost/announce'):
+    """
+    Builds the torrent of `data`, downloaded to `output_path`.
+
+    :param files: The (path, length) of every file of a multi-file torrent,
+                  the path being a file name or a list of path parts
+    """
+    hashes = b''.join(hashlib.sha1(data[i:i + piece_length]).digest()
+                      for i in range(0, len(data), piece_length))
+    info = {b'name': name, b'piece length': piece_length, b'pieces': hashes}
+    if files:
+        info[b'files'] = [{b'length': length, b'path': path if isinstance(path, list) else [path]}
+                          for path, length in files]
+    else:
+        info[b'length'] = len(data)
+    return Torrent({b'announce': announce, b'info': info}, output_path)
@@ -1,3 +1,4 @@
+import hashlib
 import unittest
 from pieces.bencoding import Decoder, Encoder
 from collections import OrderedDict
@@ -19,6 +20,43 @@ class TestBencoding(unittest.TestCase):
             OrderedDict([(b'cow', b'moo'), (b'spam', b'eggs')])
         )
 
+    def test_binary_string(self):
+        self.assertEqual(Decoder(b'4:\xff\x00\xfe\x01').decode(), b'\xff\x00\xfe\x01')
+
+    def test_str_keys(self):
+        decoded = Decoder(b'd3:cowd3:cowi1ee2:\xff\xfei2ee', str_keys=True).decode()
+        self.assertEqual(decoded, {'cow': {'cow': 1}, b'\xff\xfe': 2})
+
+    def test_buffers(self):
+        for data in (bytearray(b'li1ei-2ee'), memoryview(b'xli1ei-2ee')[1:]):
+            self.assertEqual(Decoder(data).decode(), [1, -2])
+
+    def test_deep_nesting(self):
+        depth = 100000
+        value = Decoder(b'l' * depth + b'e' * depth).decode()
+        for _ in range(depth - 1):
+            value = value[0]
+        self.assertEqual(value, [])
+
+    def test_raw_info(self):
+        info = b'd6:lengthi5e4:name1:x6:pieces2:\x00\xffe'
+        decoder = Decoder(b'd8:announce1:a4:info' + info + b'4:infoi1ee')
+        decoder.decode()
+        self.assertEqual(decoder.raw_info, info)
+        self.assertEqual(hashlib.sha1(decoder.raw_info).digest(), hashlib.sha1(info).digest())
+
+    def test_nested_info_is_not_raw_info(self):
+        decoder = Decoder(b'd1:ad4:infod1:xi1eeee')
+        decoder.decode()
+        self.assertIsNone(decoder.raw_info)
+
+    def test_invalid(self):
+        for data in (b'', b'i03e', b'i-0e', b'ie', b'i+1e', b'i1', b'01:a', b'3:ab',
+                     b'-1:a', b'l', b'di1ei2ee', b'd3:fooe', b'e', b'i1ei2e', b'x'):
+            with self.subTest(data=data):
+                with self.assertRaises(ValueError):
+                    Decoder(data).decode()
+
     def test_encoder(self):
         self.assertEqual(Encoder(123).encode(), b'i123e')
         self.assertEqual(Encoder('Middle Earth').encode(), b'12:Middle Earth')
@@ -28,5 +66,44 @@ class TestBencoding(unittest.TestCase):
         d['spam'] = 'eggs'
         self.assertEqual(Encoder(d).encode(), bytearray(b'd3:cow3:moo4:spam4:eggse'))
 
+    def test_encoder_canonical_keys(self):
+        data = {b'spam': 1, 'cow': {'z': 2, b'a': True}, b'\xff': b'', b'co': ()}
+        self.assertEqual(Encoder(data).encode(), b'd2:cole3:cowd1:ai1e1:zi2ee4:spami1e1:\xff0:e')
+        with self.assertRaises(ValueError):
+            Encoder({'a': 1, b'a': 2}).encode()
+        with self.assertRaises(TypeError):
+            Encoder({1: 2}).encode()
+        with self.assertRaises(TypeError):
+            Encoder([1.5]).encode()
+
+    def test_encoder_round_trip(self):
+        data = {b'info': {b'pieces': bytes(range(256)) * 4, b'files': [
+            {b'length': 2**40, b'path': [b'a', b'b']}, {b'length': -1, b'path': [b'c']}]}}
+        encoded = Encoder(data).encode()
+        self.assertEqual(Decoder(encoded).decode(), data)
+        self.assertEqual(Encoder(bytearray(b'ab')).encode(), b'2:ab')
+        self.assertEqual(Encoder(memoryview(b'ab')).encode(), b'2:ab')
+
+    def test_encoder_deep_nesting(self):
+        depth = 100000
+        data = []
+        for _ in range(depth - 1):
+            data = [data]
+        self.assertEqual(Encoder(data).encode(), b'l' * depth + b'e' * depth)
+
+    def test_encode_into_reuses_buffer(self):
+        buffer = bytearray(b'x')
+        self.assertIs(Encoder([1]).encode_into(buffer), buffer)
+        Encoder(b'ab').encode_into(buffer)
+        self.assertEqual(buffer, b'xli1ee2:ab')
+
+    def test_stream(self):
+        data = [b'x' * 100, list(range(100)), {b'k': b'v' * 10}]
+        chunks = []
+        Encoder(data).stream(chunks.append, chunk_size=64)
+        self.assertEqual(b''.join(chunks), Encoder(data).encode())
+        self.assertGreater(len(chunks), 3)
+        self.assertIn(b'x' * 100, chunks)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,70 @@
+import unittest
+from pieces.bitset import Bitset, set_bits
+
+class TestBitset(unittest.TestCase):
+
+    def test_set_bits(self):
+        self.assertEqual(list(set_bits(bytes([0b10000001, 0b01010000]), 12)), [0, 7, 9, 11])
+        self.assertEqual(list(set_bits(b'\xff', 5)), [0, 1, 2, 3, 4])
+
+    def test_wire_layout(self):
+        bitset = Bitset.from_bytes(10, b'\x80\x40')
+        self.assertTrue(bitset[0])
+        self.assertTrue(bitset[9])
+        self.assertFalse(bitset[1])
+        self.assertEqual(list(bitset), [0, 9])
+        bitset.add(1)
+        self.assertEqual(bitset.tobytes(), b'\xc0\x40')
+
+    def test_spare_bits_are_cleared(self):
+        bitset = Bitset.from_bytes(10, b'\xff\xff\xff')
+        self.assertEqual(bitset.tobytes(), b'\xff\xc0')
+        self.assertEqual(bitset.count(), 10)
+        self.assertTrue(bitset.all())
+
+    def test_short_data_is_padded(self):
+        bitset = Bitset.from_bytes(20, b'\x01')
+        self.assertEqual(bitset.tobytes(), b'\x01\x00\x00')
+        self.assertEqual(bitset.first(), 7)
+
+    def test_set_operations(self):
+        a = Bitset.from_bytes(16, b'\xf0\x0f')
+        b = Bitset.from_bytes(16, b'\x3c\x3c')
+        self.assertEqual((a & b).tobytes(), b'\x30\x0c')
+        self.assertEqual((a | b).tobytes(), b'\xfc\x3f')
+        self.assertEqual((a - b).tobytes(), b'\xc0\x03')
+        self.assertEqual(a.intersection_count(b), 4)
+        self.assertEqual(a.difference_count(b), 4)
+        self.assertTrue(a.intersects(b))
+        self.assertFalse(a.intersects(Bitset(16)))
+
+    def test_cached_value_is_updated(self):
+        bitset = Bitset(13)
+        self.assertEqual(bitset.value, 0)
+        bitset.add(12)
+        bitset.add(12)
+        bitset.add(0)
+        self.assertEqual(bitset.value, int.from_bytes(bitset.tobytes(), 'big'))
+        bitset.discard(12)
+        bitset.discard(5)
+        self.assertEqual(bitset.value, 1 << 15)
+        self.assertEqual(bitset.first_common(Bitset.full(13)), 0)
+        self.assertIsNone(bitset.first_common(Bitset(13)))
+
+    def test_cached_value_is_invalidated(self):
+        bitset = Bitset(8)
+        self.assertEqual(bitset.count(), 0)
+        self.assertFalse(bitset.any())
+        bitset[3] = 1
+        self.assertEqual(bitset.count(), 1)
+        self.assertTrue(bitset.any())
+        self.assertEqual(bitset.first(), 3)
+        bitset.discard(3)
+        self.assertIsNone(bitset.first())
+
+    def test_out_of_range(self):
+        with self.assertRaises(IndexError):
+            Bitset(8).add(8)
+
+if __name__ == '__main__':
+    unittest.main()
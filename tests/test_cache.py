@@ -0,0 +1,75 @@
+import unittest
+from pieces.cache import PieceCache
+
+
+class TestPieceCache(unittest.TestCase):
+
+    def test_written_piece_becomes_read_entry(self):
+        cache = PieceCache(100)
+        buffer = cache.allocate(10)
+        self.assertEqual(cache.write_bytes, 10)
+        buffer[:] = b'0123456789'
+        cache.insert('a', buffer)
+        self.assertEqual((cache.write_bytes, cache.read_bytes), (0, 10))
+        self.assertIs(cache.get('a'), buffer)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = PieceCache(30)
+        for key in 'abc':
+            cache.insert(key, cache.allocate(10))
+        cache.get('a')
+        cache.insert('d', cache.allocate(10))
+        self.assertEqual(list(cache.entries), ['c', 'a', 'd'])
+        self.assertLessEqual(cache.used, cache.budget)
+
+    def test_write_buffers_are_never_evicted(self):
+        cache = PieceCache(25)
+        first = cache.allocate(10)
+        cache.allocate(10)
+        self.assertFalse(cache.can_allocate(10))
+        self.assertIsNone(cache.allocate(10))
+        cache.insert('a', first)
+        # The read entry makes room for the new write buffer
+        self.assertIsNotNone(cache.allocate(10))
+        self.assertEqual(cache.entries, {})
+
+    def test_one_write_buffer_always_fits(self):
+        cache = PieceCache(5)
+        self.assertTrue(cache.can_allocate(10))
+        self.assertIsNotNone(cache.allocate(10))
+        self.assertFalse(cache.can_allocate(10))
+
+    def test_freed_buffers_are_reused(self):
+        cache = PieceCache(100)
+        buffer = cache.allocate(10)
+        cache.free(buffer)
+        self.assertEqual((cache.write_bytes, cache.pool_bytes), (0, 10))
+        self.assertIs(cache.allocate(10), buffer)
+        self.assertEqual((cache.write_bytes, cache.pool_bytes), (10, 0))
+
+    def test_pool_is_dropped_before_read_entries(self):
+        cache = PieceCache(20)
+        cache.insert('a', cache.allocate(10))
+        cache.free(cache.allocate(10))
+        cache.allocate(10)
+        self.assertEqual(cache.pool_bytes, 0)
+        self.assertIn('a', cache.entries)
+
+    def test_pieces_are_cached_on_second_miss(self):
+        cache = PieceCache(100)
+        self.assertFalse(cache.should_cache('a'))
+        self.assertFalse(cache.should_cache('b'))
+        self.assertTrue(cache.should_cache('a'))
+        self.assertFalse(cache.should_cache('a'))
+
+    def test_invalidate(self):
+        cache = PieceCache(100)
+        cache.insert('a', cache.allocate(10))
+        cache.invalidate('a')
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.used, 0)
+
+if __name__ == '__main__':
+    unittest.main()
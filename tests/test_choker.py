@@ -0,0 +1,78 @@
+import unittest
+from pieces.choker import Choker
+
+class FakeConnection:
+    def __init__(self, name, interested=True):
+        self.remote_id = name
+        self.peer_state = {'choked', 'interested'} if interested else {'choked'}
+        self.downloaded = 0
+        self.uploaded = 0
+
+    def choke(self):
+        self.peer_state.add('choked')
+
+    def unchoke(self):
+        self.peer_state.discard('choked')
+
+    def __repr__(self):
+        return self.remote_id
+
+class TestChoker(unittest.TestCase):
+
+    def setUp(self):
+        self.connections = [FakeConnection(f'peer{i}') for i in range(8)]
+        self.seeding = False
+        self.choker = Choker(lambda: self.connections, lambda: self.seeding,
+                             slots=3, interval=10, optimistic_interval=30)
+
+    def transfer(self, rates, attribute='downloaded'):
+        for connection, rate in zip(self.connections, rates):
+            setattr(connection, attribute, getattr(connection, attribute) + rate)
+
+    def unchoked(self):
+        return {c.remote_id for c in self.connections if 'choked' not in c.peer_state}
+
+    def test_fastest_uploaders_are_unchoked(self):
+        self.choker.rechoke(now=0)
+        self.transfer([10, 500, 20, 400, 30, 300, 0, 0])
+        unchoked = self.choker.rechoke(now=10)
+        self.assertTrue({'peer1', 'peer3', 'peer5'} < {c.remote_id for c in unchoked})
+        self.assertEqual(len(unchoked), 4)
+        self.assertEqual(self.unchoked(), {c.remote_id for c in unchoked})
+
+    def test_rates_are_measured_per_round(self):
+        self.choker.rechoke(now=0)
+        self.transfer([1000, 0, 0, 0, 0, 0, 0, 0])
+        self.choker.rechoke(now=10)
+        # peer0 stopped sending, the others caught up
+        self.transfer([0, 10, 10, 10, 0, 0, 0, 0])
+        unchoked = {c.remote_id for c in self.choker.rechoke(now=20)} - {self.choker.optimistic.remote_id}
+        self.assertEqual(unchoked, {'peer1', 'peer2', 'peer3'})
+
+    def test_optimistic_unchoke_rotates(self):
+        self.choker.rechoke(now=0)
+        first = self.choker.optimistic
+        self.assertNotIn('choked', first.peer_state)
+        self.choker.rechoke(now=10)
+        self.assertIs(self.choker.optimistic, first)
+        seen = {first}
+        for round in range(1, 20):
+            self.choker.rechoke(now=30 * round)
+            seen.add(self.choker.optimistic)
+        self.assertGreater(len(seen), 1)
+
+    def test_seeding_ranks_by_upload(self):
+        self.seeding = True
+        self.choker.rechoke(now=0)
+        self.transfer([0, 0, 0, 0, 0, 300, 200, 100], 'uploaded')
+        self.transfer([900, 900, 900, 0, 0, 0, 0, 0])
+        unchoked = {c.remote_id for c in self.choker.rechoke(now=10)}
+        self.assertTrue({'peer5', 'peer6', 'peer7'} < unchoked)
+
+    def test_uninterested_peers_stay_choked(self):
+        self.connections = [FakeConnection('a', interested=False), FakeConnection('b')]
+        self.choker.rechoke(now=0)
+        self.assertEqual(self.unchoked(), {'b'})
+
+if __name__ == '__main__':
+    unittest.main()
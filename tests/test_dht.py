@@ -0,0 +1,143 @@
+import os
+import socket
+import tempfile
+import unittest
+from pieces.dht import K, DHTNode, NodeInfo, RoutingTable, decode_nodes, distance, encode_nodes
+
+def node_id(prefix: int, rest: int = 0) -> bytes:
+    return bytes([prefix]) + rest.to_bytes(19, 'big')
+
+class TestRoutingTable(unittest.TestCase):
+
+    def setUp(self):
+        self.table = RoutingTable(node_id(0))
+
+    def test_buckets_by_shared_prefix(self):
+        self.table.add(NodeInfo(node_id(0x80), '10.0.0.1', 1))
+        self.table.add(NodeInfo(node_id(0x01), '10.0.0.2', 2))
+        self.assertIn(node_id(0x80), self.table.buckets[0])
+        self.assertIn(node_id(0x01), self.table.buckets[7])
+        # Our own id has no bucket
+        self.assertIsNone(self.table.add(NodeInfo(node_id(0), '10.0.0.3', 3)))
+        self.assertEqual(len(self.table), 2)
+
+    def test_full_bucket(self):
+        nodes = [NodeInfo(node_id(0x80 + i), '10.0.0.1', i + 1) for i in range(K + 1)]
+        for node in nodes[:K]:
+            self.assertIsNone(self.table.add(node))
+        # The least recently seen node is returned to be pinged
+        self.assertEqual(self.table.add(nodes[K]), nodes[0])
+        self.assertNotIn(nodes[K].id, self.table)
+        # A node that failed to answer is replaced right away
+        self.table.failed(nodes[3].id)
+        self.assertIsNone(self.table.add(nodes[K]))
+        self.assertNotIn(nodes[3].id, self.table)
+        self.assertIn(nodes[K].id, self.table)
+
+    def test_failing_nodes_are_dropped(self):
+        node = NodeInfo(node_id(0x80), '10.0.0.1', 1)
+        self.table.add(node)
+        self.table.failed(node.id)
+        self.assertTrue(self.table.questionable(node.id))
+        self.table.failed(node.id)
+        self.assertNotIn(node.id, self.table)
+
+    def test_closest(self):
+        nodes = [NodeInfo(os.urandom(20), '10.0.0.1', i + 1) for i in range(200)]
+        for node in nodes:
+            self.table.add(node)
+        target = os.urandom(20)
+        closest = self.table.closest(target, 5)
+        expected = sorted(self.table.nodes(), key=lambda node: distance(node.id, target))[:5]
+        self.assertEqual(closest, expected)
+
+    def test_save_and_load(self):
+        nodes = [NodeInfo(node_id(0x80 >> i), f'10.0.0.{i}', 1000 + i) for i in range(5)]
+        for node in nodes:
+            self.table.add(node)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'dht', 'state')
+            self.table.save(path)
+            self.assertEqual(RoutingTable.load(path), (node_id(0), nodes))
+            with open(path, 'wb') as f:
+                f.write(b'garbage')
+            self.assertIsNone(RoutingTable.load(path))
+
+    def test_compact_nodes(self):
+        nodes = [NodeInfo(os.urandom(20), '10.1.2.3', 6881), NodeInfo(os.urandom(20), '::1', 1)]
+        data = encode_nodes(nodes)
+        self.assertEqual(len(data), 26)
+        self.assertEqual(decode_nodes(data + b'\x00' * 5), nodes[:1])
+
+class TestDHTSwarm(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.nodes = []
+        for _ in range(24):
+            self.nodes.append(await self.start_node())
+        seed = self.nodes[0].address
+        for node in self.nodes[1:]:
+            await node.bootstrap([seed])
+
+    async def asyncTearDown(self):
+        for node in self.nodes:
+            node.close()
+
+    async def start_node(self, **kwargs):
+        return await DHTNode(host='127.0.0.1', query_timeout=0.5, **kwargs).start()
+
+    async def test_find_node(self):
+        target = os.urandom(20)
+        found = await self.nodes[3].find_node(target)
+        others = sorted((node.node_id for node in self.nodes if node is not self.nodes[3]),
+                        key=lambda node: distance(node, target))
+        self.assertEqual([node.id for node in found], others[:K])
+
+    async def test_announce_and_get_peers(self):
+        info_hash = os.urandom(20)
+        await self.nodes[5].announce_peer(info_hash, 6881)
+        # Port 0 announces the DHT port itself (implied_port)
+        await self.nodes[9].announce_peer(info_hash)
+        peers = await self.nodes[17].get_peers(info_hash)
+        self.assertEqual(sorted(peers), sorted([('127.0.0.1', 6881), self.nodes[9].address]))
+        self.assertEqual(await self.nodes[17].get_peers(os.urandom(20)), [])
+
+    async def test_bad_token_is_rejected(self):
+        info_hash = os.urandom(20)
+        target = self.nodes[1]
+        response = await self.nodes[2]._query(target.address, b'announce_peer', {
+            b'info_hash': info_hash, b'port': 1, b'token': b'forged'})
+        self.assertIsNone(response)
+        self.assertNotIn(info_hash, target.peers)
+
+    async def test_dead_nodes_time_out(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        node = self.nodes[4]
+        # Next to our own id, so it lands in a bucket with room for it
+        dead_id = node.node_id[:19] + bytes([node.node_id[19] ^ 1])
+        dead = NodeInfo(dead_id, '127.0.0.1', sock.getsockname()[1])
+        sock.close()
+        self.assertIsNone(node.table.add(dead))
+        found = await node.find_node(dead.id)
+        self.assertNotIn(dead.id, [n.id for n in found])
+        self.assertGreater(node.stats['timeouts'], 0)
+
+    async def test_warm_restart(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'dht.state')
+            node = await self.start_node(state_path=path)
+            await node.bootstrap([self.nodes[0].address])
+            node.close()
+
+            restarted = await self.start_node(state_path=path)
+            self.nodes.append(restarted)
+            self.assertEqual(restarted.node_id, node.node_id)
+            self.assertEqual(len(restarted.table), len(node.table))
+            info_hash = os.urandom(20)
+            await self.nodes[6].announce_peer(info_hash, 7000)
+            # No bootstrap needed
+            self.assertEqual(await restarted.get_peers(info_hash), [('127.0.0.1', 7000)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+from pieces.bencoding import Decoder, Encoder
+from pieces.exceptions import ProtocolError
+from pieces.extension import ExtensionHandshake, PexMessage, UT_PEX
+from pieces.peer import encode_peers
+
+class TestExtensionHandshake(unittest.TestCase):
+
+    def test_round_trip(self):
+        handshake = ExtensionHandshake.decode(ExtensionHandshake(port=6881, reqq=250).encode())
+        self.assertEqual(handshake.extensions, {UT_PEX: 1})
+        self.assertEqual(handshake.port, 6881)
+        self.assertEqual(handshake.reqq, 250)
+
+    def test_advertises_ut_pex(self):
+        message = Decoder(ExtensionHandshake().encode()).decode()
+        self.assertEqual(message[b'm'], {b'ut_pex': 1})
+        self.assertNotIn(b'p', message)
+
+    def test_invalid_fields_are_dropped(self):
+        payload = Encoder({b'm': {b'ut_pex': 300, b'ut_metadata': 2, b'x': b'1'},
+                           b'p': 70000, b'v': 5}).encode()
+        handshake = ExtensionHandshake.decode(payload)
+        self.assertEqual(handshake.extensions, {b'ut_metadata': 2})
+        self.assertIsNone(handshake.port)
+        self.assertIsNone(handshake.version)
+
+    def test_invalid_payload(self):
+        for payload in (b'garbage', b'li1ee', Encoder({b'm': [1]}).encode()):
+            with self.assertRaises(ProtocolError):
+                ExtensionHandshake.decode(payload)
+
+class TestPexMessage(unittest.TestCase):
+
+    def test_round_trip(self):
+        message = PexMessage(added=[('10.0.0.1', 1), ('::1', 2)], dropped=[('10.0.0.2', 3)])
+        decoded = PexMessage.decode(message.encode())
+        self.assertEqual(decoded.added, [('10.0.0.1', 1), ('::1', 2)])
+        self.assertEqual(decoded.dropped, [('10.0.0.2', 3)])
+
+    def test_missing_and_invalid_keys(self):
+        added, _ = encode_peers([('10.0.0.1', 1), ('10.0.0.1', 1)])
+        decoded = PexMessage.decode(Encoder({b'added': added, b'dropped': 5}).encode())
+        self.assertEqual(decoded.added, [('10.0.0.1', 1)])
+        self.assertEqual(decoded.dropped, [])
+
+if __name__ == '__main__':
+    unittest.main()
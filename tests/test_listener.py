@@ -0,0 +1,131 @@
+import asyncio
+import unittest
+from unittest import mock
+from pieces.listener import Listener
+from pieces.protocol import Handshake
+
+INFO_HASH = b'\x01' * 20
+PEER_ID = b'-XX0000-000000000000'
+
+class TestListener(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.accepted = []
+
+    async def asyncTearDown(self):
+        for _, _, writer, _ in self.accepted:
+            writer.close()
+        await self.listener.stop()
+
+    async def start(self, **kwargs):
+        self.listener = Listener(0, '127.0.0.1', **kwargs)
+        self.listener.register(INFO_HASH, self.handler)
+        await self.listener.start()
+
+    def handler(self, peer, reader, writer, handshake):
+        self.accepted.append((peer, reader, writer, handshake))
+        return True
+
+    async def connect(self, info_hash=INFO_HASH, send=True):
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.listener.port)
+        if send:
+            writer.write(Handshake(info_hash, PEER_ID).encode())
+        return reader, writer
+
+    async def closed(self, reader) -> bool:
+        # Closing with our handshake unread resets the connection
+        try:
+            return await asyncio.wait_for(reader.read(), 2) == b''
+        except ConnectionResetError:
+            return True
+
+    async def test_handshake_is_routed_by_info_hash(self):
+        await self.start()
+        _, writer = await self.connect()
+        writer.write(b'more')
+        await asyncio.sleep(0.05)
+        (peer, reader, _, handshake), = self.accepted
+        self.assertEqual(peer[0], '127.0.0.1')
+        self.assertEqual(handshake.peer_id, PEER_ID)
+        # The rest of the stream is left for the peer connection
+        self.assertEqual(await reader.readexactly(4), b'more')
+        writer.close()
+
+    async def test_unknown_torrent_is_dropped(self):
+        await self.start()
+        reader, writer = await self.connect(b'\x02' * 20)
+        self.assertTrue(await self.closed(reader))
+        self.assertEqual(self.accepted, [])
+        writer.close()
+
+    async def test_silent_peer_times_out(self):
+        await self.start(handshake_timeout=0.05)
+        reader, writer = await self.connect(send=False)
+        self.assertTrue(await self.closed(reader))
+        self.assertEqual(self.listener.pending, 0)
+        writer.close()
+
+    async def test_connections_per_address_are_capped(self):
+        await self.start(max_per_ip=2)
+        streams = [await self.connect() for _ in range(3)]
+        self.assertTrue(await self.closed(streams[2][0]))
+        self.assertEqual(len(self.accepted), 2)
+        self.assertEqual(self.listener.per_ip['127.0.0.1'], 2)
+
+        # Closed connections free their slot
+        self.accepted.pop()[2].close()
+        await asyncio.sleep(0.05)
+        await self.connect()
+        await asyncio.sleep(0.05)
+        self.assertEqual(len(self.accepted), 2)
+        for _, writer in streams:
+            writer.close()
+
+    async def test_accept_rate_is_limited(self):
+        await self.start(accept_rate=0.1, accept_burst=2, max_per_ip=10)
+        streams = [await self.connect() for _ in range(3)]
+        self.assertTrue(await self.closed(streams[2][0]))
+        self.assertEqual(len(self.accepted), 2)
+        self.assertEqual(self.listener.refused, 1)
+        for _, writer in streams:
+            writer.close()
+
+    async def test_pending_handshakes_are_capped(self):
+        await self.start(max_pending=1)
+        silent = await self.connect(send=False)
+        await asyncio.sleep(0.05)
+        reader, writer = await self.connect()
+        self.assertTrue(await self.closed(reader))
+        for stream in (silent[1], writer):
+            stream.close()
+
+    async def test_stop_cancels_handshakes_only(self):
+        errors = []
+        asyncio.get_running_loop().set_exception_handler(lambda loop, context: errors.append(context))
+        await self.start()
+        reader, writer = await self.connect(send=False)
+        _, routed = await self.connect()
+        await asyncio.sleep(0.05)
+        self.assertEqual(len(self.listener._handshaking), 1)
+        await self.listener.stop()
+        await asyncio.sleep(0)
+        self.assertEqual(self.listener._handshaking, set())
+        self.assertEqual(self.listener.pending, 0)
+        self.assertTrue(await self.closed(reader))
+        # The connection handed to the torrent is left open
+        (_, _, torrent_writer, _), = self.accepted
+        self.assertFalse(torrent_writer.is_closing())
+        self.assertEqual(errors, [])
+        writer.close()
+        routed.close()
+
+    async def test_reset_connection_is_closed(self):
+        await self.start()
+        writer = mock.Mock()
+        writer.get_extra_info.return_value = None
+        await self.listener._accept(mock.Mock(), writer)
+        writer.close.assert_called_once_with()
+        self.assertEqual(self.listener.per_ip, {})
+
+if __name__ == '__main__':
+    unittest.main()
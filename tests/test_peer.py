@@ -0,0 +1,44 @@
+import socket
+import struct
+import unittest
+from pieces.peer import decode_peers, encode_peers, merge_peers
+
+class TestCompactPeers(unittest.TestCase):
+
+    def test_decode_ipv4(self):
+        data = socket.inet_aton('10.0.0.1') + struct.pack('!H', 6881) + \
+            socket.inet_aton('192.168.1.255') + struct.pack('!H', 1)
+        self.assertEqual(decode_peers(data), [('10.0.0.1', 6881), ('192.168.1.255', 1)])
+
+    def test_decode_ipv6(self):
+        data = socket.inet_pton(socket.AF_INET6, '2001:db8::1') + struct.pack('!H', 51413)
+        self.assertEqual(decode_peers(data, ipv6=True), [('2001:db8::1', 51413)])
+
+    def test_duplicates_partial_entries_and_port_zero(self):
+        peer = socket.inet_aton('10.0.0.1') + struct.pack('!H', 1)
+        zero = socket.inet_aton('10.0.0.2') + struct.pack('!H', 0)
+        other = socket.inet_aton('10.0.0.3') + struct.pack('!H', 3)
+        data = peer + zero + other + peer + b'\x01\x02\x03'
+        self.assertEqual(decode_peers(data), [('10.0.0.1', 1), ('10.0.0.3', 3)])
+        self.assertEqual(decode_peers(memoryview(data)[6:]), [('10.0.0.3', 3), ('10.0.0.1', 1)])
+        self.assertEqual(decode_peers(b''), [])
+
+    def test_round_trip(self):
+        peers = [('10.0.0.1', 1), ('::1', 2), ('1.2.3.4', 65535), ('fe80::abcd', 3)]
+        ipv4, ipv6 = encode_peers(peers)
+        self.assertEqual((len(ipv4), len(ipv6)), (12, 36))
+        self.assertEqual(decode_peers(ipv4) + decode_peers(ipv6, ipv6=True),
+                         [('10.0.0.1', 1), ('1.2.3.4', 65535), ('::1', 2), ('fe80::abcd', 3)])
+
+    def test_large_list(self):
+        peers = [(f'10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}', 1000 + i % 5000)
+                 for i in range(20000)]
+        ipv4, _ = encode_peers(peers + peers[:100])
+        self.assertEqual(decode_peers(ipv4), peers)
+
+    def test_merge(self):
+        self.assertEqual(merge_peers([('a', 1), ('b', 2)], [('b', 2), ('c', 3)]),
+                         [('a', 1), ('b', 2), ('c', 3)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import random
+import unittest
+from pieces.bitset import Bitset
+from pieces.picker import PiecePicker
+
+def bitset(num_pieces, indexes):
+    pieces = Bitset(num_pieces)
+    for index in indexes:
+        pieces.add(index)
+    return pieces
+
+class TestPiecePicker(unittest.TestCase):
+
+    def setUp(self):
+        self.picker = PiecePicker(10, random_first=0)
+
+    def add(self, peer_id, indexes):
+        pieces = bitset(10, indexes)
+        self.picker.add_peer(peer_id, pieces)
+        return pieces
+
+    def test_rarest_first(self):
+        a = self.add('a', [1, 2, 3])
+        self.add('b', [2, 3])
+        self.add('c', [3])
+        self.assertEqual(list(self.picker.availability[:4]), [0, 1, 2, 3])
+        self.assertEqual([self.picker.pick('a', a) for _ in range(4)], [1, 2, 3, None])
+
+    def test_have_updates_availability(self):
+        a = self.add('a', [1, 2])
+        self.add('b', [1])
+        self.picker.peer_has('b', 2)
+        self.picker.peer_has('b', 1)
+        self.add('c', [2])
+        self.assertEqual(self.picker.pick('a', a), 1)
+
+    def test_remove_peer(self):
+        a = self.add('a', [1, 2])
+        self.add('b', [1])
+        self.picker.remove_peer('b', bitset(10, [1]))
+        self.add('c', [2])
+        self.assertEqual(self.picker.pick('a', a), 1)
+
+    def test_seeds_are_not_counted_per_piece(self):
+        seed = self.add('seed', range(10))
+        self.add('a', [0, 1])
+        self.assertEqual(self.picker.seeds, {'seed'})
+        self.assertEqual(self.picker.peer_availability(0), 2)
+        self.assertEqual(self.picker.peer_availability(5), 1)
+        self.assertIn(self.picker.pick('seed', seed), range(2, 10))
+        self.picker.remove_peer('seed', bitset(10, range(10)))
+        self.assertEqual(self.picker.seeds, set())
+
+    def test_restore(self):
+        a = self.add('a', [4])
+        self.assertEqual(self.picker.pick('a', a), 4)
+        self.assertIsNone(self.picker.pick('a', a))
+        self.picker.restore(4)
+        self.assertEqual(self.picker.pick('a', a), 4)
+
+    def test_peer_without_wanted_pieces(self):
+        a = self.add('a', [4])
+        self.picker.remove(4)
+        self.assertIsNone(self.picker.pick('a', a))
+
+    def test_remove(self):
+        a = self.add('a', [4, 5])
+        self.picker.remove(4)
+        self.assertEqual(self.picker.pick('a', a), 5)
+
+    def test_priority(self):
+        a = self.add('a', range(10))
+        self.add('b', range(5))
+        self.picker.set_priority(5, 7, 0)
+        self.picker.set_priority(0, 2, 3)
+        picks = [self.picker.pick('a', a) for _ in range(8)]
+        self.assertEqual(sorted(picks[:2]), [0, 1])
+        self.assertEqual(sorted(picks[2:5]), [7, 8, 9])
+        self.assertEqual(sorted(picks[5:]), [2, 3, 4])
+        self.assertIsNone(self.picker.pick('a', a))
+
+    def test_priority_band(self):
+        a = self.add('a', range(10))
+        self.picker.set_priority(0, 1, 9)
+        self.picker.set_priority(1, 2, 5)
+        self.assertEqual(self.picker.pick('a', a, max_priority=8), 1)
+        self.assertIsNone(self.picker.pick('a', a, min_priority=6, max_priority=8))
+        self.assertEqual(self.picker.pick('a', a, min_priority=6), 0)
+
+    def test_partial_peer_in_large_bucket(self):
+        picker = PiecePicker(1000, random_first=0)
+        late = 3 * PiecePicker.SCAN_LIMIT
+        picker.add_peer('b', bitset(1000, range(0, 1000, 2)))
+        a = bitset(1000, [late, late + 1])
+        picker.add_peer('a', a)
+        self.assertEqual(picker.pick('a', a), late + 1)
+        # The bucket's set follows the pieces moving in and out of it
+        picker.restore(late + 1)
+        self.assertEqual(picker.pick('a', a), late + 1)
+        self.assertEqual(picker.pick('a', a), late)
+        self.assertIsNone(picker.pick('a', a))
+
+    def test_random_first(self):
+        picker = PiecePicker(1000, random_first=4, rng=random.Random(1))
+        everything = Bitset.full(1000)
+        picker.add_peer('a', everything)
+        picker.add_peer('b', bitset(1000, range(10)))
+        picks = [picker.pick('a', everything, downloaded=0) for _ in range(3)]
+        self.assertTrue(all(index >= 10 for index in picks))
+        self.assertEqual(len(set(picks)), 3)
+        self.assertLess(picker.pick('a', everything, downloaded=4), 1000)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,377 @@
+import asyncio
+import os
+import tempfile
+import time
+import unittest
+import bitstring
+from pieces.cache import PieceCache
+from pieces.client import MAX_HASH_FAILURES, PieceManager
+from pieces.timeouts import RttEstimator
+from support import make_torrent
+
+BLOCK = 2**14
+
+class TestPieceManager(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.data = os.urandom(5 * BLOCK + 100)
+        self.torrent = make_torrent(self.directory.name, self.data, 2 * BLOCK)
+        self.manager = PieceManager(self.torrent)
+        self.manager.add_peer('peer', bitstring.BitArray('0b11100000'))
+
+    def tearDown(self):
+        self.manager.close()
+        self.directory.cleanup()
+
+    def download(self, peer_id='peer'):
+        blocks = []
+        block = self.manager.next_request(peer_id)
+        while block:
+            blocks.append(block)
+            block = self.manager.next_request(peer_id)
+        return blocks
+
+    def test_requests_every_block(self):
+        blocks = self.download()
+        self.assertEqual(sorted((b.piece, b.offset, b.length) for b in blocks),
+                         [(0, 0, BLOCK), (0, BLOCK, BLOCK), (1, 0, BLOCK),
+                          (1, BLOCK, BLOCK), (2, 0, BLOCK), (2, BLOCK, 100)])
+        self.assertEqual(len(self.manager.pending_blocks), 6)
+
+    def test_upload(self):
+        self.assertIsNone(self.manager.bitfield())
+        haves = []
+        self.manager.on_have = haves.append
+        for block in self.download():
+            start = block.piece * 2 * BLOCK + block.offset
+            self.manager.block_received('peer', block.piece, block.offset,
+                                        memoryview(self.data[start:start + block.length]))
+        self.assertEqual(sorted(haves), [0, 1, 2])
+        self.assertEqual(self.manager.bitfield(), b'\xe0')
+        self.assertTrue(self.manager.can_upload(2, BLOCK, 100))
+        self.assertFalse(self.manager.can_upload(2, BLOCK, 101))
+        self.assertFalse(self.manager.can_upload(3, 0, BLOCK))
+        self.assertFalse(self.manager.can_upload(0, 0, 0))
+
+        buffers = [bytearray(BLOCK), bytearray(100)]
+        asyncio.run(self.manager.read_blocks([(1, BLOCK, buffers[0]), (2, BLOCK, buffers[1])]))
+        self.assertEqual(buffers, [self.data[3 * BLOCK:4 * BLOCK], self.data[5 * BLOCK:]])
+
+    def test_uploads_are_served_from_the_cache(self):
+        for block in self.download():
+            self.receive('peer', block)
+        self.assertEqual(len(self.manager.cache.entries), 3)
+        self.assertEqual(self.manager.cache.write_bytes, 0)
+        # Served from the cache even if the file changed on disk since
+        with open(self.torrent.output_file, 'r+b') as f:
+            f.write(bytes(len(self.data)))
+        buffer = bytearray(BLOCK)
+        asyncio.run(self.manager.read_blocks([(0, BLOCK, buffer)]))
+        self.assertEqual(buffer, self.data[BLOCK:2 * BLOCK])
+        self.assertEqual(self.manager.cache.hits, 1)
+
+    def test_popular_piece_is_read_into_the_cache(self):
+        for block in self.download():
+            self.receive('peer', block)
+        self.manager.cache.entries.clear()
+        self.manager.cache.read_bytes = 0
+        for _ in range(2):
+            buffer = bytearray(BLOCK)
+            asyncio.run(self.manager.read_blocks([(1, 0, buffer)]))
+            self.assertEqual(buffer, self.data[2 * BLOCK:3 * BLOCK])
+        self.assertEqual(self.manager.cache.get(self.manager._cache_key(1)),
+                         self.data[2 * BLOCK:4 * BLOCK])
+
+    def test_cache_budget_holds_back_new_pieces(self):
+        self.manager.close()
+        self.manager = PieceManager(self.torrent, cache=PieceCache(3 * BLOCK))
+        self.manager.add_peer('peer', bitstring.BitArray('0b11100000'))
+        blocks = self.download()
+        self.assertEqual({b.piece for b in blocks}, {blocks[0].piece})
+        for block in blocks:
+            self.receive('peer', block)
+        self.assertIsNotNone(self.manager.next_request('peer'))
+
+    def test_pieces_no_peer_has_are_dropped(self):
+        self.manager.add_peer('other', bitstring.BitArray('0b10000000'))
+        self.manager.picker.random_first = 0
+        block = self.manager.next_request('peer')
+        self.receive('peer', block)
+        self.assertNotEqual(block.piece, 0)
+        self.manager.remove_peer('peer')
+        self.assertEqual(self.manager.ongoing_pieces, {})
+        self.assertEqual(self.manager.cache.write_bytes, 0)
+        self.assertEqual(self.manager.state.retrieved[block.piece], 0)
+        # Downloaded again from the start once a peer has it
+        self.manager.add_peer('late', bitstring.BitArray('0b11100000'))
+        self.assertEqual(self.manager.next_request('late').piece, block.piece)
+
+    def test_unknown_peer(self):
+        self.assertIsNone(self.manager.next_request('other'))
+
+    def test_complete_download(self):
+        for block in self.download():
+            start = block.piece * 2 * BLOCK + block.offset
+            self.manager.block_received('peer', block.piece, block.offset,
+                                        memoryview(self.data[start:start + block.length]))
+        self.assertTrue(self.manager.complete)
+        self.assertEqual(self.manager.have_pieces, [0, 1, 2])
+        self.assertEqual(self.manager.bytes_downloaded, len(self.data))
+        self.assertEqual(self.manager.pending_blocks, {})
+        with open(self.torrent.output_file, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_writes_off_the_event_loop(self):
+        async def run():
+            for block in reversed(self.download()):
+                start = block.piece * 2 * BLOCK + block.offset
+                self.manager.block_received('peer', block.piece, block.offset,
+                                            self.data[start:start + block.length])
+            self.assertFalse(self.manager.complete)
+            await asyncio.gather(*self.manager._writes)
+        asyncio.run(run())
+        self.assertTrue(self.manager.complete)
+        with open(self.torrent.output_file, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_close_waits_for_writes(self):
+        async def run():
+            for block in self.download():
+                start = block.piece * 2 * BLOCK + block.offset
+                self.manager.block_received('peer', block.piece, block.offset,
+                                            self.data[start:start + block.length])
+            await self.manager.close_async()
+        asyncio.run(run())
+        self.assertTrue(self.manager.complete)
+        with open(self.torrent.output_file, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_corrupt_piece_is_requested_again(self):
+        blocks = self.download()
+        for block in [b for b in blocks if b.piece == 0]:
+            self.manager.block_received('peer', block.piece, block.offset, b'\0' * block.length)
+        self.assertFalse(self.manager.state.has(0))
+        block = self.manager.next_request('peer')
+        self.assertEqual((block.piece, block.offset), (0, 0))
+
+    def test_peers_sending_corrupt_pieces_are_banned(self):
+        bans = []
+        self.manager.on_ban = bans.append
+        for _ in range(MAX_HASH_FAILURES):
+            blocks = [self.manager.next_request('peer') for _ in range(2)]
+            piece = blocks[0].piece
+            for block in blocks:
+                self.assertEqual(block.piece, piece)
+                self.manager.block_received('peer', block.piece, block.offset, b'\0' * block.length)
+            self.assertFalse(self.manager.state.has(piece))
+        self.assertEqual(self.manager.hash_failures['peer'], MAX_HASH_FAILURES)
+        self.assertIn('peer', self.manager.banned)
+        self.assertEqual(bans, ['peer'])
+        self.assertIsNone(self.manager.next_request('peer'))
+
+    def test_rarest_piece_first(self):
+        self.manager.picker.random_first = 0
+        self.manager.add_peer('other', bitstring.BitArray('0b01100000'))
+        self.manager.update_peer('late', 2)
+        self.assertEqual(self.manager.next_request('peer').piece, 0)
+        self.assertEqual(self.manager.next_request('peer').piece, 0)
+        self.assertEqual(self.manager.next_request('other').piece, 1)
+        self.manager.remove_peer('late')
+        self.assertEqual(self.manager.picker.peer_availability(2), 2)
+
+    def receive(self, peer_id, block):
+        start = block.piece * 2 * BLOCK + block.offset
+        self.manager.block_received(peer_id, block.piece, block.offset,
+                                    memoryview(self.data[start:start + block.length]))
+
+    def test_endgame(self):
+        cancels = []
+        self.manager.on_cancel = lambda peers, block: cancels.append((peers, block.piece, block.offset))
+        self.manager.add_peer('other', bitstring.BitArray('0b11100000'))
+        blocks = self.download()
+        self.assertTrue(self.manager.endgame)
+        # Every pending block is requested again from the other peer
+        duplicates = []
+        block = self.manager.next_request('other')
+        while block:
+            duplicates.append(block)
+            block = self.manager.next_request('other')
+        self.assertEqual(sorted((b.piece, b.offset) for b in duplicates),
+                         sorted((b.piece, b.offset) for b in blocks))
+
+        self.receive('other', blocks[0])
+        self.assertEqual(cancels, [({'peer'}, blocks[0].piece, blocks[0].offset)])
+        # The copy that was already under way is discarded
+        self.receive('peer', blocks[0])
+        self.assertEqual(self.manager.duplicate_bytes, blocks[0].length)
+        for block in blocks[1:]:
+            self.receive('peer', block)
+        self.assertTrue(self.manager.complete)
+        self.assertEqual(len(cancels), len(blocks))
+
+    def test_no_endgame_while_blocks_are_missing(self):
+        self.manager.next_request('peer')
+        self.assertFalse(self.manager._in_endgame())
+        self.assertFalse(self.manager.endgame)
+
+    def test_stalled_request_is_reassigned(self):
+        cancels = []
+        self.manager.on_cancel = lambda peers, block: cancels.append((peers, block.piece, block.offset))
+        self.manager.add_peer('other', bitstring.BitArray('0b11100000'))
+        self.manager.timing['peer'] = RttEstimator(initial=0.01, min_timeout=0.01)
+        stalled = self.manager.next_request('peer')
+        time.sleep(0.02)
+        block = self.manager.next_request('other')
+        self.assertEqual((block.piece, block.offset), (stalled.piece, stalled.offset))
+        self.assertEqual(cancels, [({'peer'}, stalled.piece, stalled.offset)])
+        self.assertTrue(self.manager.is_snubbed('peer'))
+        self.assertFalse(self.manager.is_snubbed('other'))
+
+        # A block from the snubbed peer clears it
+        other = self.manager.next_request('peer')
+        self.receive('peer', other)
+        self.assertFalse(self.manager.is_snubbed('peer'))
+
+    def test_stalled_endgame_request_expires_once_alone(self):
+        cancels = []
+        self.manager.on_cancel = lambda peers, block: cancels.append((peers, block.piece, block.offset))
+        self.manager.add_peer('other', bitstring.BitArray('0b11100000'))
+        self.manager.timing['peer'] = RttEstimator(initial=0.01, min_timeout=0.01)
+        self.download()
+        raced = self.manager.next_request('other')
+        key = (raced.piece, raced.offset)
+        time.sleep(0.05)
+        self.manager._expire_requests()
+        # Still racing, the request is kept
+        self.assertEqual(self.manager.pending_blocks[key].peers, {'peer', 'other'})
+        self.manager.remove_peer('other')
+        time.sleep(0.05)
+        self.manager._expire_requests()
+        self.assertNotIn(key, self.manager.pending_blocks)
+        self.assertEqual(cancels[-1], ({'peer'}, raced.piece, raced.offset))
+        self.assertTrue(self.manager.is_snubbed('peer'))
+
+    def test_round_trips_are_measured(self):
+        block = self.manager.next_request('peer')
+        self.receive('peer', block)
+        self.assertIsNotNone(self.manager.timing['peer'].srtt)
+
+    def test_requests_of_removed_peer_are_released(self):
+        self.manager.add_peer('other', bitstring.BitArray('0b11100000'))
+        blocks = [self.manager.next_request('peer') for _ in range(2)]
+        self.manager.remove_peer('peer')
+        self.assertEqual(self.manager.pending_blocks, {})
+        block = self.manager.next_request('other')
+        self.assertEqual((block.piece, block.offset), (blocks[0].piece, blocks[0].offset))
+
+    def test_requests_of_choking_peer_are_released(self):
+        self.manager.add_peer('other', bitstring.BitArray('0b11100000'))
+        choked = self.manager.next_request('peer')
+        self.manager.release_requests('peer')
+        block = self.manager.next_request('other')
+        self.assertEqual((block.piece, block.offset), (choked.piece, choked.offset))
+        # Choking is no timeout: the peer keeps its full request window
+        self.assertFalse(self.manager.is_snubbed('peer'))
+        self.assertIn('peer', self.manager.peers)
+
+    def test_unexpected_block(self):
+        self.manager.block_received('peer', 1, 0, b'\0' * BLOCK)
+        self.assertEqual(self.manager.state.retrieved[1], 0)
+
+class TestPieceManagerResume(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.resume_dir = os.path.join(self.directory.name, 'resume')
+        self.data = os.urandom(8 * BLOCK)
+        self.torrent = make_torrent(self.directory.name, self.data, 2 * BLOCK)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def start(self, force_recheck=False):
+        manager = PieceManager(self.torrent, self.resume_dir)
+        checked = []
+        recheck = manager._recheck
+
+        async def spy(indexes):
+            checked.extend(indexes)
+            return await recheck(indexes)
+        manager._recheck = spy
+        asyncio.run(manager.load(force_recheck))
+        return manager, checked
+
+    def download(self, manager, pieces):
+        manager.add_peer('peer', bitstring.BitArray('0xff'))
+        block = manager.next_request('peer')
+        while block:
+            if block.piece in pieces:
+                start = block.piece * 2 * BLOCK + block.offset
+                manager.block_received('peer', block.piece, block.offset,
+                                       self.data[start:start + block.length])
+            block = manager.next_request('peer')
+
+    def test_fresh_download_is_not_rechecked(self):
+        manager, checked = self.start()
+        self.assertEqual(checked, [])
+        manager.close()
+
+    def test_restart_trusts_resume_data(self):
+        manager, _ = self.start()
+        self.download(manager, {0, 2})
+        manager.close()
+
+        manager, checked = self.start()
+        self.assertEqual(checked, [])
+        self.assertEqual(manager.have_pieces, [0, 2])
+        manager.close()
+
+    def test_crash_keeps_journaled_pieces(self):
+        manager, _ = self.start()
+        self.download(manager, {1, 3})
+        manager.verifier.close()
+        manager.storage.close()
+        manager.resume.close()
+
+        manager, checked = self.start()
+        self.assertEqual(checked, [])
+        self.assertEqual(manager.have_pieces, [1, 3])
+        manager.close()
+
+    def test_changed_files_are_rechecked(self):
+        manager, _ = self.start()
+        self.download(manager, {0, 1})
+        manager.close()
+        os.utime(self.torrent.output_file, ns=(0, 12345))
+
+        manager, checked = self.start()
+        self.assertEqual(checked, [0, 1, 2, 3])
+        self.assertEqual(manager.have_pieces, [0, 1])
+        manager.close()
+
+    def test_missing_resume_data_rechecks_existing_files(self):
+        manager = PieceManager(self.torrent)
+        self.download(manager, {3})
+        manager.close()
+
+        manager, checked = self.start()
+        self.assertEqual(checked, [0, 1, 2, 3])
+        self.assertEqual(manager.have_pieces, [3])
+        self.assertIsNone(manager.check_progress)
+        manager.close()
+
+    def test_force_recheck_ignores_resume_data(self):
+        manager, _ = self.start()
+        self.download(manager, {0, 2})
+        manager.close()
+        with open(self.torrent.output_file, 'r+b') as f:
+            f.write(b'corrupt')
+
+        manager, checked = self.start(force_recheck=True)
+        self.assertEqual(checked, [0, 1, 2, 3])
+        self.assertEqual(manager.have_pieces, [2])
+        manager.close()
+
+if __name__ == '__main__':
+    unittest.main()
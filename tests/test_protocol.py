@@ -0,0 +1,384 @@
+import asyncio
+import struct
+import unittest
+from pieces.exceptions import ProtocolError
+from pieces.extension import ExtensionHandshake, PexMessage
+from pieces.protocol import (BitField, Cancel, Extended, Handshake, Have, Interested,
+                             KeepAlive, MessageFramer, PeerConnection, PeerMessage, Piece,
+                             Request, RequestWindow, Unchoke, EXTENSION_RESERVED,
+                             REQUEST_SIZE)
+from pieces.ratelimit import TokenBucket
+
+INFO_HASH = b'\x01' * 20
+REMOTE_ID = b'-RM0001-000000000000'
+SEED_DATA = bytes(range(256)) * 256
+
+class FakeBlock:
+    def __init__(self, piece, offset, length=REQUEST_SIZE):
+        self.piece = piece
+        self.offset = offset
+        self.length = length
+
+class FakePieceManager:
+    def __init__(self, blocks):
+        self.blocks = list(blocks)
+        self.peers = {}
+        self.banned = set()
+
+    def add_peer(self, peer_id, bitfield):
+        self.peers[peer_id] = bitfield
+
+    def update_peer(self, peer_id, index):
+        pass
+
+    def remove_peer(self, peer_id):
+        self.peers.pop(peer_id, None)
+
+    def is_interested(self, peer_id):
+        return peer_id in self.peers
+
+    def next_request(self, peer_id):
+        return self.blocks.pop(0) if self.blocks else None
+
+    def is_snubbed(self, peer_id):
+        return False
+
+    def bitfield(self):
+        return None
+
+class FakeSeedManager(FakePieceManager):
+    """
+    Has the two pieces of `SEED_DATA`, pieces being two blocks long.
+    """
+    def __init__(self):
+        super().__init__([])
+        self.uploaded = 0
+
+    def bitfield(self):
+        return b'\xc0'
+
+    def can_upload(self, index, begin, length):
+        return index < 2 and begin + length <= 2 * REQUEST_SIZE
+
+    async def read_blocks(self, blocks):
+        for index, begin, buffer in blocks:
+            start = index * 2 * REQUEST_SIZE + begin
+            buffer[:] = SEED_DATA[start:start + len(buffer)]
+
+    def record_upload(self, length):
+        self.uploaded += length
+
+class TestHandshake(unittest.TestCase):
+
+    def test_round_trip(self):
+        data = Handshake(INFO_HASH, REMOTE_ID).encode()
+        self.assertEqual(len(data), Handshake.length)
+        handshake = Handshake.decode(data)
+        self.assertEqual(handshake.info_hash, INFO_HASH)
+        self.assertEqual(handshake.peer_id, REMOTE_ID)
+
+    def test_extension_bit(self):
+        handshake = Handshake.decode(Handshake(INFO_HASH, REMOTE_ID, EXTENSION_RESERVED).encode())
+        self.assertTrue(handshake.supports_extensions)
+        self.assertFalse(Handshake(INFO_HASH, REMOTE_ID).supports_extensions)
+
+    def test_invalid_protocol(self):
+        data = bytearray(Handshake(INFO_HASH, REMOTE_ID).encode())
+        data[1:20] = b'x' * 19
+        self.assertIsNone(Handshake.decode(bytes(data)))
+
+class TestMessageFramer(unittest.TestCase):
+
+    def stream(self):
+        return b''.join([
+            KeepAlive().encode(),
+            Interested().encode(),
+            Have(7).encode(),
+            Request(1, REQUEST_SIZE, REQUEST_SIZE).encode(),
+            Piece(1, REQUEST_SIZE, bytes(range(256)) * 64).encode(),
+            Cancel(1, REQUEST_SIZE, REQUEST_SIZE).encode(),
+        ])
+
+    def check(self, messages):
+        self.assertEqual([type(m) for m in messages],
+                         [KeepAlive, Interested, Have, Request, Piece, Cancel])
+        self.assertEqual(messages[2].index, 7)
+        self.assertEqual((messages[3].index, messages[3].begin, messages[3].length),
+                         (1, REQUEST_SIZE, REQUEST_SIZE))
+        self.assertEqual((messages[5].index, messages[5].begin), (1, REQUEST_SIZE))
+
+    def test_whole_stream(self):
+        framer = MessageFramer()
+        framer.feed(self.stream())
+        messages = list(framer)
+        self.check(messages)
+        piece = messages[4]
+        self.assertIsInstance(piece.block, memoryview)
+        self.assertEqual(piece.block, bytes(range(256)) * 64)
+        self.assertEqual(len(framer), 0)
+
+    def test_partial_reads(self):
+        framer = MessageFramer(capacity=1024)
+        messages = []
+        data = self.stream()
+        for i in range(0, len(data), 7):
+            framer.feed(data[i:i + 7])
+            for message in framer:
+                if isinstance(message, Piece):
+                    self.assertEqual(bytes(message.block), bytes(range(256)) * 64)
+                messages.append(message)
+        self.check(messages)
+
+    def test_bitfield(self):
+        framer = MessageFramer(capacity=16)
+        payload = b'\xff' * 100
+        framer.feed(struct.pack('>IB', 1 + len(payload), PeerMessage.BitField) + payload)
+        message = framer.next_message()
+        self.assertIsInstance(message, BitField)
+        self.assertEqual(message.bitfield.bytes, payload)
+
+    def test_unknown_message(self):
+        framer = MessageFramer()
+        framer.feed(struct.pack('>IB', 1, 99))
+        with self.assertRaises(ProtocolError):
+            framer.next_message()
+
+    def test_extended(self):
+        framer = MessageFramer()
+        framer.feed(Extended(1, b'd5:added0:e').encode())
+        message = framer.next_message()
+        self.assertIsInstance(message, Extended)
+        self.assertEqual((message.extended_id, message.payload), (1, b'd5:added0:e'))
+        self.assertIsNone(framer.next_message())
+
+    def test_invalid_length(self):
+        framer = MessageFramer()
+        framer.feed(struct.pack('>IBI', 5, PeerMessage.Request, 1))
+        with self.assertRaises(ProtocolError):
+            framer.next_message()
+
+class TestRequestWindow(unittest.TestCase):
+
+    def test_starts_at_minimum(self):
+        window = RequestWindow(5, 250)
+        self.assertEqual(window.size, 5)
+        self.assertEqual(window.available, 5)
+
+    def test_sized_to_bandwidth_delay_product(self):
+        window = RequestWindow(5, 250)
+        # 100 ms round-trips at 10 blocks per 100 ms => ~1.6 MB/s
+        now = 0.0
+        for i in range(100):
+            window.add(FakeBlock(0, i * REQUEST_SIZE), now=now)
+            now += 0.01
+            window.complete(0, i * REQUEST_SIZE, REQUEST_SIZE, now=now + 0.09)
+        self.assertAlmostEqual(window.min_rtt, 0.1)
+        # Twice the bandwidth-delay product of ~10 blocks
+        self.assertTrue(18 <= window.size <= 20, window.size)
+
+    def test_clamped_to_maximum(self):
+        window = RequestWindow(5, 8)
+        window.min_rtt = 1.0
+        window.rate = 100 * REQUEST_SIZE
+        self.assertEqual(window.size, 8)
+
+    def test_unknown_block(self):
+        window = RequestWindow()
+        self.assertIsNone(window.complete(1, 0, REQUEST_SIZE))
+
+    def test_discard(self):
+        window = RequestWindow()
+        window.add(FakeBlock(1, 0))
+        self.assertTrue(window.discard(1, 0))
+        self.assertFalse(window.discard(1, 0))
+        self.assertEqual(len(window), 0)
+        self.assertIsNone(window.min_rtt)
+
+class TestPeerConnection(unittest.IsolatedAsyncioTestCase):
+
+    async def test_pipelined_download(self):
+        requests = []
+
+        async def seeder(reader, writer):
+            await reader.readexactly(Handshake.length)
+            writer.write(Handshake(INFO_HASH, REMOTE_ID).encode())
+            writer.write(BitField(b'\xc0').encode())
+            await writer.drain()
+            interested = PeerMessage.decode(await reader.readexactly(5))
+            self.assertIsInstance(interested, Interested)
+            writer.write(Unchoke().encode())
+            await writer.drain()
+            while len(requests) < 8:
+                request = PeerMessage.decode(await reader.readexactly(17))
+                self.assertIsInstance(request, Request)
+                requests.append(request)
+                writer.write(Piece(request.index, request.begin, b'x' * request.length).encode())
+                await writer.drain()
+
+        server = await asyncio.start_server(seeder, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        received = []
+        done = asyncio.Event()
+
+        def on_block(peer_id, piece_index, block_offset, data):
+            received.append((peer_id, piece_index, block_offset, len(data)))
+            if len(received) == 8:
+                done.set()
+
+        queue = asyncio.Queue()
+        queue.put_nowait(('127.0.0.1', port))
+        manager = FakePieceManager(FakeBlock(i // 4, (i % 4) * REQUEST_SIZE) for i in range(8))
+        peer = PeerConnection(queue, INFO_HASH, '-PC0001-000000000000', manager, on_block)
+        await asyncio.wait_for(done.wait(), 5)
+        peer.stop()
+        server.close()
+        await server.wait_closed()
+
+        self.assertEqual([(r.index, r.begin) for r in requests],
+                         [(i // 4, (i % 4) * REQUEST_SIZE) for i in range(8)])
+        self.assertTrue(all(r[0] == REMOTE_ID for r in received))
+        self.assertEqual(len(received), 8)
+
+    async def test_connection_to_ourselves_is_dropped(self):
+        closed = asyncio.Event()
+
+        async def mirror(reader, writer):
+            # Answers with the handshake it received, our own peer_id
+            writer.write(await reader.readexactly(Handshake.length))
+            await writer.drain()
+            if await reader.read() == b'':
+                closed.set()
+
+        server = await asyncio.start_server(mirror, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        queue = asyncio.Queue()
+        queue.put_nowait(('127.0.0.1', port))
+        manager = FakePieceManager([])
+        peer = PeerConnection(queue, INFO_HASH, '-PC0001-000000000000', manager)
+        await asyncio.wait_for(closed.wait(), 5)
+        peer.stop()
+        server.close()
+        await server.wait_closed()
+        self.assertIsNone(peer.remote_id)
+        self.assertEqual(manager.peers, {})
+
+    async def test_banned_peer_is_dropped(self):
+        closed = asyncio.Event()
+
+        async def banned(reader, writer):
+            await reader.readexactly(Handshake.length)
+            writer.write(Handshake(INFO_HASH, REMOTE_ID).encode())
+            await writer.drain()
+            if await reader.read() == b'':
+                closed.set()
+
+        server = await asyncio.start_server(banned, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        queue = asyncio.Queue()
+        queue.put_nowait(('127.0.0.1', port))
+        manager = FakePieceManager([])
+        manager.banned.add(REMOTE_ID)
+        peer = PeerConnection(queue, INFO_HASH, '-PC0001-000000000000', manager)
+        await asyncio.wait_for(closed.wait(), 5)
+        peer.stop()
+        server.close()
+        await server.wait_closed()
+        self.assertIsNone(peer.remote_id)
+        self.assertEqual(manager.peers, {})
+
+    async def test_peer_exchange(self):
+        received = asyncio.Queue()
+
+        async def seeder(reader, writer):
+            handshake = Handshake.decode(await reader.readexactly(Handshake.length))
+            self.assertTrue(handshake.supports_extensions)
+            writer.write(Handshake(INFO_HASH, REMOTE_ID, EXTENSION_RESERVED).encode())
+            await writer.drain()
+            header = await reader.readexactly(4)
+            message = PeerMessage.decode(header + await reader.readexactly(
+                struct.unpack('>I', header)[0]))
+            self.assertIsInstance(message, Extended)
+            handshake = ExtensionHandshake.decode(message.payload)
+            self.assertEqual(handshake.extensions, {b'ut_pex': 1})
+            self.assertEqual(handshake.port, 6881)
+            writer.write(Extended(0, ExtensionHandshake({b'ut_pex': 3}).encode()).encode())
+            # The second ut_pex arrives too early and is ignored
+            for peers in ([('10.0.0.1', 1), ('10.0.0.2', 2)], [('10.0.0.3', 3)]):
+                writer.write(Extended(1, PexMessage(added=peers).encode()).encode())
+            await writer.drain()
+            await reader.read()
+
+        server = await asyncio.start_server(seeder, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        queue = asyncio.Queue()
+        queue.put_nowait(('127.0.0.1', port))
+        peer = PeerConnection(queue, INFO_HASH, '-PC0001-000000000000', FakePieceManager([]),
+                              on_peers=received.put_nowait, port=6881)
+        peers = await asyncio.wait_for(received.get(), 5)
+        await asyncio.sleep(0.05)
+        self.assertEqual(peer.remote_extensions, {b'ut_pex': 3})
+        peer.stop()
+        server.close()
+        await server.wait_closed()
+
+        self.assertEqual(peers, [('10.0.0.1', 1), ('10.0.0.2', 2)])
+        self.assertTrue(received.empty())
+
+    async def test_upload(self):
+        received = []
+        done = asyncio.Event()
+
+        async def read_message(reader):
+            header = await reader.readexactly(4)
+            return PeerMessage.decode(header + await reader.readexactly(
+                struct.unpack('>I', header)[0]))
+
+        async def leecher(reader, writer):
+            await reader.readexactly(Handshake.length)
+            writer.write(Handshake(INFO_HASH, REMOTE_ID).encode())
+            writer.write(Interested().encode())
+            await writer.drain()
+            bitfield = await read_message(reader)
+            self.assertEqual(bitfield.bitfield.bytes, b'\xc0')
+            # Requests of a choked peer are ignored
+            writer.write(Request(0, 0).encode())
+            await writer.drain()
+            self.assertIsInstance(await read_message(reader), Unchoke)
+            for index, begin in [(0, 0), (1, REQUEST_SIZE), (5, 0), (0, REQUEST_SIZE)]:
+                writer.write(Request(index, begin).encode())
+            writer.write(Cancel(0, REQUEST_SIZE).encode())
+            await writer.drain()
+            while True:
+                message = await read_message(reader)
+                received.append((message.index, message.begin, bytes(message.block)))
+                if message.index == 1:
+                    done.set()
+
+        server = await asyncio.start_server(leecher, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        manager = FakeSeedManager()
+        uploads, downloads = TokenBucket(), TokenBucket()
+        peer = PeerConnection(None, INFO_HASH, '-PC0001-000000000000', manager,
+                              upload_limit=uploads, download_limit=downloads)
+        task = asyncio.ensure_future(peer.run('127.0.0.1', port))
+        while 'interested' not in peer.peer_state:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.05)
+        peer.unchoke()
+        await asyncio.wait_for(done.wait(), 5)
+        await asyncio.sleep(0.05)
+        task.cancel()
+        server.close()
+        await server.wait_closed()
+
+        # The cancelled and the invalid requests are not served
+        self.assertEqual(received, [(0, 0, SEED_DATA[:REQUEST_SIZE]),
+                                        (1, REQUEST_SIZE, SEED_DATA[3 * REQUEST_SIZE:])])
+        self.assertEqual(peer.uploaded, manager.uploaded)
+        self.assertEqual(manager.uploaded, 2 * REQUEST_SIZE)
+        # Transfers are charged to the rate limits
+        self.assertEqual(uploads.transferred, 2 * REQUEST_SIZE)
+        self.assertGreater(downloads.transferred, 0)
+
+if __name__ == '__main__':
+    unittest.main()
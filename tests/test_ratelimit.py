@@ -0,0 +1,87 @@
+import asyncio
+import time
+import unittest
+from pieces.ratelimit import TokenBucket, limiter
+
+class TestTokenBucket(unittest.IsolatedAsyncioTestCase):
+
+    async def test_unlimited(self):
+        bucket = TokenBucket()
+        for _ in range(100):
+            await bucket.acquire(10**9)
+        self.assertEqual(bucket.transferred, 100 * 10**9)
+
+    async def test_rate_is_enforced(self):
+        bucket = TokenBucket(10**6, burst=10**4, interval=0.01)
+        start = time.monotonic()
+        for _ in range(20):
+            await bucket.acquire(10**4)
+        # The first 10 KB come from the burst
+        self.assertGreaterEqual(time.monotonic() - start, 0.18)
+
+    async def test_large_transfers_go_into_debt(self):
+        bucket = TokenBucket(10**6, burst=10**4, interval=0.01)
+        start = time.monotonic()
+        await bucket.acquire(10**5)
+        self.assertLess(time.monotonic() - start, 0.01)
+        await bucket.acquire(1)
+        self.assertGreaterEqual(time.monotonic() - start, 0.08)
+
+    async def test_parent_limits_children(self):
+        parent = TokenBucket(10**6, burst=10**4, interval=0.01)
+        children = [TokenBucket(parent=parent) for _ in range(2)]
+        start = time.monotonic()
+
+        async def transfer(bucket):
+            for _ in range(10):
+                await bucket.acquire(10**4)
+        await asyncio.gather(*(transfer(child) for child in children))
+        self.assertGreaterEqual(time.monotonic() - start, 0.18)
+        self.assertEqual(parent.transferred, 2 * 10**5)
+
+    async def test_waiting_transfers_share_fairly(self):
+        bucket = TokenBucket(10**6, burst=10**4, interval=0.01)
+        counts = [0, 0, 0]
+        # Use up the burst so every transfer queues
+        await bucket.acquire(10**4)
+
+        async def transfer(index):
+            while True:
+                await bucket.acquire(10**4)
+                counts[index] += 1
+        tasks = [asyncio.ensure_future(transfer(index)) for index in range(3)]
+        await asyncio.sleep(0.3)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.assertLessEqual(max(counts) - min(counts), 1)
+        self.assertLessEqual(sum(counts), 33)
+
+    async def test_cancelled_transfer_is_skipped(self):
+        bucket = TokenBucket(10**6, burst=10**4, interval=0.01)
+        await bucket.acquire(10**5)
+        waiting = asyncio.ensure_future(bucket.acquire(10**4))
+        await asyncio.sleep(0)
+        waiting.cancel()
+        await asyncio.wait_for(bucket.acquire(10**4), 1)
+        self.assertEqual(bucket.transferred, 11 * 10**4)
+
+    async def test_removing_the_rate_releases_waiters(self):
+        bucket = TokenBucket(10, burst=10)
+        await bucket.acquire(10**6)
+        waiting = asyncio.ensure_future(bucket.acquire(1))
+        await asyncio.sleep(0)
+        bucket.set_rate(None)
+        await asyncio.wait_for(waiting, 1)
+
+class TestLimiter(unittest.TestCase):
+
+    def test_levels_without_rate_are_skipped(self):
+        parent = TokenBucket(100)
+        self.assertIsNone(limiter(None))
+        self.assertIs(limiter(None, parent), parent)
+        child = limiter(10, parent)
+        self.assertEqual((child.rate, child.parent), (10, parent))
+
+if __name__ == '__main__':
+    unittest.main()
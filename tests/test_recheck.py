@@ -0,0 +1,115 @@
+import asyncio
+import hashlib
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+from pieces import recheck
+from pieces.recheck import Rechecker
+from pieces.storage import Storage
+from pieces.torrent import Torrent
+from pieces.verify import PieceVerifier
+
+PIECE = 2**14
+
+class TestRechecker(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.data = os.urandom(6 * PIECE + 100)
+        # Pieces 1 and 3 span file boundaries, the empty file spans nothing
+        self.files = [(b'a', PIECE + 10), (b'empty', 0), (b'b', 2 * PIECE), (b'c', 3 * PIECE + 90)]
+        hashes = b''.join(hashlib.sha1(self.data[i:i + PIECE]).digest()
+                          for i in range(0, len(self.data), PIECE))
+        info = {b'name': b'test', b'piece length': PIECE, b'pieces': hashes,
+                b'files': [{b'length': length, b'path': [name]} for name, length in self.files]}
+        self.torrent = Torrent({b'announce': b'http://localhost/announce', b'info': info},
+                               self.directory.name)
+        self.storage = Storage(self.torrent)
+        self.verifier = PieceVerifier(max_workers=2)
+
+    def tearDown(self):
+        self.verifier.close()
+        self.storage.close()
+        self.directory.cleanup()
+
+    def write_files(self):
+        self.storage.write(0, self.data)
+
+    def run_check(self, indexes=range(7), progress=None):
+        rechecker = Rechecker(self.storage, self.torrent.pieces, self.verifier, progress)
+        return asyncio.run(rechecker.run(indexes))
+
+    def test_complete_data(self):
+        self.write_files()
+        self.assertEqual(self.run_check(), list(range(7)))
+
+    def test_corrupt_piece_across_files(self):
+        self.write_files()
+        # Last byte of file 'a' belongs to piece 1
+        self.storage.write(PIECE + 9, b'\x00' if self.data[PIECE + 9] else b'\x01')
+        self.assertEqual(self.run_check(), [0, 2, 3, 4, 5, 6])
+
+    def test_missing_and_short_files(self):
+        self.write_files()
+        self.storage.close()
+        os.remove(self.storage.files[2].path)
+        with open(self.storage.files[3].path, 'r+b') as f:
+            f.truncate(2 * PIECE)
+        self.assertEqual(self.run_check(), [0, 4])
+
+    def test_sparse_files(self):
+        self.storage.preallocate()
+        self.assertEqual(self.run_check(), [])
+
+    def test_progress_in_batches(self):
+        self.write_files()
+        progress = []
+        with mock.patch.object(recheck, 'BATCH_SIZE', 2 * PIECE):
+            verified = self.run_check([6, 0, 1, 2, 4],
+                                      lambda done, total: progress.append((done, total)))
+        self.assertEqual(verified, [0, 1, 2, 4, 6])
+        self.assertEqual(progress[0], (0, 5))
+        self.assertEqual(progress[-1], (5, 5))
+        self.assertEqual(progress, sorted(progress))
+
+    def test_cancel_waits_for_running_jobs(self):
+        self.write_files()
+        hashing = threading.Event()
+
+        class SlowHash:
+            def __init__(self):
+                self.hasher = hashlib.sha1()
+
+            def update(self, data):
+                hashing.set()
+                time.sleep(0.05)  # Holding a view into the mapping
+                self.hasher.update(data)
+
+            def digest(self):
+                return self.hasher.digest()
+
+        async def run():
+            rechecker = Rechecker(self.storage, self.torrent.pieces, self.verifier)
+            task = asyncio.ensure_future(rechecker.run(range(7)))
+            while not hashing.is_set():
+                await asyncio.sleep(0.001)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            self.assertEqual(rechecker._maps, {})
+
+        with mock.patch.object(recheck, 'BATCH_SIZE', PIECE), \
+                mock.patch.object(recheck, 'sha1', SlowHash):
+            asyncio.run(run())
+
+    def test_batches_are_contiguous(self):
+        rechecker = Rechecker(self.storage, self.torrent.pieces, self.verifier)
+        with mock.patch.object(recheck, 'BATCH_SIZE', 2 * PIECE):
+            self.assertEqual(list(rechecker._batches([0, 1, 2, 4, 6])),
+                             [[0, 1], [2], [4], [6]])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import os
+import tempfile
+import unittest
+from pieces.bitset import Bitset
+from pieces.resume import ResumeFile
+
+INFO_HASH = b'\x02' * 20
+
+class TestResumeFile(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.files = [os.path.join(self.directory.name, name) for name in ('a', 'b')]
+        for path in self.files:
+            with open(path, 'wb') as f:
+                f.write(b'x' * 10)
+        self.resume = ResumeFile.for_torrent(self.directory.name, INFO_HASH, 10, self.files)
+
+    def tearDown(self):
+        self.resume.close()
+        self.directory.cleanup()
+
+    def reopen(self, info_hash=INFO_HASH, num_pieces=10):
+        self.resume.close()
+        return ResumeFile.for_torrent(self.directory.name, info_hash, num_pieces, self.files)
+
+    def test_missing(self):
+        self.assertIsNone(self.resume.load())
+        self.resume.record(1, [0])
+        self.assertFalse(os.path.exists(self.resume.path))
+
+    def test_snapshot(self):
+        have = Bitset(10)
+        have.add(3)
+        self.resume.compact(have)
+        self.assertTrue(self.resume.path.endswith(INFO_HASH.hex() + '.resume'))
+        state = self.reopen().load()
+        self.assertEqual(list(state.have), [3])
+        self.assertEqual(state.stale, set())
+
+    def test_journal(self):
+        self.resume.compact(Bitset(10))
+        with open(self.files[1], 'ab') as f:
+            f.write(b'y')
+        self.resume.record(4, [1])
+        self.resume.record(5, [0, 1])
+        resume = self.reopen()
+        state = resume.load()
+        self.assertEqual(list(state.have), [4, 5])
+        self.assertEqual(state.stale, set())
+        self.assertEqual(resume.records, 2)
+
+    def test_truncated_record_is_ignored(self):
+        self.resume.compact(Bitset(10))
+        self.resume.record(4, [1])
+        self.resume.record(5, [1])
+        self.resume.close()
+        with open(self.resume.path, 'r+b') as f:
+            f.truncate(os.path.getsize(self.resume.path) - 3)
+        self.assertEqual(list(self.reopen().load().have), [4])
+
+    def test_modified_files_are_stale(self):
+        self.resume.compact(Bitset(10))
+        os.utime(self.files[0], ns=(0, 12345))
+        self.assertEqual(self.reopen().load().stale, {0})
+
+    def test_other_torrent(self):
+        self.resume.compact(Bitset(10))
+        self.assertIsNone(self.reopen(num_pieces=11).load())
+
+    def test_compaction(self):
+        self.resume.compact(Bitset(10))
+        for index in range(ResumeFile.COMPACT_EVERY):
+            self.resume.record(index % 10, [0])
+        self.assertTrue(self.resume.should_compact())
+        have = Bitset.full(10)
+        self.resume.compact(have)
+        self.assertFalse(self.resume.should_compact())
+        self.assertEqual(self.reopen().load().have, have)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import asyncio
+import time
+import unittest
+from pieces.scheduler import BACKOFF_BASE, MAX_FAILURES, ConnectionScheduler, PeerStats
+
+class FakeConnection:
+    """
+    Stands in for a PeerConnection: peers in `reachable` accept the
+    connection and send `rate` bytes every 10 ms until closed.
+    """
+    def __init__(self, swarm):
+        self.swarm = swarm
+        self.connected = False
+        self.downloaded = 0
+        self.uploaded = 0
+
+    async def run(self, host, port, dial_limit, timeout):
+        async with dial_limit:
+            self.swarm.dialing += 1
+            self.swarm.max_dialing = max(self.swarm.max_dialing, self.swarm.dialing)
+            await asyncio.sleep(0.01)
+            self.swarm.dialing -= 1
+        self.swarm.dials.append((host, port))
+        rate = self.swarm.reachable.get((host, port))
+        if rate is None:
+            return
+        self.connected = True
+        while True:
+            await asyncio.sleep(0.01)
+            self.downloaded += rate
+
+    def stop(self):
+        pass
+
+class FakeSwarm:
+    def __init__(self, reachable):
+        self.reachable = reachable
+        self.dials = []
+        self.dialing = 0
+        self.max_dialing = 0
+
+class TestPeerStats(unittest.TestCase):
+
+    def test_ordering(self):
+        fast, slow, untried, failed = PeerStats(), PeerStats(), PeerStats(), PeerStats()
+        fast.downloaded, fast.connected_time = 1000, 1
+        slow.downloaded, slow.connected_time = 10, 1
+        failed.failures = 2
+        ranked = sorted([failed, untried, slow, fast], key=PeerStats.sort_key)
+        self.assertEqual(ranked, [fast, slow, untried, failed])
+        self.assertIsNone(untried.rate)
+
+class TestConnectionScheduler(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncTearDown(self):
+        self.scheduler.stop()
+        await asyncio.sleep(0)
+
+    def create(self, swarm, **kwargs):
+        self.scheduler = ConnectionScheduler(lambda: FakeConnection(swarm), **kwargs)
+        return self.scheduler
+
+    async def test_keeps_connections_full(self):
+        peers = [('10.0.0.1', port) for port in range(1, 21)]
+        swarm = FakeSwarm({peer: 100 for peer in peers[:12]})
+        scheduler = self.create(swarm, max_connections=10, max_half_open=3)
+        scheduler.start()
+        scheduler.add(peers)
+        await asyncio.sleep(0.3)
+        # Unreachable peers are replaced until every slot has a live peer
+        self.assertEqual(len(scheduler), 10)
+        self.assertTrue(all(connection.connected for connection, _ in scheduler.active.values()))
+        self.assertEqual(swarm.max_dialing, 3)
+        self.assertEqual(len(swarm.dials), len(set(swarm.dials)))
+
+    async def test_failed_peers_back_off(self):
+        swarm = FakeSwarm({})
+        scheduler = self.create(swarm)
+        scheduler.start()
+        scheduler.add([('10.0.0.1', 1)])
+        await asyncio.sleep(0.05)
+        stats = scheduler.peers[('10.0.0.1', 1)]
+        self.assertEqual(stats.failures, 1)
+        self.assertAlmostEqual(stats.next_attempt - time.monotonic(), BACKOFF_BASE, delta=1)
+        self.assertEqual(scheduler.candidates(), [])
+
+        for _ in range(MAX_FAILURES - 1):
+            stats.next_attempt = 0
+            scheduler._wakeup.set()
+            await asyncio.sleep(0.05)
+        self.assertNotIn(('10.0.0.1', 1), scheduler.peers)
+        self.assertEqual(len(swarm.dials), MAX_FAILURES)
+
+    async def test_slow_peers_are_replaced(self):
+        peers = [('10.0.0.1', port) for port in range(1, 6)]
+        swarm = FakeSwarm({peer: 1000 * port for peer in peers for port in [peer[1]]})
+        scheduler = self.create(swarm, max_connections=4, evict_interval=0.1)
+        scheduler.add(peers)
+        scheduler.start()
+        await asyncio.sleep(0.35)
+        # The slowest peer made room for the waiting one, and remembers its rate
+        self.assertIn(('10.0.0.1', 5), scheduler.active)
+        self.assertNotIn(('10.0.0.1', 1), scheduler.active)
+        self.assertGreater(scheduler.peers[('10.0.0.1', 1)].rate, 0)
+
+    async def test_banned_hosts_are_disconnected(self):
+        peers = [('10.0.0.1', 1), ('10.0.0.2', 1)]
+        swarm = FakeSwarm({peer: 100 for peer in peers})
+        scheduler = self.create(swarm)
+        scheduler.add(peers)
+        scheduler.start()
+        await asyncio.sleep(0.05)
+        scheduler.ban('10.0.0.1')
+        await asyncio.sleep(0)
+        self.assertEqual(list(scheduler.active), [('10.0.0.2', 1)])
+        self.assertEqual(list(scheduler.peers), [('10.0.0.2', 1)])
+        # Neither dialed nor accepted again
+        scheduler.add([('10.0.0.1', 2)])
+        self.assertNotIn(('10.0.0.1', 2), scheduler.peers)
+        self.assertFalse(scheduler.accept(('10.0.0.1', 3), None, None, None))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import asyncio
+import os
+import tempfile
+import threading
+import unittest
+from pieces.protocol import Handshake
+from pieces.session import FairExecutor, Session, fair_shares
+from support import make_torrent
+
+class TestFairShares(unittest.TestCase):
+
+    def test_unused_share_goes_to_others(self):
+        self.assertEqual(fair_shares(100, {'a': 10, 'b': 500, 'c': 500}),
+                         {'a': 10, 'b': 45, 'c': 45})
+
+    def test_everyone_satisfied(self):
+        self.assertEqual(fair_shares(100, {'a': 10, 'b': 20}), {'a': 10, 'b': 20})
+
+    def test_never_exceeds_total(self):
+        shares = fair_shares(10, {key: 4 for key in range(7)})
+        self.assertEqual(sum(shares.values()), 10)
+        self.assertLessEqual(max(shares.values()) - min(shares.values()), 1)
+
+class TestFairExecutor(unittest.TestCase):
+
+    def test_lanes_take_turns(self):
+        executor = FairExecutor(1)
+        gate = threading.Event()
+        order = []
+        busy, first, second = executor.lane(), executor.lane(), executor.lane()
+        blocker = busy.submit(gate.wait)
+        futures = [first.submit(order.append, f'first{i}') for i in range(3)]
+        futures.append(second.submit(order.append, 'second0'))
+        gate.set()
+        first.shutdown()
+        second.shutdown()
+        self.assertTrue(blocker.result())
+        self.assertEqual(order, ['first0', 'second0', 'first1', 'first2'])
+        executor.shutdown()
+
+    def test_errors_are_raised_by_the_future(self):
+        executor = FairExecutor(2)
+        future = executor.lane().submit(int, 'x')
+        with self.assertRaises(ValueError):
+            future.result()
+        executor.shutdown()
+
+class TestSession(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.session = Session(port=0, host='127.0.0.1', max_active=1,
+                               resume_dir=os.path.join(self.directory.name, 'resume'))
+        self.first, self.second = (
+            make_torrent(self.directory.name, os.urandom(1000), 2**14, name=name,
+                         announce=b'http://127.0.0.1:1/announce')
+            for name in (b'first.bin', b'second.bin'))
+        self.session.add(self.first)
+        self.session.add(self.second)
+        await self.session.start()
+
+    async def asyncTearDown(self):
+        await self.session.stop()
+        self.directory.cleanup()
+
+    async def handshake(self, info_hash):
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.session.port)
+        writer.write(Handshake(info_hash, b'-XX0000-000000000000').encode())
+        try:
+            return Handshake.decode(await asyncio.wait_for(reader.read(Handshake.length), 5))
+        finally:
+            writer.close()
+
+    async def test_only_max_active_torrents_run(self):
+        self.assertEqual(list(self.session.clients), [self.first.info_hash])
+        self.assertEqual(list(self.session.queued), [self.second.info_hash])
+
+    async def test_incoming_peers_are_routed_by_info_hash(self):
+        response = await self.handshake(self.first.info_hash)
+        self.assertEqual(response.info_hash, self.first.info_hash)
+        # Torrents not running don't take peers
+        self.assertIsNone(await self.handshake(self.second.info_hash))
+
+    async def test_next_torrent_starts_when_one_is_removed(self):
+        self.session.remove(self.first.info_hash)
+        await asyncio.sleep(0.1)
+        self.assertEqual(list(self.session.clients), [self.second.info_hash])
+
+if __name__ == '__main__':
+    unittest.main()
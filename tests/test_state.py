@@ -0,0 +1,78 @@
+import unittest
+from pieces.state import DownloadState
+
+BLOCK = 2**14
+
+class TestDownloadState(unittest.TestCase):
+
+    def setUp(self):
+        # Three pieces of four blocks, the last one only a block and a half
+        self.state = DownloadState(2 * 4 * BLOCK + BLOCK + BLOCK // 2, 4 * BLOCK)
+
+    def test_layout(self):
+        self.assertEqual(self.state.num_pieces, 3)
+        self.assertEqual(self.state.blocks_per_piece, 4)
+        self.assertEqual(self.state.block_count(2), 2)
+        self.assertEqual(self.state.piece_size(2), BLOCK + BLOCK // 2)
+        self.assertEqual(self.state.block_length(2, 1), BLOCK // 2)
+        self.assertEqual(self.state.block_length(0, 3), BLOCK)
+
+    def test_exact_multiple_of_piece_length(self):
+        state = DownloadState(8 * BLOCK, 4 * BLOCK)
+        self.assertEqual(state.num_pieces, 2)
+        self.assertEqual(state.piece_size(1), 4 * BLOCK)
+        self.assertEqual(state.block_count(1), 4)
+
+    def test_request_blocks_in_order(self):
+        self.assertEqual([self.state.request_block(2) for _ in range(3)], [0, 1, None])
+        self.assertEqual(self.state.block_status(2, 1), DownloadState.Pending)
+        self.assertEqual(self.state.next_missing_piece(), 0)
+        self.assertEqual(self.state.next_missing_piece(1), 1)
+        self.state.request_block(1)
+        self.assertIsNone(self.state.next_missing_piece(1))
+
+    def test_block_missing(self):
+        self.state.request_block(0)
+        self.state.block_missing(0, 0)
+        self.assertEqual(self.state.request_block(0), 0)
+
+    def test_completion(self):
+        for block in range(2):
+            self.state.request_block(2)
+            self.assertFalse(self.state.is_complete(2))
+            self.assertTrue(self.state.block_received(2, block))
+        self.assertFalse(self.state.block_received(2, 1))
+        self.assertTrue(self.state.is_complete(2))
+
+    def test_block_index(self):
+        self.assertEqual(self.state.block_index(0, 3 * BLOCK), 3)
+        self.assertIsNone(self.state.block_index(0, 100))
+        self.assertIsNone(self.state.block_index(2, 2 * BLOCK))
+        self.assertIsNone(self.state.block_index(3, 0))
+
+    def test_have(self):
+        self.state.set_have(2)
+        self.state.set_have(2)
+        self.assertTrue(self.state.has(2))
+        self.assertFalse(self.state.has(1))
+        self.assertEqual(self.state.have_count, 1)
+        self.assertEqual(self.state.bytes_have, BLOCK + BLOCK // 2)
+        self.assertIsNone(self.state.request_block(2))
+        self.state.set_have(0)
+        self.state.set_have(1)
+        self.assertTrue(self.state.complete)
+        self.assertEqual(self.state.have.tobytes(), bytes([0b11100000]))
+
+    def test_reset(self):
+        self.state.request_block(0)
+        self.state.block_received(0, 0)
+        self.state.reset(0)
+        self.assertEqual(self.state.retrieved[0], 0)
+        self.assertEqual(self.state.next_missing_piece(), 0)
+        self.state.set_have(1)
+        self.state.reset(1)
+        self.assertFalse(self.state.has(1))
+        self.assertEqual(self.state.have_count, 0)
+
+if __name__ == '__main__':
+    unittest.main()
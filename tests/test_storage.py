@@ -0,0 +1,158 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from pieces.exceptions import TorrentError
+from pieces.storage import FilePool, Storage
+from support import make_torrent
+
+class TestStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.torrent = make_torrent(self.directory.name, bytes(18), 8, name=b'multi', files=[
+            ([b'a.bin'], 5),
+            ([b'empty'], 0),
+            ([b'sub', b'b.bin'], 10),
+            ([b'..', b'c.bin'], 3),
+        ])
+        self.storage = Storage(self.torrent)
+
+    def tearDown(self):
+        self.storage.close()
+        self.directory.cleanup()
+
+    def path(self, *parts):
+        return os.path.join(self.directory.name, 'multi', *parts)
+
+    def test_layout(self):
+        self.assertEqual([(f.path, f.offset, f.length) for f in self.storage.files], [
+            (self.path('a.bin'), 0, 5),
+            (self.path('empty'), 5, 0),
+            (self.path('sub', 'b.bin'), 5, 10),
+            (self.path('c.bin'), 15, 3),
+        ])
+
+    def test_piece_spans(self):
+        self.assertEqual(self.storage.piece_spans(0), [(0, 0, 5), (2, 0, 3)])
+        self.assertEqual(self.storage.piece_spans(1), [(2, 3, 7), (3, 0, 1)])
+        self.assertEqual(self.storage.piece_spans(2), [(3, 1, 2)])
+
+    def test_out_of_range(self):
+        with self.assertRaises(TorrentError):
+            self.storage.spans(10, 9)
+
+    def test_preallocate(self):
+        self.storage.preallocate()
+        self.assertEqual(os.path.getsize(self.path('a.bin')), 5)
+        self.assertEqual(os.path.getsize(self.path('empty')), 0)
+        self.assertEqual(os.path.getsize(self.path('sub', 'b.bin')), 10)
+        self.assertEqual(os.path.getsize(self.path('c.bin')), 3)
+
+    def test_out_of_order_writes(self):
+        data = bytes(range(18))
+        self.storage.writev(16, [memoryview(data[16:])])
+        self.storage.writev(8, [data[8:12], bytearray(data[12:16])])
+        self.storage.write(0, data[:8])
+        self.assertEqual(self.storage.read(0, 18), data)
+        self.assertEqual(self.storage.read_piece(2), data[16:])
+        with open(self.path('a.bin'), 'rb') as f:
+            self.assertEqual(f.read(), data[:5])
+        with open(self.path('sub', 'b.bin'), 'rb') as f:
+            self.assertEqual(f.read(), data[5:15])
+
+    def test_unwritten_data_reads_as_zeros(self):
+        self.storage.preallocate()
+        self.assertEqual(self.storage.read(3, 6), bytes(6))
+
+    def test_readinto_across_files(self):
+        self.storage.write(0, bytes(range(18)))
+        buffer = bytearray(b'#' * 12)
+        self.storage.readinto(3, memoryview(buffer)[1:11])
+        self.assertEqual(bytes(buffer), b'#' + bytes(range(3, 13)) + b'#')
+
+    def test_readinto_unwritten_data(self):
+        self.storage.write(0, b'abc')
+        buffer = bytearray(b'#' * 6)
+        self.storage.readinto(0, buffer)
+        self.assertEqual(bytes(buffer), b'abc' + bytes(3))
+
+    def test_async(self):
+        async def run():
+            await self.storage.write_async(4, [b'abcd', b'efgh'])
+            buffers = [bytearray(2), bytearray(3)]
+            await self.storage.readinto_async([(4, buffers[0]), (9, buffers[1])])
+            return await self.storage.read_async(4, 8), buffers
+        self.assertEqual(asyncio.run(run()), (b'abcdefgh', [b'ab', b'fgh']))
+
+    def test_close_async_finishes_queued_writes(self):
+        async def run():
+            writes = [asyncio.ensure_future(self.storage.write_async(offset, [bytes([offset]) * 2]))
+                      for offset in range(0, 16, 2)]
+            await asyncio.sleep(0)
+            await self.storage.close_async()
+            await asyncio.gather(*writes)
+        asyncio.run(run())
+        with open(self.path('sub', 'b.bin'), 'rb') as f:
+            self.assertEqual(f.read(), bytes([4, 6, 6, 8, 8, 10, 10, 12, 12, 14]))
+
+class TestFilePool(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.pool = FilePool(max_open=2)
+        torrents = [make_torrent(os.path.join(self.directory.name, str(i)), bytes(8), 4,
+                                 name=b'multi', files=[([b'a'], 4), ([b'b'], 4)])
+                    for i in range(2)]
+        self.storages = [Storage(torrent, files=self.pool) for torrent in torrents]
+
+    def tearDown(self):
+        for storage in self.storages:
+            storage.close()
+        self.directory.cleanup()
+
+    def test_least_recently_used_files_are_closed(self):
+        first, second = self.storages
+        first.write(0, b'abcdefgh')
+        second.write(0, b'ijkl')
+        self.assertEqual(len(self.pool), 2)
+        # Reopened after being closed
+        self.assertEqual(first.read(0, 8), b'abcdefgh')
+        self.assertEqual(len(self.pool), 2)
+
+    def test_files_in_use_are_kept_open(self):
+        first, second = self.storages
+        with first._open(0), first._open(1):
+            second.write(0, b'ijkl')
+            self.assertEqual(len(self.pool), 3)
+        second.write(4, b'mnop')
+        self.assertEqual(len(self.pool), 2)
+
+    def test_idle_files_are_closed(self):
+        first, second = self.storages
+        first.write(0, b'abcd')
+        with second._open(0):
+            self.pool.close_idle(0)
+            self.assertEqual(len(self.pool), 1)
+        second.close()
+        self.assertEqual(len(self.pool), 0)
+
+    def test_preallocate_async(self):
+        asyncio.run(self.storages[0].preallocate_async())
+        self.assertEqual(os.path.getsize(self.storages[0].files[1].path), 4)
+        self.assertLessEqual(len(self.pool), 2)
+
+class TestSingleFileStorage(unittest.TestCase):
+
+    def test_single_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            torrent = make_torrent(directory, bytes(10), 4, name=b'multi')
+            storage = Storage(torrent)
+            storage.preallocate()
+            storage.write(4, b'xyzw')
+            storage.close()
+            with open(os.path.join(directory, 'multi'), 'rb') as f:
+                self.assertEqual(f.read(), b'\0' * 4 + b'xyzw' + b'\0' * 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,163 @@
+import asyncio
+import os
+import tempfile
+import time
+import unittest
+from pieces.bitset import Bitset
+from pieces.client import CRITICAL_TIME, DEADLINE_PRIORITY, PieceManager
+from pieces.exceptions import TorrentError
+from pieces.streaming import FileStream
+from support import make_torrent
+
+BLOCK = 2**14
+PIECE = 2 * BLOCK
+
+
+class TestStreaming(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.data = os.urandom(8 * PIECE)
+        # Piece 3 is shared by both files
+        self.torrent = make_torrent(self.directory.name, self.data, PIECE,
+                                    files=[(b'a.bin', 7 * BLOCK), (b'b.bin', 9 * BLOCK)])
+        self.manager = PieceManager(self.torrent)
+        self.manager.picker.random_first = 0
+        self.manager.add_peer('peer', Bitset.full(8))
+
+    def tearDown(self):
+        self.manager.close()
+        self.directory.cleanup()
+
+    def receive(self, peer_id, block):
+        start = block.piece * PIECE + block.offset
+        self.manager.block_received(peer_id, block.piece, block.offset,
+                                    memoryview(self.data[start:start + block.length]))
+
+    def download(self, peer_id='peer'):
+        pieces = []
+        block = self.manager.next_request(peer_id)
+        while block:
+            pieces.append(block.piece)
+            self.receive(peer_id, block)
+            block = self.manager.next_request(peer_id)
+        return pieces
+
+    def test_file_selection(self):
+        self.manager.set_file_priority(1, 0)
+        self.assertEqual(list(self.manager.skipped), [4, 5, 6, 7])
+        self.assertEqual(sorted(set(self.download())), [0, 1, 2, 3])
+        self.assertTrue(self.manager.complete)
+        self.assertFalse(self.manager.state.complete)
+        self.manager.add_peer('other', Bitset.full(8))
+        self.assertFalse(self.manager.is_interested('other'))
+        with self.assertRaises(ValueError):
+            self.manager.set_file_priority(0, 8)
+
+    def test_file_priority(self):
+        self.manager.set_file_priority(1, 2)
+        # The shared piece has the highest priority of its files
+        self.assertEqual(list(self.manager.picker.priority), [1, 1, 1, 2, 2, 2, 2, 2])
+        self.assertEqual(set(self.download()[:10]), {3, 4, 5, 6, 7})
+
+    def test_deadlines_are_picked_in_order(self):
+        now = time.monotonic()
+        self.manager.set_deadlines({6: now + 10, 5: now + 20, 1: now + 30}, owner='a')
+        self.assertEqual(self.manager.picker.priority[6], DEADLINE_PRIORITY)
+        pieces = self.download()
+        self.assertEqual(pieces[:6], [6, 6, 5, 5, 1, 1])
+        # Clearing them restores the file priorities
+        self.manager.set_deadlines({}, owner='a')
+        self.assertEqual(list(self.manager.picker.priority), [1] * 8)
+
+    def test_critical_pieces_are_left_to_fast_peers(self):
+        self.manager.add_peer('slow', Bitset.full(8))
+        now = time.monotonic()
+        self.manager.rates = {'peer': (1e6, now), 'slow': (1e3, now)}
+        self.manager._fastest = (1e6, now)
+        self.manager.set_deadlines({4: now, 5: now + 10 * CRITICAL_TIME})
+        self.assertTrue(self.manager.is_fast('peer'))
+        self.assertFalse(self.manager.is_fast('slow'))
+        # The slow peer only gets the piece that is not due yet
+        self.assertEqual(self.manager.next_request('slow').piece, 5)
+        self.assertEqual(self.manager.next_request('peer').piece, 4)
+        self.assertEqual(self.manager.next_request('slow').piece, 5)
+        self.assertEqual(self.manager.next_request('peer').piece, 4)
+
+    def test_fast_peer_races_slow_peer(self):
+        self.manager.add_peer('slow', Bitset.full(8))
+        self.manager.set_deadlines({4: time.monotonic()})
+        # Before any block arrived every peer is fast
+        blocks = [self.manager.next_request('slow') for _ in range(2)]
+        self.assertEqual([(b.piece, b.offset) for b in blocks], [(4, 0), (4, BLOCK)])
+        now = time.monotonic()
+        self.manager.rates = {'peer': (1e6, now), 'slow': (1e3, now)}
+        self.manager._fastest = (1e6, now)
+        block = self.manager.next_request('peer')
+        self.assertEqual((block.piece, block.offset), (4, 0))
+        self.assertEqual(self.manager.pending_blocks[(4, 0)].peers, {'slow', 'peer'})
+
+
+class TestFileStream(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.data = os.urandom(8 * PIECE)
+        self.torrent = make_torrent(self.directory.name, self.data, PIECE,
+                                    files=[(b'a.bin', 7 * BLOCK), (b'b.bin', 9 * BLOCK)])
+        self.manager = PieceManager(self.torrent)
+        self.manager.add_peer('peer', Bitset.full(8))
+
+    def tearDown(self):
+        self.manager.close()
+        self.directory.cleanup()
+
+    async def download(self, count: int):
+        """
+        Downloads the next `count` pieces the manager asks for.
+        """
+        pieces = []
+        while len(pieces) < count:
+            block = self.manager.next_request('peer')
+            start = block.piece * PIECE + block.offset
+            self.manager.block_received('peer', block.piece, block.offset,
+                                        self.data[start:start + block.length])
+            if self.manager.state.is_complete(block.piece) and block.piece not in pieces:
+                pieces.append(block.piece)
+        await asyncio.gather(*self.manager._writes)
+        return pieces
+
+    def test_read_waits_for_pieces(self):
+        async def run():
+            stream = FileStream(self.manager, 1, read_ahead=2 * PIECE)
+            # The window starts at the piece shared with the first file
+            self.assertEqual(sorted(self.manager.deadlines), [3, 4, 5])
+            read = asyncio.ensure_future(stream.read(PIECE))
+            await asyncio.sleep(0)
+            self.assertFalse(read.done())
+            self.assertEqual(await self.download(2), [3, 4])
+            self.assertEqual(await read, self.data[7 * BLOCK:9 * BLOCK])
+            self.assertEqual(stream.tell(), PIECE)
+            # The window moved along
+            self.assertEqual(sorted(self.manager.deadlines), [5])
+
+            stream.seek(-100, os.SEEK_END)
+            self.assertEqual(sorted(self.manager.deadlines), [7])
+            read = asyncio.ensure_future(stream.read())
+            self.assertEqual(await self.download(1), [7])
+            self.assertEqual(await read, self.data[-100:])
+            self.assertEqual(await stream.read(), b'')
+            stream.close()
+            self.assertEqual(self.manager.deadlines, {})
+        asyncio.run(run())
+
+    def test_read_fails_when_torrent_closes(self):
+        async def run():
+            async with FileStream(self.manager, 0) as stream:
+                read = asyncio.ensure_future(stream.read(10))
+                await asyncio.sleep(0)
+                self.manager.close()
+                with self.assertRaises(TorrentError):
+                    await read
+            self.assertTrue(stream.closed)
+        asyncio.run(run())
@@ -0,0 +1,50 @@
+import unittest
+from pieces.timeouts import MAX_TIMEOUT, MIN_TIMEOUT, RttEstimator, TimeoutQueue
+
+class TestRttEstimator(unittest.TestCase):
+
+    def test_initial_timeout(self):
+        self.assertEqual(RttEstimator(initial=20).timeout, 20)
+
+    def test_follows_round_trips(self):
+        estimator = RttEstimator()
+        for _ in range(50):
+            estimator.sample(1.0)
+        self.assertAlmostEqual(estimator.srtt, 1.0)
+        self.assertLess(estimator.timeout, 2.5)
+        self.assertGreaterEqual(estimator.timeout, MIN_TIMEOUT)
+
+    def test_jitter_widens_timeout(self):
+        steady, jittery = RttEstimator(min_timeout=0), RttEstimator(min_timeout=0)
+        for i in range(50):
+            steady.sample(1.0)
+            jittery.sample(0.2 if i % 2 else 1.8)
+        self.assertGreater(jittery.timeout, steady.timeout + 1)
+
+    def test_timeouts_back_off_and_snub(self):
+        estimator = RttEstimator()
+        estimator.sample(1.0)
+        timeout = estimator.timeout
+        estimator.timed_out()
+        self.assertTrue(estimator.snubbed)
+        self.assertEqual(estimator.timeout, 2 * timeout)
+        for _ in range(10):
+            estimator.timed_out()
+        self.assertEqual(estimator.timeout, MAX_TIMEOUT)
+        estimator.sample(1.0)
+        self.assertFalse(estimator.snubbed)
+        self.assertEqual(estimator.timeouts, 0)
+
+class TestTimeoutQueue(unittest.TestCase):
+
+    def test_expired_in_deadline_order(self):
+        queue = TimeoutQueue()
+        for deadline, item in [(5, 'e'), (1, 'a'), (3, 'c'), (3, 'd'), (2, 'b')]:
+            queue.push(deadline, item)
+        self.assertEqual(queue.next_deadline(), 1)
+        self.assertEqual(list(queue.expired(3)), ['a', 'b', 'c', 'd'])
+        self.assertEqual(len(queue), 1)
+        self.assertEqual(list(queue.expired(4)), [])
+
+if __name__ == '__main__':
+    unittest.main()
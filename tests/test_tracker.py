@@ -1,11 +1,282 @@
-import unittest
-from pieces.tracker import Tracker
-
-class TestTracker(unittest.TestCase):
-
-    def test_tracker_connection(self):
-        tracker = Tracker('http://example.com/announce')
-        self.assertTrue(tracker.connect())
-
-if __name__ == '__main__':
-    unittest.main()
+import asyncio
+import socket
+import struct
+import unittest
+from urllib.parse import unquote_to_bytes
+from aiohttp import web
+from pieces.bencoding import Encoder
+from pieces.exceptions import TrackerError
+from pieces.tracker import HTTPPool, ScrapeStats, Tracker, scrape_url
+
+INFO_HASH = b'\x01' * 20
+
+class FakeTorrent:
+    def __init__(self, announce='', announce_list=None, info_hash=INFO_HASH):
+        self.announce = announce
+        self.meta_info = {b'announce': announce.encode()}
+        if announce_list is not None:
+            self.meta_info[b'announce-list'] = [[url.encode() for url in tier]
+                                                for tier in announce_list]
+        self.info_hash = info_hash
+        self.total_size = 1000
+
+def compact(peers):
+    return b''.join(socket.inet_aton(host) + struct.pack('!H', port) for host, port in peers)
+
+class FakeUDPTracker(asyncio.DatagramProtocol):
+    """
+    A BEP 15 tracker that can drop the first requests it receives.
+    """
+    def __init__(self, peers, drop=0, error=None):
+        self.peers = peers
+        self.drop = drop
+        self.error = error
+        self.connects = 0
+        self.announces = []
+        self.scrapes = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if self.drop:
+            self.drop -= 1
+            return
+        connection_id, action, transaction_id = struct.unpack_from('!QII', data)
+        if action == 0:
+            self.connects += 1
+            response = struct.pack('!IIQ', 0, transaction_id, 0xC0FFEE)
+        elif self.error:
+            response = struct.pack('!II', 3, transaction_id) + self.error
+        elif action == 2:
+            hashes = [data[i:i + 20] for i in range(16, len(data), 20)]
+            self.scrapes.append(hashes)
+            response = struct.pack('!II', 2, transaction_id) + b''.join(
+                struct.pack('!III', h[0], 7, 3) for h in hashes)
+        else:
+            self.announces.append(struct.unpack('!QII20s20sQQQIIIiH', data))
+            response = struct.pack('!IIIII', 1, transaction_id, 900, 1, 2) + compact(self.peers)
+        self.transport.sendto(response, addr)
+
+class TestTracker(unittest.TestCase):
+
+    def test_tracker_connection(self):
+        tracker = Tracker('http://example.com/announce')
+        self.assertTrue(tracker.connect())
+
+    def test_tiers_from_announce_list(self):
+        tracker = Tracker(FakeTorrent('http://a/announce',
+                                      [['http://b/announce'], ['udp://c:1', 'udp://d:2']]))
+        self.assertEqual(tracker.tiers[0], ['http://b/announce'])
+        self.assertEqual(sorted(tracker.tiers[1]), ['udp://c:1', 'udp://d:2'])
+
+    def test_tiers_fall_back_to_announce(self):
+        tracker = Tracker(FakeTorrent('http://a/announce'))
+        self.assertEqual(tracker.tiers, [['http://a/announce']])
+
+    def test_udp_peers_start_after_header(self):
+        tracker = Tracker(FakeTorrent())
+        response = struct.pack('!IIIII', 1, 7, 600, 3, 4) + compact([('10.0.0.1', 6881)])
+        self.assertEqual(tracker.parse_udp_response(response),
+                         {'interval': 600, 'peers': [('10.0.0.1', 6881)]})
+
+    def test_http_peers6(self):
+        tracker = Tracker(FakeTorrent())
+        peers6 = socket.inet_pton(socket.AF_INET6, '::1') + struct.pack('!H', 2)
+        response = Encoder({b'interval': 60, b'peers6': peers6,
+                            b'peers': compact([('10.0.0.1', 1), ('10.0.0.1', 1)])}).encode()
+        self.assertEqual(tracker.parse_response(response)['peers'], [('10.0.0.1', 1), ('::1', 2)])
+
+    def test_udp_ipv6_peers(self):
+        tracker = Tracker(FakeTorrent())
+        response = struct.pack('!IIIII', 1, 7, 600, 3, 4) + \
+            socket.inet_pton(socket.AF_INET6, '::1') + struct.pack('!H', 2)
+        self.assertEqual(tracker.parse_udp_response(response, ipv6=True)['peers'], [('::1', 2)])
+
+    def test_scrape_url(self):
+        self.assertEqual(scrape_url('http://t/announce'), 'http://t/scrape')
+        self.assertEqual(scrape_url('http://t/x/announce.php?k=1'), 'http://t/x/scrape.php?k=1')
+        self.assertIsNone(scrape_url('http://t/a'))
+        self.assertEqual(scrape_url('udp://t:1'), 'udp://t:1')
+
+    def test_http_failure_reason(self):
+        tracker = Tracker(FakeTorrent())
+        with self.assertRaises(TrackerError):
+            tracker.parse_response(Encoder({b'failure reason': b'unregistered'}).encode())
+
+class TestTrackerAnnounce(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        Tracker.connection_ids.clear()
+        self.servers = []
+
+    async def asyncTearDown(self):
+        await Tracker.http_pool.close()
+        for close in self.servers:
+            await close()
+
+    async def udp_tracker(self, peers, **kwargs):
+        loop = asyncio.get_running_loop()
+        transport, protocol = await loop.create_datagram_endpoint(
+            lambda: FakeUDPTracker(peers, **kwargs), local_addr=('127.0.0.1', 0))
+
+        async def close():
+            transport.close()
+        self.servers.append(close)
+        return protocol, f'udp://127.0.0.1:{transport.get_extra_info("sockname")[1]}/announce'
+
+    async def http_tracker(self, peers):
+        self.requests = []
+
+        async def announce(request):
+            self.requests.append(request.transport.get_extra_info('peername'))
+            query = dict(part.split('=', 1) for part in request.rel_url.raw_query_string.split('&'))
+            self.assertEqual(unquote_to_bytes(query['info_hash']), INFO_HASH)
+            return web.Response(body=Encoder({b'interval': 1800, b'peers': compact(peers)}).encode())
+
+        async def scrape(request):
+            self.requests.append(request.transport.get_extra_info('peername'))
+            hashes = [unquote_to_bytes(part.split('=', 1)[1])
+                      for part in request.rel_url.raw_query_string.split('&')]
+            files = {h: {b'complete': h[0], b'downloaded': 7, b'incomplete': 3} for h in hashes}
+            return web.Response(body=Encoder({b'files': files}).encode())
+        app = web.Application()
+        app.router.add_get('/announce', announce)
+        app.router.add_get('/scrape', scrape)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        self.servers.append(runner.cleanup)
+        return f'http://127.0.0.1:{runner.addresses[0][1]}/announce'
+
+    def unused_udp_url(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        return f'udp://127.0.0.1:{port}/announce'
+
+    async def test_udp_announce_caches_connection_id(self):
+        server, url = await self.udp_tracker([('10.0.0.1', 1), ('10.0.0.2', 2)])
+        tracker = Tracker(FakeTorrent(url), udp_timeout=0.5)
+        for _ in range(3):
+            response = await tracker.connect(downloaded=100, event='started')
+            self.assertEqual(sorted(response['peers']), [('10.0.0.1', 1), ('10.0.0.2', 2)])
+            self.assertEqual(response['interval'], 900)
+        self.assertEqual(server.connects, 1)
+        self.assertEqual(len(server.announces), 3)
+        connection_id, action, _, info_hash, peer_id, downloaded, left, _, event, *_ = \
+            server.announces[0]
+        self.assertEqual((connection_id, action, info_hash, downloaded, left, event),
+                         (0xC0FFEE, 1, INFO_HASH, 100, 900, 2))
+        self.assertEqual(peer_id, tracker.peer_id.encode())
+
+    async def test_udp_retries_lost_requests(self):
+        server, url = await self.udp_tracker([('10.0.0.1', 1)], drop=2)
+        tracker = Tracker(FakeTorrent(url), udp_timeout=0.05, udp_retries=3)
+        response = await tracker.connect()
+        self.assertEqual(response['peers'], [('10.0.0.1', 1)])
+
+    async def test_udp_gives_up(self):
+        _, url = await self.udp_tracker([], drop=100)
+        tracker = Tracker(FakeTorrent(url), udp_timeout=0.02, udp_retries=1)
+        with self.assertRaises(TrackerError):
+            await tracker.announce(url)
+
+    async def test_udp_tracker_error(self):
+        _, url = await self.udp_tracker([], error=b'unregistered torrent')
+        tracker = Tracker(FakeTorrent(url), udp_timeout=0.5)
+        with self.assertRaisesRegex(TrackerError, 'unregistered torrent'):
+            await tracker.announce(url)
+
+    async def test_tiers_are_merged_and_deduplicated(self):
+        _, udp = await self.udp_tracker([('10.0.0.1', 1), ('10.0.0.2', 2)])
+        http = await self.http_tracker([('10.0.0.2', 2), ('10.0.0.3', 3)])
+        tracker = Tracker(FakeTorrent(udp, [[udp], [http]]), udp_timeout=0.5)
+        batches = []
+        response = await tracker.connect(on_peers=batches.append)
+        expected = [('10.0.0.1', 1), ('10.0.0.2', 2), ('10.0.0.3', 3)]
+        self.assertEqual(sorted(response['peers']), expected)
+        self.assertEqual(sorted(peer for batch in batches for peer in batch), expected)
+        self.assertEqual(response['interval'], 900)
+
+    async def test_tier_falls_back_to_next_tracker(self):
+        _, good = await self.udp_tracker([('10.0.0.1', 1)])
+        bad = self.unused_udp_url()
+        tracker = Tracker(FakeTorrent(good, [[good, bad]]), udp_timeout=0.05, udp_retries=0)
+        tracker.tiers[0][:] = [bad, good]
+        response = await tracker.connect()
+        self.assertEqual(response['peers'], [('10.0.0.1', 1)])
+        # The tracker that responded moves to the front of its tier
+        self.assertEqual(tracker.tiers[0], [good, bad])
+
+    async def test_silent_tracker_is_given_up(self):
+        _, good = await self.udp_tracker([('10.0.0.1', 1)])
+        _, silent = await self.udp_tracker([], drop=100)
+        tracker = Tracker(FakeTorrent(good, [[silent, good]]), udp_timeout=60,
+                          announce_timeout=0.05)
+        tracker.tiers[0][:] = [silent, good]
+        response = await asyncio.wait_for(tracker.connect(), 5)
+        self.assertEqual(response['peers'], [('10.0.0.1', 1)])
+
+    async def test_connect_deadline_keeps_responses(self):
+        _, good = await self.udp_tracker([('10.0.0.1', 1)])
+        _, silent = await self.udp_tracker([], drop=100)
+        tracker = Tracker(FakeTorrent(good, [[good], [silent]]), udp_timeout=60)
+        response = await asyncio.wait_for(tracker.connect(timeout=0.2), 5)
+        self.assertEqual(response['peers'], [('10.0.0.1', 1)])
+
+    async def test_no_tracker_responds(self):
+        tracker = Tracker(FakeTorrent(self.unused_udp_url()), udp_timeout=0.02, udp_retries=0)
+        self.assertIsNone(await tracker.connect())
+
+    async def test_http_connections_are_reused(self):
+        url = await self.http_tracker([('10.0.0.1', 1)])
+        trackers = [Tracker(FakeTorrent(url)) for _ in range(3)]
+        for tracker in trackers:
+            response = await tracker.connect()
+            self.assertEqual(response['peers'], [('10.0.0.1', 1)])
+        # One keep-alive connection served every torrent
+        self.assertEqual(len(self.requests), 3)
+        self.assertEqual(len(set(self.requests)), 1)
+
+    async def test_http_pool_is_closed_by_its_last_holder(self):
+        pool = HTTPPool()
+        pool.acquire()
+        pool.acquire()
+        session = pool.session
+        await pool.release()
+        self.assertFalse(session.closed)
+        await pool.release()
+        self.assertTrue(session.closed)
+
+    async def test_http_scrape_is_batched(self):
+        url = await self.http_tracker([])
+        hashes = [bytes([i]) * 20 for i in range(60)]
+        stats = await Tracker(FakeTorrent(url)).scrape(url, hashes)
+        self.assertEqual(len(self.requests), 2)  # 50 info hashes per request
+        self.assertEqual(stats[hashes[5]], ScrapeStats(5, 7, 3))
+        self.assertEqual(len(stats), 60)
+
+    async def test_udp_scrape_is_batched(self):
+        server, url = await self.udp_tracker([])
+        hashes = [bytes([i]) * 20 for i in range(80)]
+        stats = await Tracker(FakeTorrent(url), udp_timeout=0.5).scrape(url, hashes)
+        self.assertEqual([len(batch) for batch in server.scrapes], [74, 6])
+        self.assertEqual(server.connects, 1)
+        self.assertEqual(stats[hashes[79]], ScrapeStats(79, 7, 3))
+
+    async def test_scrape_all_groups_by_tracker(self):
+        http = await self.http_tracker([])
+        server, udp = await self.udp_tracker([])
+        trackers = [Tracker(FakeTorrent(http, info_hash=bytes([i]) * 20)) for i in range(3)]
+        trackers += [Tracker(FakeTorrent(udp, info_hash=bytes([i]) * 20), udp_timeout=0.5)
+                     for i in range(3, 5)]
+        stats = await Tracker.scrape_all(trackers)
+        self.assertEqual(sorted(stats), [bytes([i]) * 20 for i in range(5)])
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual(len(server.scrapes), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,32 @@
+import asyncio
+import hashlib
+import unittest
+from pieces.verify import PieceVerifier, digest
+
+class TestPieceVerifier(unittest.TestCase):
+
+    def setUp(self):
+        self.verifier = PieceVerifier(max_workers=2)
+        self.blocks = [bytes([i]) * 2**14 for i in range(4)]
+        self.expected = hashlib.sha1(b''.join(self.blocks)).digest()
+
+    def tearDown(self):
+        self.verifier.close()
+
+    def test_digest_of_buffers(self):
+        self.assertEqual(digest(self.blocks), self.expected)
+        self.assertEqual(digest([memoryview(b) for b in self.blocks]), self.expected)
+
+    def test_check(self):
+        self.assertTrue(self.verifier.check(self.expected, self.blocks))
+        self.assertFalse(self.verifier.check(self.expected, self.blocks[:3]))
+
+    def test_verify_off_loop(self):
+        async def run():
+            return await asyncio.gather(
+                self.verifier.verify(self.expected, self.blocks),
+                self.verifier.verify(self.expected, reversed(self.blocks)))
+        self.assertEqual(asyncio.run(run()), [True, False])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -65,8 +65,14 @@ class TorrentGUI:
         if self.client.piece_manager:
             downloaded_bytes = self.client.piece_manager.bytes_downloaded
             total_size = self.client.piece_manager.torrent.total_size
-
-            if total_size > 0:
+            checked = self.client.piece_manager.check_progress
+
+            if checked is not None:
+                # Show the recheck of existing data until it is done
+                self.progress_label.config(text="Checking Existing Data:")
+                self.progress_bar["value"] = checked * 100
+            elif total_size > 0:
+                self.progress_label.config(text="Download Progress:")
                 progress = (downloaded_bytes / total_size) * 100
                 self.progress_bar["value"] = progress
 